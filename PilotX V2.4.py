@@ -9,10 +9,8 @@ import serial # pyserial library is needed
 import serial.tools.list_ports
 import threading
 import time
-import queue
+from concurrent.futures import TimeoutError as FutureTimeout
 import re
-from collections import deque
-from math import floor
 import csv
 from matplotlib.figure import Figure # Matplotlib library is needed
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
@@ -21,11 +19,22 @@ import json
 from tkinter import simpledialog, messagebox
 import os
 from PIL import Image, ImageTk  # pillow library is needed
+from pilotx_engine import StreamEngine, GRBL_RX_BUFFER_SIZE, STREAM_MODE_LINES, STREAM_MODE_CHARS
+from pilotx_engine import RT_STATUS, RT_FEED_HOLD, RT_CYCLE_START, RT_SOFT_RESET
+from pilotx_engine import RESP_PROBE, RESP_ALARM, RESP_ERROR
+from pilotx_gcode import load_gcode_program, apply_height_map, decimate_program, toolpath_runs, toolpath_segments, CompactedLines, FLAG_X, FLAG_Y, FLAG_Z
+from pilotx_gcode import resume_state, resume_preamble
+from pilotx_estimate import estimate_program, format_duration, normalize_profile
+from pilotx_log import LogPipeline, LOG_SENT, LOG_ACK
 
 # ------------------------- Constants -------------------------
 DEFAULT_SEND_RATE = 15.0  # lines/sec for simulation
-READER_QUEUE_MAX = 1000   # serial response queue size
-GRBL_BUFFER_MAX = 16      # GRBL 1.2h planner buffer (safe)
+UI_REFRESH_MS = 33        # DRO / progress / cone refresh tick (~30 Hz)
+LOG_FLUSH_MS = 100        # console batch flush interval
+CONE_HEIGHT = 5.0         # tool marker, mm
+CONE_RADIUS = 2.0
+CONE_SEGMENTS = 20
+STATS_REFRESH_MS = 500    # streaming stats line / histogram refresh
 
 # ------------------------- CNC Sender App -------------------------
 class CNCSenderApp:
@@ -39,42 +48,77 @@ class CNCSenderApp:
         
         #Simulation/gcode sending speed-------------------------
         self.update_interval = 20
+
+        # UI refresh: engine threads only record the latest state and mark it
+        # dirty; one pending _ui_tick at a time applies it on the Tk thread
+        self._ui_lock = threading.Lock()
+        self._ui_pending = False
+        self._ui_status_dirty = False
+        self._ui_dro_dirty = False
+        self._ui_line_index = None    # latest line sent (toolpath cone)
+        self._ui_drawn_index = -1     # line the cone was last drawn at
+        self._tool_marker = None      # persistent cone, animated (blitted over _toolpath_bg)
+        self._toolpath_bg = None      # canvas without the cone, saved after every full draw
+        self._ui_progress = None      # latest (index, total)
         
         
         #Load Json File For Previous Settings
         self.config = {}
         self.load_settings()
 
-        # Serial / Thread variables
-        self.serial_connection = None
-        self.is_connected = False
-        self.serial_lock = threading.Lock()
-        self.response_queue = queue.Queue(maxsize=READER_QUEUE_MAX)
-        self.reader_thread = None
+        # Console log: messages are queued from any thread and flushed in batches
+        # by _flush_log; the full log also goes to log_file
+        self.log_pipeline = LogPipeline(
+            path=self.config.get("log_file", "pilotx.log"),
+            max_lines=self.config.get("console_max_lines", 2000),
+            sample={
+                LOG_SENT: self.config.get("log_sent_every", 1),
+                LOG_ACK: self.config.get("log_ok_every", 1),
+            },
+        )
 
-        self.send_manager_thread = None
-        self.send_manager_stop = threading.Event()
-        self.send_manager_pause = threading.Event()
-        self.pending_lines = deque()  # lines sent but waiting for ok
+        # Streaming engine: serial I/O, buffering, status parsing and the send loop.
+        # The GUI only subscribes to its events (see _subscribe_engine).
+        self.engine = StreamEngine(
+            stream_mode=self.config.get("stream_mode", STREAM_MODE_LINES),
+            rx_buffer_limit=self.config.get("rx_buffer_limit", GRBL_RX_BUFFER_SIZE),
+            update_interval=self.update_interval,
+            batch_writes=self.config.get("batch_writes", True),
+        )
+        self._acks = threading.local()  # per-thread ack Future of the last _send_line
+        self.send_manager_stop = self.engine.stop_event
 
         # G-code variables
+        self.program = None      # GcodeProgram: parsed once on load, shared by sender/visualizer/auto-level
+        self.estimate = None     # TimeEstimate of self.program (ETA and time-based progress)
+        self._load_thread = None # background loader (memory-mapped index + parse)
         self.gcode_lines = []
         self.gcode_path = None
         self.total_lines = 0
-        self.current_line_index = 0
         
         self.jog_distance = tk.DoubleVar(value=1.0)
         self.feedrate_entry_var = tk.StringVar(value="1000")
         self.send_rate = tk.DoubleVar(value=DEFAULT_SEND_RATE)
         self.simulate_mode = tk.BooleanVar(value=True)
         self.sim_speed = tk.DoubleVar(value=1.0)
+        # Worker threads read the engine's plain copies, never the tk variables
+        self.engine.simulate = True
+        self.simulate_mode.trace_add("write", lambda *args: setattr(self.engine, "simulate", bool(self.simulate_mode.get())))
+        self.sim_speed.trace_add("write", lambda *args: setattr(self.engine, "sim_speed", float(self.sim_speed.get())))
+        self.stream_mode = tk.StringVar(value=self.config.get("stream_mode", STREAM_MODE_LINES))
+        self.rx_buffer_limit = tk.IntVar(value=self.config.get("rx_buffer_limit", GRBL_RX_BUFFER_SIZE))
+        self.compact_gcode = tk.BooleanVar(value=self.config.get("compact_gcode", False))
+        self.compact_resolution = tk.DoubleVar(value=self.config.get("compact_resolution", 0.001))
+        self.decimate_gcode = tk.BooleanVar(value=self.config.get("decimate_gcode", False))
+        self.decimate_tolerance = tk.DoubleVar(value=self.config.get("decimate_tolerance", 0.005))
+        self.preflight_check = tk.BooleanVar(value=self.config.get("preflight_check", True))
 
         # Visualization
         self.vis_x, self.vis_y, self.vis_z = [], [], []
 
         # Status
         self.status_var = tk.StringVar(value="Idle")
-        self._polling_paused = threading.Event()
+        self._polling_paused = self.engine.polling_paused
 
         # Auto-level data structures
         self.al_xs = []
@@ -101,18 +145,18 @@ class CNCSenderApp:
         self.wco_b = 0.0
 
         
-        # Status polling
-        self._last_status_request = 0
-        self._status_poll_interval = 0.1  # seconds
-
         # Build UI
         self._build_ui()
+        self._subscribe_engine()
+        self.root.after(LOG_FLUSH_MS, self._flush_log)
+        self._stats_win = None
+        self._diag_win = None
+        self.engine.timers.enabled = bool(self.config.get("profile_stages", False))
+        self.engine.telemetry.directory = self.config.get("telemetry_dir", "") or None
+        self.root.after(STATS_REFRESH_MS, self._refresh_stream_stats)
 
         # Start background threads
-        self.poll_thread = threading.Thread(target=self._position_poll_loop, daemon=True)
-        self.poll_thread.start()
-        self.response_handler_thread = threading.Thread(target=self._response_handler_loop, daemon=True)
-        self.response_handler_thread.start()
+        self.engine.start_polling()
         
             
 # Logo in cmd and seperate window--------------------------------------------------
@@ -270,6 +314,23 @@ class CNCSenderApp:
         ttk.Checkbutton(r, text="Simulation Mode /", variable=self.simulate_mode).grid(row=1, column=0, sticky='e')
         ttk.Label(r, text="Sim Speed:").grid(row=1, column=1, sticky='w')
         ttk.Scale(r, from_=0.1, to=5.0, variable=self.sim_speed, orient='horizontal', length=160).grid(row=1, column=1, sticky='e')
+
+        # Streaming protocol: line count (16 lines) or GRBL character counting (RX bytes)
+        ttk.Label(r, text="Streaming:").grid(row=1, column=2, sticky='e')
+        ttk.Combobox(r, values=[STREAM_MODE_LINES, STREAM_MODE_CHARS], textvariable=self.stream_mode,
+                     state='readonly', width=16).grid(row=1, column=3, padx=4, sticky='w')
+        ttk.Label(r, text="RX Buffer:").grid(row=1, column=3, sticky='e')
+        ttk.Entry(r, textvariable=self.rx_buffer_limit, width=6).grid(row=1, column=4, padx=4, sticky='w')
+
+        # Byte reduction before streaming: comments/spaces, modal repeats, rounding (mm)
+        ttk.Checkbutton(r, text="Compact", variable=self.compact_gcode).grid(row=1, column=5, sticky='w')
+        ttk.Entry(r, textvariable=self.compact_resolution, width=6).grid(row=1, column=6, padx=4, sticky='w')
+        # Merge nearly collinear G1 runs on load, chord tolerance in mm
+        ttk.Checkbutton(r, text="Simplify", variable=self.decimate_gcode).grid(row=2, column=5, sticky='w')
+        ttk.Entry(r, textvariable=self.decimate_tolerance, width=6).grid(row=2, column=6, padx=4, sticky='w')
+        # Pre-flight check on Play: machine travel ($130-$132) at the current work offset, and the stock box
+        ttk.Checkbutton(r, text="Check bounds before Play", variable=self.preflight_check).grid(row=2, column=0, sticky='w')
+        ttk.Button(r, text="Stock Box...", command=self.set_stock_box).grid(row=2, column=1, sticky='w')
         
         style = ttk.Style()
         style.configure("green.TButton", foreground="green")       
@@ -281,7 +342,9 @@ class CNCSenderApp:
         
         style = ttk.Style()
         style.configure("Red.TButton", foreground="red")
-        ttk.Button(r,text="E Stop/Sft Rst",style="Red.TButton",command=lambda: self.send_realtime(b"\x18")).grid(row=4, column=0, sticky="e")
+        ttk.Button(r,text="E Stop/Sft Rst",style="Red.TButton",command=lambda: self.send_realtime(RT_SOFT_RESET)).grid(row=4, column=0, sticky="e")
+        # Restart part way through (broken bit, power loss): modal state is rebuilt from the file
+        ttk.Button(r, text="Start at Line...", command=self.start_at_line).grid(row=4, column=5, padx=6, sticky='w')
             
             
             
@@ -290,16 +353,16 @@ class CNCSenderApp:
 
         
         #ttk.Button(f, text="Blank",).grid(row=1, column=4, padx=6,sticky='w')
-        ttk.Button(r, text="Feed Hold !", command=lambda: self._send_line("!")).grid(row=4, column=4, padx=6,sticky='w')
-        ttk.Button(r, text="Cycle Start ~", command=lambda: self._send_line("~")).grid(row=4, column=4, padx=6, sticky='e')
+        ttk.Button(r, text="Feed Hold !", command=lambda: self.engine.send_realtime(RT_FEED_HOLD)).grid(row=4, column=4, padx=6,sticky='w')
+        ttk.Button(r, text="Cycle Start ~", command=lambda: self.engine.send_realtime(RT_CYCLE_START)).grid(row=4, column=4, padx=6, sticky='e')
 
         ttk.Label(r, text="Status:").grid(row=4, column=1, sticky='e')
         ttk.Label(r, textvariable=self.status_var, foreground="blue").grid(row=4, column=2, sticky='w')
         
         self.current_label = ttk.Label(r, text="Line: 0 / 0")
         self.current_label.grid(row=4, column=1, sticky='w')
-        # self.eta_label = ttk.Label(r, text="ETA: -")
-        # self.eta_label.grid(row=6, column=3, columnspan=2)
+        self.eta_label = ttk.Label(r, text="ETA: -")
+        self.eta_label.grid(row=6, column=5, columnspan=2, sticky='w')
         
         ttk.Button(r, text="Spindle Run M3", command=lambda: self._send_line("M3")).grid(row=4, column=3, padx=6, sticky= 'w')
         ttk.Button(r, text="Spindle Stop M5", command=lambda: self._send_line("M5")).grid(row=4, column=3, padx=6, sticky= 'e')
@@ -307,6 +370,12 @@ class CNCSenderApp:
         self.progress = ttk.Progressbar(r, orient='horizontal', length=760, mode='determinate')
         self.progress.grid(row=5, column=0, columnspan=7, pady=8, sticky='ew')
 
+        # Live streaming stats (ack latency, throughput, RX buffer occupancy)
+        self.stats_label = ttk.Label(r, text="Ack: - ms   - lines/s   - B/s   RX: -")
+        self.stats_label.grid(row=6, column=0, columnspan=4, sticky='w')
+        ttk.Button(r, text="Stream Stats", command=self.show_stream_stats).grid(row=6, column=4, padx=6, sticky='w')
+        ttk.Button(r, text="Diagnostics", command=self.show_diagnostics).grid(row=6, column=4, padx=6, sticky='e')
+
 
 
         # --- Jog + Visualizer ---
@@ -414,6 +483,7 @@ class CNCSenderApp:
 
         self.canvas = FigureCanvasTkAgg(self.fig, master=vis_frame)
         self.canvas.get_tk_widget().pack(fill='both', expand=True)
+        self.canvas.mpl_connect('draw_event', self._on_toolpath_draw)
         
         # #---------- Draw Legend inside matplotlib------------
         # import matplotlib.lines as mlines
@@ -643,7 +713,7 @@ class CNCSenderApp:
         
         style = ttk.Style()
         style.configure("Red.TButton", foreground="red")
-        ttk.Button(btn_frame,text="E Stop/Sft Rst",style="Red.TButton",command=lambda: self.send_realtime(b"\x18")).pack(pady=5)
+        ttk.Button(btn_frame,text="E Stop/Sft Rst",style="Red.TButton",command=lambda: self.send_realtime(RT_SOFT_RESET)).pack(pady=5)
 
         #ttk.Button(btn_frame, text="Load Macros", width=16, command=self._load_macros).pack(pady=5)
         
@@ -756,7 +826,7 @@ class CNCSenderApp:
         
         style = ttk.Style()
         style.configure("Red.TButton", foreground="red")
-        ttk.Button(ss2,text="E Stop/Sft Rst",style="Red.TButton",command=lambda: self.send_realtime(b"\x18")).grid(row=0, column=2,padx=6)
+        ttk.Button(ss2,text="E Stop/Sft Rst",style="Red.TButton",command=lambda: self.send_realtime(RT_SOFT_RESET)).grid(row=0, column=2,padx=6)
         
         tips_frame = ttk.Frame(frame)
         tips_frame.grid(row=6, column=0, rowspan=4, sticky='nw', padx=6)
@@ -895,7 +965,7 @@ class CNCSenderApp:
                   
         style = ttk.Style()
         style.configure("Red.TButton", foreground="red")
-        ttk.Button(ss_frame,text="E Stop/Sft Rst",style="Red.TButton",command=lambda: self.send_realtime(b"\x18")).grid(row=0, column=1,padx=6, pady=10)
+        ttk.Button(ss_frame,text="E Stop/Sft Rst",style="Red.TButton",command=lambda: self.send_realtime(RT_SOFT_RESET)).grid(row=0, column=1,padx=6, pady=10)
 
 #----------------------Get Current Mpos Function--------------------------------------
     #----------------Get Mpos Function-----------------------------------------------
@@ -948,20 +1018,21 @@ class CNCSenderApp:
         self._log("Probing...")
 
         # Send probe command
+        probe = self.engine.expect(RESP_PROBE, RESP_ALARM, RESP_ERROR)
         self._send_line(f"G38.2 Z{dist2} F{feed2}")
 
-        # --- Wait for PRB result ---
+        # --- Wait for PRB result (up to 5 seconds) ---
         probe_z = None
-        for _ in range(50):  # up to 5 seconds
-            line = self._read_line(timeout=0.1)
-            if line is None:
-                continue
+        try:
+            line = probe.result(timeout=5.0)[1]
+        except FutureTimeout:
+            probe.cancel()
+            line = ""
 
-            # Look for PRB report
-            m = re.search(r"PRB:([-.\d]+),([-.\d]+),([-.\d]+):(\d)", line)
-            if m:
-                probe_z = float(m.group(3))  # Z value
-                break
+        # Look for PRB report
+        m = re.search(r"PRB:([-.\d]+),([-.\d]+),([-.\d]+):(\d)", line)
+        if m:
+            probe_z = float(m.group(3))  # Z value
 
         if probe_z is None:
             self._log("ERROR: No PRB result received!")
@@ -1117,7 +1188,7 @@ class CNCSenderApp:
         # RESUME PROGRAM
         # -----------------------------
         self._log("Resuming program...")
-        self._send_line("~")
+        self.engine.send_realtime(RT_CYCLE_START)
         time.sleep(0.2)
 
         self._update_position_labels()
@@ -1182,22 +1253,12 @@ class CNCSenderApp:
 # ------------------ estop function ----------------------------------------------
     def send_realtime(self, b):
         self._log(f"Estop/Soft Reset (Ctrl-X)")
-        if self.serial_connection and self.serial_connection.is_open:
-            try:
-                self.serial_connection.write(b)
-                self.serial_connection.flush()
-                
-            except Exception as e:
-                print("Realtime send error:", e)
-                
-        self.send_manager_stop.set()
-        self.send_manager_pause.clear()
-        self.status_var.set("Stopped")
-        self.current_line_index = 0
-        self.pending_lines.clear()
+        self.engine.send_realtime(b)
+        self.engine.stop_job(spindle_off=False)
         
             # Re-enable tabs
         self.set_tabs_state('normal')
+        self._ui_progress = None
         try:
             self.progress['value'] = 0
             self.current_label.config(text="Line: 0 / 0")
@@ -1277,6 +1338,27 @@ class CNCSenderApp:
             #----- Sender Tab ------------
             "com_port": "COM1",
             "baud_rate": 115200,
+            "stream_mode": STREAM_MODE_LINES,
+            "rx_buffer_limit": GRBL_RX_BUFFER_SIZE,
+            "batch_writes": True,
+            "profile_stages": False,       # stage timers for the Diagnostics window
+            "telemetry_dir": "",           # record each job's status reports here ("" = off)
+            "resume_safe_z": 5.0,          # mm, work Z to retract to before moving to a resume point
+            "resume_plunge_feed": 0.0,     # mm/min to the resume depth, 0 = the program's feed
+            "resume_spin_up": 2.0,         # s, dwell after restarting the spindle on resume
+            "machine_profile": {},         # $11, $110-$112, $120-$122 last read from the controller
+            "compact_gcode": False,        # compact lines before streaming
+            "compact_resolution": 0.001,   # mm, coordinates are rounded to this
+            "decimate_gcode": False,       # merge nearly collinear G1 runs on load
+            "decimate_tolerance": 0.005,   # mm, max chord deviation
+            "preflight_check": True,       # check travel and stock box before Play
+            "stock_box": [],               # work mm xmin,xmax,ymin,ymax,zmin,zmax for cutting moves ([] = off)
+            "force_set_origin": False,     # firmware built with HOMING_FORCE_SET_ORIGIN ($23 axes travel 0..+)
+            #------ Console ------------
+            "log_file": "pilotx.log",      # full log, "" to disable
+            "console_max_lines": 2000,     # console widget is trimmed to this
+            "log_sent_every": 1,           # show every Nth ">>" sent line, 0 = none
+            "log_ok_every": 1,             # show every Nth "<< ok", 0 = none
             #------ Probe Tab ----------
             # "z_probe_Safe_Z": 10,
             "z_probe_distance": 50,
@@ -1326,6 +1408,15 @@ class CNCSenderApp:
         print("Updating GUI settings...")
         print("Before:", self.config)
         try:
+            #---------- Sender Tab-----------
+            self.config["stream_mode"] = self.stream_mode.get()
+            self.config["rx_buffer_limit"] = int(self.rx_buffer_limit.get())
+            self.config["compact_gcode"] = bool(self.compact_gcode.get())
+            self.config["compact_resolution"] = float(self.compact_resolution.get())
+            self.config["decimate_gcode"] = bool(self.decimate_gcode.get())
+            self.config["decimate_tolerance"] = float(self.decimate_tolerance.get())
+            self.config["preflight_check"] = bool(self.preflight_check.get())
+
             #---------- Probe Tab-----------
             # self.config["z_probe_Safe_Z"] = float(self.z_safe_entry.get())
             self.config["z_probe_distance"] = float(self.z_dist_entry.get())
@@ -1382,56 +1473,301 @@ class CNCSenderApp:
                 
                 
 
-#------------------------Parse GRBL status lines safely Function--------------------------------------
-    def _update_position_from_status(self, status_line):
-        """
-        Parse GRBL status line like:
-        <Idle|MPos:5.000,10.000,0.000|WCO:1.000,2.000,0.000>
-        """
+#------------------------ Engine Event Handlers --------------------------------------
+    def _subscribe_engine(self):
+        """Hook the GUI to the streaming engine. Handlers run on engine threads."""
+        self.engine.on("log", self._log)
+        self.engine.on("response", lambda line: self._log(f"<< {line}"))
+        self.engine.on("status", self._on_engine_status)
+        self.engine.on("line_sent", self._on_line_sent)
+        self.engine.on("progress", self._on_progress)
+        self.engine.on("job", self._on_job_state)
+
+    def _on_engine_status(self, report):
+        self._ui_status_dirty = True
+        self._request_ui_refresh()
+
+    def _on_line_sent(self, index, line):
+        self._ui_line_index = index
+        self._request_ui_refresh()
+
+    def _on_progress(self, index, total):
+        self._ui_progress = (index, total)
+        self._request_ui_refresh()
+
+    def _request_ui_refresh(self):
+        """Schedule one UI tick unless one is already pending. Safe from any thread."""
+        with self._ui_lock:
+            if self._ui_pending:
+                return
+            self._ui_pending = True
         try:
-            # Extract MPos
-            mpos_match = re.search(r"MPos:([-.\d]+),([-.\d]+),([-.\d]+)", status_line)
-            if mpos_match:
-                self.mpos_x = float(mpos_match.group(1))
-                self.mpos_y = float(mpos_match.group(2))
-                self.mpos_z = float(mpos_match.group(3))
-                # self.pos_z = self.Mpos_z
-
-            # Extract WCO (work coordinate offset)
-            wco_match = re.search(r"WCO:([-.\d]+),([-.\d]+),([-.\d]+)", status_line)
-            if wco_match:
-                self.wco_x = float(wco_match.group(1))
-                self.wco_y = float(wco_match.group(2))
-                self.wco_z = float(wco_match.group(3))
-
-            # ---- Compute WPos manually (GRBL may not report WPos) ----
-            if hasattr(self, "wco_x"):
-                self.pos_x = self.mpos_x - self.wco_x
-                self.pos_y = self.mpos_y - self.wco_y
-                self.pos_z = self.mpos_z - self.wco_z
-                
+            self.root.after(UI_REFRESH_MS, self._ui_tick)
+        except Exception:
+            self._ui_pending = False
+
+    def _ui_tick(self):
+        """Apply the latest engine state to the DRO, progress bar and cone (Tk thread)."""
+        timers = self.engine.timers
+        t_tick = timers.start()
+        with self._ui_lock:
+            self._ui_pending = False
+
+        # --- Positions from the latest status report ---
+        if self._ui_status_dirty:
+            self._ui_status_dirty = False
+            e = self.engine
+            self.mpos_x, self.mpos_y, self.mpos_z = e.mpos_x, e.mpos_y, e.mpos_z
+            self.wco_x, self.wco_y, self.wco_z = e.wco_x, e.wco_y, e.wco_z
+            self.wco_a, self.wco_b = e.wco_a, e.wco_b
+            self.pos_x, self.pos_y, self.pos_z = e.pos_x, e.pos_y, e.pos_z
+            self._ui_dro_dirty = True
+
+        # --- Toolpath cone: blitted, so it follows every tick ---
+        index = self._ui_line_index
+        if index is not None and index != self._ui_drawn_index:
+            self._ui_drawn_index = index
+            t = timers.start()
+            self._update_toolpath(line_index=index, redraw=True)
+            timers.stop("ui.toolpath", t)
+
+        # --- Progress ---
+        progress = self._ui_progress
+        if progress is not None:
+            self._ui_progress = None
+            index, total = progress
+            estimate = self.estimate
+            try:
+                if estimate is not None and len(estimate.line_end) == total:
+                    # Time-based: lines vary from microseconds to minutes
+                    self.progress.config(value=estimate.fraction(index - 1) * 100)
+                    self.eta_label.config(text=f"ETA: {format_duration(estimate.remaining(index - 1))} "
+                                               f"of {format_duration(estimate.total)}")
+                else:
+                    self.progress.config(value=(index / total) * 100 if total else 0)
+                self.current_label.config(text=f"Line: {index} / {total}")
+            except Exception:
+                pass
+
+        if self._ui_dro_dirty:
+            self._ui_dro_dirty = False
+            self._refresh_position_labels()
+        timers.stop("ui.tick", t_tick)
+
+    def _on_job_state(self, state):
+        if state == "Idle" and not self.engine.simulate and self.engine.starvation.samples:
+            # Post-job planner starvation report (Bf: samples taken while streaming)
+            self._log(self.engine.starvation.report(self._source_line))
+        if state == "Idle" and isinstance(self.engine.gcode_lines, CompactedLines):
+            self._log(self.engine.gcode_lines.summary())
+        def update():
+            self.status_var.set(state)
+            if state in ("Idle", "Stopped"):
+                # Re-enable tabs
+                self.set_tabs_state('normal')
+        try:
+            self.root.after(0, update)
+        except Exception:
+            pass
+
+    def _source_line(self, index):
+        """Source file line number of program line index (for reports)."""
+        program = self.program
+        if program is not None and 0 <= index < len(program):
+            return str(int(program.records["src"][index]))
+        return str(index)
+
+    #------------------------ Stream Stats --------------------------------------
+    def _refresh_stream_stats(self):
+        """Update the stats line (and the histogram window) while a job is streaming."""
+        try:
+            e = self.engine
+            if e.send_thread and e.send_thread.is_alive() and not e.simulate:
+                snap = e.metrics.snapshot()
+                with e.pending_cond:
+                    occupancy, in_flight = e.pending_chars, len(e.pending_lines)
+                self.stats_label.config(
+                    text=f"Ack p50/p95/max: {snap['p50']:.1f}/{snap['p95']:.1f}/{snap['max']:.1f} ms   "
+                         f"{snap['lines_per_s']:.0f} lines/s   {snap['bytes_per_s']:.0f} B/s   "
+                         f"RX: {occupancy}/{e.rx_buffer_limit} B, {in_flight} lines"
+                )
+                if self._stats_win is not None:
+                    self._draw_stream_stats()
+        except Exception:
+            pass
+        finally:
+            self.root.after(STATS_REFRESH_MS, self._refresh_stream_stats)
+
+    def show_stream_stats(self):
+        """Ack latency histogram and summary of the current/last job, with export."""
+        if self._stats_win is not None:
+            self._stats_win.lift()
+            self._draw_stream_stats()
+            return
+
+        win = tk.Toplevel(self.root)
+        win.title("Stream Stats")
+        fig = Figure(figsize=(7, 3.5), dpi=100)
+        ax = fig.add_subplot(111)
+        canvas = FigureCanvasTkAgg(fig, master=win)
+        canvas.get_tk_widget().pack(fill='both', expand=True)
+        summary = ttk.Label(win, text="", justify='left')
+        summary.pack(fill='x', padx=8, pady=4)
+        ttk.Button(win, text="Export JSON / CSV", command=self.export_stream_stats).pack(pady=(0, 8))
+
+        def close():
+            self._stats_win = None
+            win.destroy()
+        win.protocol("WM_DELETE_WINDOW", close)
+
+        self._stats_win = win
+        self._stats_ax = ax
+        self._stats_canvas = canvas
+        self._stats_summary = summary
+        self._draw_stream_stats()
+
+    def _draw_stream_stats(self):
+        m = self.engine.metrics
+        counts, edges = m.histogram()
+        labels = [f"{lo:g}" for lo in edges[:-1]]
+
+        ax = self._stats_ax
+        ax.cla()
+        ax.bar(range(len(counts)), counts, color='blue')
+        ax.set_xticks(range(len(counts)))
+        ax.set_xticklabels(labels, rotation=60, fontsize=7)
+        ax.set_xlabel("Ack latency (ms, bin start)")
+        ax.set_ylabel("Lines")
+        ax.set_title("Send -> ok latency")
+        self._stats_canvas.figure.tight_layout()
+        self._stats_canvas.draw_idle()
+
+        total = int(counts.sum())
+        text = f"Lines acknowledged: {total}"
+        running = self.engine.send_thread and self.engine.send_thread.is_alive()
+        if total and not running:  # full percentiles once the job is over
+            info = m.summary()
+            text += (f"   Mean {info['latency_ms_mean']:.1f} ms   p50 {info['latency_ms_p50']:.1f}"
+                     f"   p95 {info['latency_ms_p95']:.1f}   p99 {info['latency_ms_p99']:.1f}"
+                     f"   max {info['latency_ms_max']:.1f} ms\n"
+                     f"{info['lines_per_s']:.0f} lines/s   {info['bytes_per_s']:.0f} B/s"
+                     f"   mean RX occupancy {info['mean_occupancy']:.0f} B")
+        if not running and self.engine.starvation.samples:
+            text += "\n" + self.engine.starvation.report(self._source_line)
+        self._stats_summary.config(text=text)
+
+    def export_stream_stats(self):
+        path = filedialog.asksaveasfilename(
+            defaultextension=".json",
+            filetypes=[("JSON", "*.json"), ("CSV (per line)", "*.csv"), ("All files", "*.*")])
+        if not path:
+            return
+        try:
+            self.engine.metrics.export(path, extra={
+                "file": self.gcode_path,
+                "stream_mode": self.engine.stream_mode,
+                "rx_buffer_limit": self.engine.rx_buffer_limit,
+                "starvation": self.engine.starvation.summary(),
+            })
+            self._log(f"Stream stats saved: {path}")
+        except Exception as e:
+            messagebox.showerror("Export failed", str(e))
 
-            # ---- Probe result (PRB) ----
-            prb_match = re.search(r"PRB:([-.\d]+),([-.\d]+),([-.\d]+),[-.\d]+:(\d)", status_line)
-            if prb_match:
-                self.prb_x = float(prb_match.group(1))
-                self.prb_y = float(prb_match.group(2))
-                self.prb_z = float(prb_match.group(3))
-                self.prb_ok = int(prb_match.group(4))
+    #------------------------ Diagnostics (stage timers) ------------------------------
+    def show_diagnostics(self):
+        """Live per-stage timings of the send loop, reader, UI and auto-level, with export."""
+        if self._diag_win is not None:
+            self._diag_win.lift()
+            return
 
+        win = tk.Toplevel(self.root)
+        win.title("Diagnostics")
+        timers = self.engine.timers
+        enabled = tk.BooleanVar(value=timers.enabled)
 
-            # Update GUI labels
-            self.root.after(0, self._update_position_labels)
+        def toggle():
+            timers.enabled = enabled.get()
+            self.config["profile_stages"] = timers.enabled
+            self.save_settings()
 
-            # print(
-                # f"MPos: X={self.mpos_x:.3f}, Y={self.mpos_y:.3f}, Z={self.mpos_z:.3f} | "
-                # f"WPos: X={self.pos_x:.3f}, Y={self.pos_y:.3f}, Z={self.pos_z:.3f}"
-            # )
+        bar = ttk.Frame(win)
+        bar.pack(fill='x', padx=8, pady=4)
+        ttk.Checkbutton(bar, text="Stage timers on", variable=enabled, command=toggle).pack(side='left')
+        ttk.Button(bar, text="Reset", command=timers.reset).pack(side='left', padx=6)
+        ttk.Button(bar, text="Save JSON", command=lambda: self.export_diagnostics(False)).pack(side='left')
+        ttk.Button(bar, text="Save Chrome Trace", command=lambda: self.export_diagnostics(True)).pack(side='left', padx=6)
+
+        # Job telemetry: every status report of a job saved as a compressed .npz
+        telemetry = self.engine.telemetry
+        record = tk.BooleanVar(value=bool(telemetry.directory))
+        folder = tk.StringVar(value=self.config.get("telemetry_dir", ""))
+
+        def set_telemetry():
+            if record.get() and not folder.get():
+                path = filedialog.askdirectory(title="Telemetry folder")
+                if not path:
+                    record.set(False)
+                    return
+                folder.set(path)
+            telemetry.directory = folder.get() if record.get() else None
+            self.config["telemetry_dir"] = telemetry.directory or ""
+            self.save_settings()
 
+        def browse():
+            path = filedialog.askdirectory(title="Telemetry folder")
+            if path:
+                folder.set(path)
+                set_telemetry()
+
+        row = ttk.Frame(win)
+        row.pack(fill='x', padx=8, pady=(0, 4))
+        ttk.Checkbutton(row, text="Record job telemetry to", variable=record, command=set_telemetry).pack(side='left')
+        ttk.Entry(row, textvariable=folder, width=40, state='readonly').pack(side='left', padx=4, fill='x', expand=True)
+        ttk.Button(row, text="Browse", command=browse).pack(side='left')
+
+        columns = ("count", "total", "mean", "max")
+        tree = ttk.Treeview(win, columns=columns, height=14)
+        tree.heading("#0", text="Stage")
+        for col, title in zip(columns, ("Count", "Total ms", "Mean us", "Max ms")):
+            tree.heading(col, text=title)
+            tree.column(col, width=90, anchor='e')
+        tree.pack(fill='both', expand=True, padx=8, pady=(0, 8))
+
+        def close():
+            self._diag_win = None
+            win.destroy()
+        win.protocol("WM_DELETE_WINDOW", close)
+
+        self._diag_win = win
+        self._diag_tree = tree
+        self._refresh_diagnostics()
+
+    def _refresh_diagnostics(self):
+        if self._diag_win is None:
+            return
+        try:
+            tree = self._diag_tree
+            tree.delete(*tree.get_children())
+            for name, s in self.engine.timers.summary().items():
+                tree.insert("", "end", text=name, values=(s["count"], f"{s['total_ms']:.1f}",
+                                                          f"{s['mean_us']:.1f}", f"{s['max_ms']:.2f}"))
+        except Exception:
+            pass
+        self.root.after(STATS_REFRESH_MS, self._refresh_diagnostics)
+
+    def export_diagnostics(self, trace=False):
+        path = filedialog.asksaveasfilename(
+            defaultextension=".json",
+            initialfile="pilotx_trace.json" if trace else "pilotx_stages.json",
+            filetypes=[("JSON", "*.json"), ("All files", "*.*")])
+        if not path:
+            return
+        try:
+            self.engine.timers.export(path, trace=trace)
+            self._log(f"Diagnostics saved: {path}")
         except Exception as e:
-            self._log(f"Error parsing position: {e}")
-                  
-                
+            messagebox.showerror("Export failed", str(e))
+
     #-------------------------Macro Functions-----------------------------------------------------
     #---------------- Macro Data Persistence ----------------
     def _load_macros(self):
@@ -1854,9 +2190,8 @@ class CNCSenderApp:
                 self._send_line(line)
                 self._wait_for_ok(1.0)
 
-        # Request a fresh GRBL status to update DRO
-        self._send_line("?")
-        self._wait_for_ok(0.2)
+        # Request a fresh GRBL status to update DRO (realtime, no ok to wait for)
+        self.engine.send_realtime(RT_STATUS)
 
 
 
@@ -1940,18 +2275,29 @@ class CNCSenderApp:
         return [p.device for p in serial.tools.list_ports.comports()]
 
     def _log(self, text, widget=None):
-        if widget is None:
-            widget = self.console
-        def append():
-            try:
-                widget.insert(tk.END, text + "\n")
-                widget.see(tk.END)
-            except Exception:
-                pass
+        """Queue a console message; safe from any thread. Shown on the next _flush_log."""
+        self.log_pipeline.put(text, widget)
+
+    def _flush_log(self):
+        """Insert queued messages into their consoles in one batch each and trim them."""
         try:
-            self.root.after(0, append)
-        except Exception:
-            append()
+            batches = {}
+            for widget, text in self.log_pipeline.drain():
+                batches.setdefault(widget or self.console, []).append(text)
+
+            max_lines = self.log_pipeline.max_lines
+            for widget, texts in batches.items():
+                try:
+                    widget.insert(tk.END, "\n".join(texts) + "\n")
+                    if max_lines:
+                        excess = int(widget.index("end-1c").split(".")[0]) - 1 - max_lines
+                        if excess > 0:
+                            widget.delete("1.0", f"{excess + 1}.0")
+                    widget.see(tk.END)
+                except Exception:
+                    pass
+        finally:
+            self.root.after(LOG_FLUSH_MS, self._flush_log)
 
     # ------------------------- Serial Functions -------------------------
     def connect_serial(self):
@@ -1965,35 +2311,23 @@ class CNCSenderApp:
             baud = 115200
             self.baud_cb.set("115200")
         try:
-            self.serial_connection = serial.Serial(port, baud, timeout=0.5)
-            self.serial_connection.dtr = False
-            self.serial_connection.rts = False
-            time.sleep(0.05)
-            self.serial_connection.dtr = True
-            self.serial_connection.rts = True
-            time.sleep(2.0)
-            try:
-                self.serial_connection.reset_input_buffer()
-            except Exception:
-                pass
+            self.engine.connect(port, baud)
         except Exception as e:
             messagebox.showerror("Connection failed", str(e))
             return
-        self.is_connected = True
-        self._log(f"Connected to {port} @ {baud}")
-        if self.reader_thread is None or not self.reader_thread.is_alive():
-            self.reader_thread = threading.Thread(target=self._serial_reader_loop, daemon=True)
-            self.reader_thread.start()
+        # Motion settings for the run time estimate
+        threading.Thread(target=self._read_machine_profile, daemon=True).start()
 
     def disconnect_serial(self):
-        self.is_connected = False
-        if self.serial_connection:
-            try:
-                self.serial_connection.close()
-            except Exception:
-                pass
-            self.serial_connection = None
-        self._log("Serial disconnected")
+        self.engine.disconnect()
+
+    @property
+    def is_connected(self):
+        return self.engine.is_connected
+
+    @property
+    def serial_connection(self):
+        return self.engine.serial_connection
 
     def unlock_machine(self):
         if self.is_connected:
@@ -2007,23 +2341,20 @@ class CNCSenderApp:
     #----------------DRO Thread-safe function to update labels-------------------------------------
     #----------------------Position Updates New-----------------------------------------
     def _update_position_labels(self):
-        """Update DRO labels for both WPos and MPos in a thread-safe way."""
-        def update():
-            try:
-                self.readout_x.config(text=f"W: X: {self.pos_x:.3f}")
-                self.readout_y.config(text=f"W: Y: {self.pos_y:.3f}")
-                self.readout_z.config(text=f"W: Z: {self.pos_z:.3f}")
+        """Mark the DRO dirty; the next UI tick redraws it (thread-safe, coalesced)."""
+        self._ui_dro_dirty = True
+        self._request_ui_refresh()
 
-                self.readout_mx.config(text=f"M: X: {self.mpos_x:.3f}")
-                self.readout_my.config(text=f"M: Y: {self.mpos_y:.3f}")
-                self.readout_mz.config(text=f"M: Z: {self.mpos_z:.3f}")
-            except Exception:
-                pass
-
-        # Schedule the update on the main Tkinter thread
+    def _refresh_position_labels(self):
+        """Write WPos and MPos into the DRO labels. Tk thread only."""
         try:
-            if hasattr(self, "root"):  # replace with your Tk root variable
-                self.root.after(0, update)
+            self.readout_x.config(text=f"W: X: {self.pos_x:.3f}")
+            self.readout_y.config(text=f"W: Y: {self.pos_y:.3f}")
+            self.readout_z.config(text=f"W: Z: {self.pos_z:.3f}")
+
+            self.readout_mx.config(text=f"M: X: {self.mpos_x:.3f}")
+            self.readout_my.config(text=f"M: Y: {self.mpos_y:.3f}")
+            self.readout_mz.config(text=f"M: Z: {self.mpos_z:.3f}")
         except Exception:
             pass
 
@@ -2048,9 +2379,61 @@ class CNCSenderApp:
         path = filedialog.askopenfilename(filetypes=[("G-code files","*.gcode *.nc *.tap"),("All files","*.*")])
         if not path:
             return
-        with open(path, "r", encoding='utf-8', errors='ignore') as f:
-            # remove empty lines and comments
-            self.gcode_lines = [line.rstrip() for line in f if line.strip() and not line.strip().startswith(';')]
+        if self._load_thread and self._load_thread.is_alive():
+            messagebox.showinfo("Loading", "A G-code file is still loading.")
+            return
+        if self.engine.send_thread and self.engine.send_thread.is_alive():
+            messagebox.showwarning("Busy", "Stop the running job before loading another file.")
+            return
+
+        self.status_var.set("Loading...")
+        self.progress['value'] = 0
+
+        def report(stage, done, total):
+            # called from the loader thread
+            pct = (done / total) * 100 if total else 100
+            try:
+                self.root.after(0, lambda: (self.progress.config(value=pct),
+                                            self.current_label.config(text=f"{stage}: {pct:.0f}%")))
+            except Exception:
+                pass
+
+        tolerance = 0.0
+        if self.decimate_gcode.get():
+            try:
+                tolerance = float(self.decimate_tolerance.get())
+            except Exception:
+                tolerance = 0.005
+
+        def worker():
+            try:
+                # memory-mapped: empty lines and comments skipped, G90 injected, parsed once
+                program = load_gcode_program(path, progress=report)
+                if tolerance > 0:
+                    report("Simplifying", 0, 1)
+                    program, result = decimate_program(program, tolerance)
+                    self._log(result.summary())
+            except Exception as e:
+                msg = str(e)
+                self.root.after(0, lambda: (self.status_var.set("Idle"),
+                                            messagebox.showerror("Load failed", msg)))
+                return
+            self.root.after(0, lambda: self._on_gcode_loaded(path, program))
+
+        # Index + parse off the Tk main loop so the GUI stays responsive on huge files
+        self._load_thread = threading.Thread(target=worker, daemon=True)
+        self._load_thread.start()
+
+
+    def _on_gcode_loaded(self, path, program):
+        """Main-thread half of load_gcode_file, runs once the loader thread is done."""
+        self.program = program
+        self.gcode_lines = program.lines
+        self._set_estimate(None)
+        self._estimate_in_background(program, self.config.get("machine_profile"))
+        self.status_var.set("Idle")
+        self.progress['value'] = 0
+        self.current_label.config(text=f"Line: 0 / {len(program)}")
             
                     #---------- Draw Legend inside matplotlib------------
         import matplotlib.lines as mlines
@@ -2080,49 +2463,65 @@ class CNCSenderApp:
         self.canvas.draw_idle()
         self.canvas.flush_events()
 
-        # Inject G90 at the start
-        self.gcode_lines.insert(0, "G90")
-
         self.gcode_path = path
         self.total_lines = len(self.gcode_lines)
-        self.current_line_index = 0
+        self.engine.load_program(self.gcode_lines)
 
         # >>> draw gcode on load <<<
-        self._update_toolpath(gcode_lines=self.gcode_lines, redraw=True)
+        self._update_toolpath(program=self.program, redraw=True)
         self._log(f"Loaded {self.total_lines} lines from {path}")
         
-        # After full toolpath draw, draw cone
-        for line in self.gcode_lines:
-            if any(a in line.upper() for a in ("X", "Y", "Z")):
-                self._update_toolpath(gcode_line=line, redraw=True)
-                break        
+        # After full toolpath draw, draw cone at the first move
+        moves = self.program.moves()
+        if len(moves):
+            self._update_toolpath(line_index=int(moves[0]), redraw=True)
         
         
 
 
-    def _send_line(self, line):
-        if self.simulate_mode.get():
-            # Only log simulation commands that are not "?"
-            if line != "?":
-                self._log(f"[SIM] {line}")
-            return
-
-        if self.is_connected and self.serial_connection:
+    #------------------------ Run Time Estimate ------------------------------
+    def _estimate_in_background(self, program, profile):
+        """Estimate the run time on a worker thread; the result only applies if the program is still loaded."""
+        def worker():
             try:
-                with self.serial_lock:
-                    self.serial_connection.write((line + "\n").encode('ascii', errors='ignore'))
-                    self.serial_connection.flush()
-                    # track pending lines for buffer management
-                    self.pending_lines.append(line)
-                    # Only log actual commands that are not "?"
-                    if line != "?":
-                        self._log(f">> {line}")
+                estimate = estimate_program(program, profile)
             except Exception as e:
-                self._log(f"Serial write error: {e}")
+                self._log(f"Run time estimate failed: {e}")
+                return
+            self.root.after(0, lambda: self._set_estimate(estimate) if self.program is program else None)
+        threading.Thread(target=worker, name="estimate", daemon=True).start()
+
+    def _set_estimate(self, estimate):
+        self.estimate = estimate
+        if estimate is None:
+            self.eta_label.config(text="ETA: -")
+            return
+        self.eta_label.config(text=f"Est: {format_duration(estimate.total)}")
+        self._log(estimate.summary())
+
+    def _read_machine_profile(self):
+        """Read $$ after connecting, keep the motion settings as the saved profile and re-estimate."""
+        try:
+            settings = self.engine.read_settings()
+        except Exception as e:
+            self._log(f"Could not read $$: {e}")
+            return
+        profile = {f"${k}": v for k, v in normalize_profile(settings).items()}
+        if not settings or profile == self.config.get("machine_profile"):
+            return
+        self.config["machine_profile"] = profile
+        self.save_settings()
+        if self.program is not None:
+            self._estimate_in_background(self.program, profile)
+
+    def _send_line(self, line):
+        # remembered per thread for the _wait_for_ok that usually follows
+        self._acks.last = self.engine.send_line(line)
+        return self._acks.last
 
 
     # ------------------------- Pipeline Send Optimized for GRBL 1.2h -------------------------
-    def start_pipeline_send(self):
+    def start_pipeline_send(self, start=0, preamble=None):
             # Disable tabs while sending
         self.set_tabs_state('disabled')
         
@@ -2133,48 +2532,121 @@ class CNCSenderApp:
             return
 
         # Draw the full toolpath on load if not already drawn
-        self._update_toolpath(gcode_lines=self.gcode_lines, redraw=True)
+        self._update_toolpath(program=self.program, redraw=True)
+        self._ui_drawn_index = -1
+
+        # Streaming protocol from the Run frame
+        self.engine.stream_mode = self.stream_mode.get()
+        try:
+            self.engine.rx_buffer_limit = int(self.rx_buffer_limit.get())
+        except Exception:
+            self.engine.rx_buffer_limit = GRBL_RX_BUFFER_SIZE
+
+        # A new job streams the loaded lines, compacted if enabled (a resume keeps its program)
+        if not (self.engine.send_thread and self.engine.send_thread.is_alive()):
+            lines = self.gcode_lines
+            if self.compact_gcode.get():
+                try:
+                    resolution = float(self.compact_resolution.get())
+                except Exception:
+                    resolution = 0.001
+                if resolution > 0:
+                    lines = CompactedLines(lines, resolution)
+            if self.preflight_check.get() and not self._preflight_ok(start, preamble):
+                self.set_tabs_state('normal')
+                return
+            name = os.path.splitext(os.path.basename(self.gcode_path or "job"))[0]
+            self.engine.load_program(lines, name)
 
-        # Resume existing thread if paused
-        if self.send_manager_thread and self.send_manager_thread.is_alive():
-            self.send_manager_pause.clear()
-            self.send_manager_stop.clear()
-            self.status_var.set("Resuming...")
+        # Starts a new job (at line start after the preamble), or resumes the running one if paused
+        self.engine.start_job(start, preamble)
+
+    def _preflight_ok(self, start=0, preamble=None):
+        """
+        Check the loaded program (from line start, with the resume preamble) against
+        the travel and stock box, ask before sending anything outside.
+        """
+        if self.program is None:
+            return True
+        report = self.engine.check_envelope(self.program, self.config.get("stock_box") or None,
+                                            bool(self.config.get("force_set_origin", False)), start, preamble)
+        self._log(report.summary(limit=5))
+        if report.ok:
+            return True
+        return messagebox.askyesno("Out of Bounds", report.summary(limit=15) + "\n\nSend anyway?", icon='warning')
+
+    def set_stock_box(self):
+        """Ask for the stock box (work mm) that cutting moves must stay inside; blank turns it off."""
+        box = self.config.get("stock_box") or []
+        text = simpledialog.askstring(
+            "Stock Box", "Xmin, Xmax, Ymin, Ymax, Zmin, Zmax in work mm (blank = off):",
+            initialvalue=", ".join(f"{v:g}" for v in box), parent=self.root)
+        if text is None:
             return
+        try:
+            box = [float(v) for v in text.replace(" ", "").split(",")] if text.strip() else []
+        except ValueError:
+            box = None
+        if box is None or len(box) not in (0, 6) or (box and (box[0] > box[1] or box[2] > box[3] or box[4] > box[5])):
+            messagebox.showwarning("Stock Box", "Enter six numbers: Xmin, Xmax, Ymin, Ymax, Zmin, Zmax.")
+            return
+        self.config["stock_box"] = box
+        self.save_settings()
+        self._log("Stock box: " + (", ".join(f"{v:g}" for v in box) if box else "off"))
 
-        # Start a new sending thread
-        self.send_manager_stop.clear()
-        self.send_manager_pause.clear()
-        self.send_manager_thread = threading.Thread(
-            target=self._pipeline_send_loop_grbl12h, daemon=True
-        )
-        self.send_manager_thread.start()
-        self.status_var.set("Running...")
+    def start_at_line(self):
+        """Ask for a file line, show the preamble that restores the modal state there, and stream from it."""
+        program = self.program
+        if program is None or not len(program):
+            messagebox.showwarning("No G-code", "Load a G-code file first.")
+            return
+        if self.engine.send_thread and self.engine.send_thread.is_alive():
+            messagebox.showwarning("Busy", "Stop the running job first.")
+            return
 
+        # Suggest the oldest line that may not have been cut when the last job stopped
+        hint = self.engine.resume_index()
+        suggested = int(program.records["src"][hint]) if 0 < hint < len(program) else 1
+        line = simpledialog.askinteger("Start at Line", "Resume from line of the file:",
+                                       initialvalue=suggested, minvalue=1, parent=self.root)
+        if line is None:
+            return
+        index = program.index_of_line(line)
+        if index >= len(program):
+            messagebox.showwarning("Start at Line", f"Line {line} is past the end of the program.")
+            return
 
-    def pause_pipeline_send(self):
-        self.send_manager_pause.set()
-        self.status_var.set("Paused")
+        state = resume_state(program, index)
+        preamble = resume_preamble(state,
+                                   safe_z=float(self.config.get("resume_safe_z", 5.0)),
+                                   plunge_feed=float(self.config.get("resume_plunge_feed", 0.0)) or None,
+                                   spin_up=float(self.config.get("resume_spin_up", 2.0)),
+                                   line=program.lines[index])
+        unknown = state.unknown_axes()
+        warning = (f"\n\n{unknown} position unknown here (only G91 moves before this line): "
+                   f"{unknown} stays where the machine is now." if unknown else "")
+        if not messagebox.askokcancel(
+                "Start at Line",
+                f"Resume at line {line}: {program.lines[index].strip()}\n\n"
+                "The machine will run:\n" + "\n".join(preamble) + warning +
+                "\n\nCheck the tool and work offset first.",
+                icon='warning' if unknown else 'question'):
+            return
+        self._log(f"Resume at line {line}: " + " | ".join(preamble))
+        self.start_pipeline_send(state.start, preamble)
 
 
-    def stop_pipeline_send(self):
-        self.send_manager_stop.set()
-        self.send_manager_pause.clear()
-        self.status_var.set("Stopped")
+    def pause_pipeline_send(self):
+        self.engine.pause_job()
 
-        # --- Stop spindle ---
-        if self.serial_connection and self.serial_connection.is_open:
-            try:
-                self.serial_connection.write(b"M5\n")
-                self.serial_connection.flush()
-            except Exception as e:
-                print("Failed to send M5:", e)
 
-        self.current_line_index = 0
-        self.pending_lines.clear()
+    def stop_pipeline_send(self):
+        # Stops streaming and sends M5 to stop the spindle
+        self.engine.stop_job()
             # Re-enable tabs
         self.set_tabs_state('normal')
 
+        self._ui_progress = None
         try:
             self.progress['value'] = 0
             self.current_label.config(text="Line: 0 / 0")
@@ -2183,101 +2655,53 @@ class CNCSenderApp:
 
 
 
-    def _pipeline_send_loop_grbl12h(self):
-        update_interval = self.update_interval # ----------- Simulation Update Interval---------------------
-        sim_yield = 0.002
-
-        while self.current_line_index < self.total_lines:
-
-            # --- Check STOP instantly ---
-            if self.send_manager_stop.is_set():
-                break
-
-            # --- Handle Pause ---
-            while self.send_manager_pause.is_set():
-                if self.send_manager_stop.is_set():
-                    break
-                time.sleep(0.01)
-            if self.send_manager_stop.is_set():
-                break
-
-            # --- GRBL Buffer wait (interruptible) ---
-            while (
-                not self.simulate_mode.get()
-                and len(self.pending_lines) >= GRBL_BUFFER_MAX
-            ):
-                if self.send_manager_stop.is_set():
-                    break
-                time.sleep(0.001)
-            if self.send_manager_stop.is_set():
-                break
-
-            # --- Get line ---
-            line = self.gcode_lines[self.current_line_index]
-
-            # --- Send to machine ---
-            if not self.simulate_mode.get():
-                self._send_line(line)
-
-            # --- Update toolpath (throttled) ---
-            redraw_now = (
-                (self.current_line_index % update_interval == 0)
-                or (self.current_line_index == self.total_lines - 1)
-            )
-            self._update_toolpath(gcode_line=line, redraw=redraw_now)
-
-            self.current_line_index += 1
-
-            # --- Safe GUI update ---
-            if (
-                self.current_line_index % update_interval == 0
-                or self.current_line_index == self.total_lines
-            ):
-                try:
-                    progress_val = (self.current_line_index / self.total_lines) * 100
-                    self.progress.after(
-                        0,
-                        lambda v=progress_val: self.progress.config(value=v)
-                    )
-                    self.current_label.after(
-                        0,
-                        lambda i=self.current_line_index: self.current_label.config(
-                            text=f"Line: {i} / {self.total_lines}"
-                        )
-                    )
-                except Exception:
-                    pass
-
-            # --- Simulation mode sleep (interruptible) ---
-            if self.simulate_mode.get():
-                scaled = sim_yield / max(0.01, self.sim_speed.get())
-                # break sleep into tiny slices so stop is instant
-                end_time = time.time() + scaled
-                while time.time() < end_time:
-                    if self.send_manager_stop.is_set():
-                        break
-                    time.sleep(0.001)
-                if self.send_manager_stop.is_set():
-                    break
-
-        # Finish
-        self.status_var.set("Idle")
-        
-            # Re-enable tabs
-        self.set_tabs_state('normal')
-
-
-
     # ------------------------- Visualization -------------------------
-    def _update_toolpath(self, gcode_line=None, gcode_lines=None, redraw=True):
+    def _on_toolpath_draw(self, event):
+        """After every full draw (load, rotate, zoom, resize): save the background and put the cone back on it."""
+        self._toolpath_bg = self.canvas.copy_from_bbox(self.fig.bbox)
+        if self._tool_marker is not None and self._tool_marker in self.ax.collections:
+            self._tool_marker.do_3d_projection()
+            self.ax.draw_artist(self._tool_marker)
+
+    def _move_tool_marker(self, x, y, z):
         """
-        Draws the full toolpath from G-code lines and moves a yellow cone for the current position.
-        - gcode_lines: list of lines to draw the complete path (on load)
-        - gcode_line: single line to move the cone along the path
+        Move the yellow cone (tip at x, y, z) by updating its vertices and blitting
+        it over the saved background, instead of redrawing the whole 3D view.
         """
-        import re
-        import numpy as np
+        from mpl_toolkits.mplot3d.art3d import Poly3DCollection
+
+        if not hasattr(self, "_cone_shape"):
+            # side triangles from the tip to the rim, and the rim as a cap
+            theta = np.linspace(0, 2 * np.pi, CONE_SEGMENTS + 1)
+            rim = np.column_stack((CONE_RADIUS * np.cos(theta), CONE_RADIUS * np.sin(theta),
+                                   np.full(len(theta), CONE_HEIGHT)))
+            sides = [np.array([[0.0, 0.0, 0.0], rim[k], rim[k + 1]]) for k in range(CONE_SEGMENTS)]
+            self._cone_shape = sides + [rim[:-1]]
+
+        verts = [face + (x, y, z) for face in self._cone_shape]
+        marker = self._tool_marker
+        if marker is None or marker not in self.ax.collections:
+            # first use, or the axes were cleared: a full draw saves the background with it
+            marker = self._tool_marker = Poly3DCollection(verts, facecolors='yellow', edgecolors='none',
+                                                          alpha=0.8, animated=True)
+            self.ax.add_collection3d(marker)
+            self.canvas.draw_idle()
+            return
+        marker.set_verts(verts)
+        if self._toolpath_bg is None:
+            self.canvas.draw_idle()
+            return
+        self.canvas.restore_region(self._toolpath_bg)
+        marker.do_3d_projection()
+        self.ax.draw_artist(marker)
+        self.canvas.blit(self.fig.bbox)
 
+    def _update_toolpath(self, line_index=None, program=None, redraw=True):
+        """
+        Draws the full toolpath from the parsed program and moves a yellow cone for the current position.
+        - program: GcodeProgram to draw the complete path (on load)
+        - line_index: index of the line being sent, moves the cone along the path
+        """
         # ----------------- Initialize axes if not done -----------------
         if not hasattr(self, 'ax') or self.ax is None:
             from mpl_toolkits.mplot3d import Axes3D  # needed for 3D
@@ -2294,108 +2718,38 @@ class CNCSenderApp:
 
 
 # ----------------- Draw full toolpath on load -----------------
-        if gcode_lines:
-            # build segments (list of continuous segments), each segment is a list of (x,y,z)
-            rapid_segs = []   # segments for G0
-            cut_segs = []     # segments for G1/G2/G3
-
-            # current segment buffer and its type ('G0' or 'G1')
-            cur_seg = []
-            cur_mode = None
-
-            sim_x, sim_y, sim_z = 0.0, 0.0, 0.0
-
-            for line in gcode_lines:
-                up = line.upper()
-                # determine motion command on this line (modal parsing: change mode if G0/G1/G2/G3 present)
-                if "G0" in up:
-                    mode = "G0"
-                elif "G1" in up or "G2" in up or "G3" in up:
-                    mode = "G1"
-                else:
-                    mode = cur_mode or "G1"  # keep previous mode, default to G1
-
-                # update coordinates if present
-                coords = re.findall(r"[XYZ]\s*-?\d+\.?\d*", line, flags=re.IGNORECASE)
-                for c in coords:
-                    try:
-                        axis = c[0].upper()
-                        val = float(c[1:].strip())
-                        if axis == 'X':
-                            sim_x = val
-                        elif axis == 'Y':
-                            sim_y = val
-                        elif axis == 'Z':
-                            sim_z = val
-                    except Exception:
-                        pass
-
-                # if mode changed, flush current segment to appropriate list and start new one
-                if cur_mode is None:
-                    cur_mode = mode
-
-                if mode != cur_mode:
-                    # flush
-                    if cur_seg:
-                        if cur_mode == "G0":
-                            rapid_segs.append(cur_seg)
-                        else:
-                            cut_segs.append(cur_seg)
-                    cur_seg = []
-                    cur_mode = mode
-
-                # append current point to current segment
-                cur_seg.append((sim_x, sim_y, sim_z))
-
-            # flush last segment
-            if cur_seg:
-                if cur_mode == "G0":
-                    rapid_segs.append(cur_seg)
-                else:
-                    cut_segs.append(cur_seg)
+        if program is not None and len(program):
+            # continuous runs of rapids (G0) and cuts (G1/G2/G3)
+            pts, rapid, starts, ends = toolpath_runs(program)
 
-            # now plot: clear axes and plot each segment separately
-            if redraw:
+            # now plot: clear axes and draw all cuts and all rapids as one collection each
+            if redraw and len(pts):
                 try:
+                    from mpl_toolkits.mplot3d.art3d import Line3DCollection
                     self.ax.cla()
 
-                    # plot cutting segments (blue)
-                    for seg in cut_segs:
-                        xs = [p[0] for p in seg]
-                        ys = [p[1] for p in seg]
-                        zs = [p[2] for p in seg]
-                        if len(xs) >= 2:
-                            self.ax.plot(xs, ys, zs, linewidth=0.35, color='blue')
-                        else:
-                            # single points as small markers (optional)
-                            self.ax.scatter(xs, ys, zs, s=2)
-
-                    # plot rapid segments (red)
-                    for seg in rapid_segs:
-                        xs = [p[0] for p in seg]
-                        ys = [p[1] for p in seg]
-                        zs = [p[2] for p in seg]
-                        if len(xs) >= 2:
-                            self.ax.plot(xs, ys, zs, linewidth=0.6, color='red')
-                        else:
-                            self.ax.scatter(xs, ys, zs, s=4)
+                    cuts, rapids, single_cuts, single_rapids = toolpath_segments(pts, rapid)
+                    if len(rapids):
+                        # rapid segments (red)
+                        self.ax.add_collection3d(Line3DCollection(rapids, linewidths=0.6, colors='red'))
+                    if len(cuts):
+                        # cutting segments (blue)
+                        self.ax.add_collection3d(Line3DCollection(cuts, linewidths=0.35, colors='blue'))
+                    # single points as small markers
+                    if len(single_rapids):
+                        self.ax.scatter(single_rapids[:, 0], single_rapids[:, 1], single_rapids[:, 2], s=4)
+                    if len(single_cuts):
+                        self.ax.scatter(single_cuts[:, 0], single_cuts[:, 1], single_cuts[:, 2], s=2)
 
                     # compute bounds from everything plotted
-                    all_points = []
-                    for seg in cut_segs + rapid_segs:
-                        all_points.extend(seg)
-                    if all_points:
-                        all_x = [p[0] for p in all_points]
-                        all_y = [p[1] for p in all_points]
-                        all_z = [p[2] for p in all_points]
-                        padding = 5
-                        self.ax.set_xlim(min(all_x)-padding, max(all_x)+padding)
-                        self.ax.set_ylim(min(all_y)-padding, max(all_y)+padding)
-                        self.ax.set_zlim(min(all_z)-padding, max(all_z)+padding)
-                        dx = max(all_x)-min(all_x)+1
-                        dy = max(all_y)-min(all_y)+1
-                        dz = max(all_z)-min(all_z)+1
-                        self.ax.set_box_aspect([dx, dy, dz])
+                    lo = pts.min(axis=0)
+                    hi = pts.max(axis=0)
+                    padding = 5
+                    self.ax.set_xlim(lo[0]-padding, hi[0]+padding)
+                    self.ax.set_ylim(lo[1]-padding, hi[1]+padding)
+                    self.ax.set_zlim(lo[2]-padding, hi[2]+padding)
+                    dx, dy, dz = (hi - lo + 1).tolist()
+                    self.ax.set_box_aspect([dx, dy, dz])
 
                     self.ax.set_xlabel("X")
                     self.ax.set_ylabel("Y")
@@ -2411,60 +2765,21 @@ class CNCSenderApp:
 
 
         # ----------------- Move yellow cone for single G-code line -----------------
-        if gcode_line:
-            coords = re.findall(r"[XYZ]\s*-?\d+\.?\d*", gcode_line, flags=re.IGNORECASE)
+        if line_index is not None and self.program is not None and line_index < len(self.program):
             x, y, z = getattr(self, "pos_x", 0), getattr(self, "pos_y", 0), getattr(self, "pos_z", 0)
 
-            for c in coords:
-                try:
-                    axis = c[0].upper()
-                    val = float(c[1:].strip())
-                    if axis == 'X':
-                        x = val
-                        self.pos_x = val
-                    elif axis == 'Y':
-                        y = val
-                        self.pos_y = val
-                    elif axis == 'Z':
-                        z = val
-                        self.pos_z = val
-                except Exception:
-                    pass
+            rec = self.program.records[line_index]
+            flags = int(rec["flags"])
+            if flags & FLAG_X:
+                x = self.pos_x = float(rec["x"])
+            if flags & FLAG_Y:
+                y = self.pos_y = float(rec["y"])
+            if flags & FLAG_Z:
+                z = self.pos_z = float(rec["z"])
 
             if redraw:
                 try:
-                    tx, ty, tz = x, y, z
-                    cone_height = 5
-                    cone_radius = 2
-                    segments = 20
-
-                    theta = np.linspace(0, 2*np.pi, segments)
-                    r = np.linspace(0, cone_radius, 2)
-                    T, R = np.meshgrid(theta, r)
-
-                    Xc = tx + R * np.cos(T)
-                    Yc = ty + R * np.sin(T)
-                    Zc = tz + (cone_height * (R / cone_radius))
-
-                    # Remove previous cone surfaces safely
-                    for c in list(self.ax.collections):
-                        if hasattr(c, "_is_cone") and c._is_cone:
-                            c.remove()
-
-                    # Draw new cone
-                    cone_surf = self.ax.plot_surface(
-                        Xc, Yc, Zc,
-                        color='yellow',
-                        edgecolor='none',
-                        shade=True,
-                        alpha=0.8
-                    )
-                    cone_surf._is_cone = True
-
-                    try:
-                        self.canvas.draw_idle()
-                    except Exception:
-                        self.canvas.draw()
+                    self._move_tool_marker(x, y, z)
                 except Exception as e:
                     self._log(f"Cone draw error: {e}")
 
@@ -2474,140 +2789,6 @@ class CNCSenderApp:
 
 
 
-    # ------------------------- Serial Reader Loop -------------------------
-    # def _log_safe(self, msg):
-        # """Thread-safe console logger that ignores GRBL noise like ok, ?, MPos, WPos."""
-        # if not msg:
-            # return
-
-        # line = str(msg).strip()
-
-        # # Filter out unwanted GRBL echo/status lines
-        # if line.lower() == "ok" or line == "?" or line.startswith("MPos:") or line.startswith("WPos:"):
-            # return  # silently ignore
-
-        # # Thread-safe print or GUI log
-        # try:
-            # print(line)
-            # # If using a Tkinter Text or Listbox for logs:
-            # # self.log_text.insert('end', line + "\n")
-            # # self.log_text.see('end')
-        # except Exception:
-            # pass
-
-
-    def _serial_reader_loop(self):
-        """GRBL serial reader: updates DRO, manages queue, and keeps console clean."""
-        buffer = ""
-        while True:
-            if self.is_connected and self.serial_connection:
-                try:
-                    raw = self.serial_connection.readline()
-                    if not raw:
-                        time.sleep(0.001)
-                        continue
-
-                    line = raw.decode('ascii', errors='ignore').strip()
-                    if not line:
-                        continue
-
-                    # ------------------------------------------------------
-                    # 🔥 IGNORE ALARM 11 (GRBL Mega-5X hard-limit false trigger)
-                    # ------------------------------------------------------
-                    if line.startswith("ALARM:11"):
-                        self._log_safe("Ignoring ALARM:11 (auto-reset)")
-                        self._send_line("\x18")   # CTRL-X soft reset
-                        time.sleep(0.05)
-                        self._send_line("$X")     # Unlock GRBL
-                        continue  # DO NOT stop or add to any queue
-
-                    # ------------------------------------------------------
-                    # DRO / Position updates
-                    # ------------------------------------------------------
-                    if line.startswith("<") and "MPos:" in line:
-                        self._update_position_from_status(line)
-
-                        if "WCO:" in line:
-                            try:
-                                wco = line.split("WCO:")[1].split("|")[0]
-                                wx, wy, wz = map(float, wco.split(","))
-                                self.wco_x = wx
-                                self.wco_y = wy
-                                self.wco_z = wz
-                            except:
-                                pass
-                                
-                        # hide idle/Mposs lines from console-----------
-                        self.pos_x = self.mpos_x - self.wco_x
-                        self.pos_y = self.mpos_y - self.wco_y
-                        self.pos_z = self.mpos_z - self.wco_z
-                        continue
-
-                    # ------------------------------------------------------
-                    # Handle OK -> dequeue next G-code line
-                    # ------------------------------------------------------
-                    if line.lower() == "ok" and self.pending_lines:
-                        try:
-                            self.pending_lines.popleft()
-                        except Exception:
-                            pass
-                        continue
-
-                    # ------------------------------------------------------
-                    # Add GRBL response to the queue
-                    # ------------------------------------------------------
-                    try:
-                        if self.response_queue.full():
-                            try:
-                                self.response_queue.get_nowait()
-                            except Exception:
-                                pass
-                        self.response_queue.put_nowait(line)
-                    except Exception:
-                        pass
-
-                    # ------------------------------------------------------
-                    # Log line
-                    # ------------------------------------------------------
-                    self._log_safe(line)
-
-                except Exception:
-                    time.sleep(0.01)
-
-            else:
-                time.sleep(0.1)
-
-
-
-
-
-    # ------------------------- Response Handler -------------------------
-    def _response_handler_loop(self):
-        while True:
-            try:
-                if not self.response_queue.empty():
-                    try:
-                        line = self.response_queue.get(timeout=0.1)
-                        self._log(f"<< {line}")
-                    except queue.Empty:
-                        pass
-                else:
-                    time.sleep(0.01)
-            except Exception:
-                time.sleep(0.05)
-
-    # ------------------------- Position Poll Loop -------------------------
-    def _position_poll_loop(self):
-        while True:
-            if self.is_connected and not self._polling_paused.is_set():
-                # Send "?" without logging to console (handled in _send_line)
-                # self._log("?")
-                self._send_line("?")
-                
-            time.sleep(0.2)
-
-
-
     # ------------------------- Jog Commands -------------------------
     def jog(self, direction):
         distance = self.jog_distance.get()
@@ -2727,6 +2908,7 @@ class CNCSenderApp:
         pulloff = float(self.al_pulloff.get())
         total_pts = len(xs) * len(ys)
         idx = 0
+        timers = self.engine.timers
 
         # Precompute center offsets for simulation
         x_center = 0.5 * (xs[0] + xs[-1]) if xs else 0
@@ -2743,15 +2925,17 @@ class CNCSenderApp:
                 self._log(f"Probing point {idx}/{total_pts}: X={x}, Y={y}", widget=self.al_console)
 
                 # Move to safe Z and XY
+                t = timers.start()
                 self._send_line(f"G90 G0 Z{safe_z}")
                 self._wait_for_ok(timeout=0.1)
                 self._send_line(f"G90 G0 X{x} Y{y}")
                 self._wait_for_ok(timeout=0.1)
+                timers.stop("autolevel.move", t)
 
                 # Probe with retry and alarm handling
                 measured = None
                 for attempt in range(3):
-                    if self.simulate_mode.get():
+                    if self.engine.simulate:
                         # --- SIMULATED BED: gentle curved surface ---
                         dx = x - x_center
                         dy = y - y_center
@@ -2763,14 +2947,16 @@ class CNCSenderApp:
                         self._log(f"[SIM PROBE] Z={measured:.4f}", widget=self.al_console)
                         break
                     else:
-                        self._drain_response_queue()
+                        probe = self.engine.expect(RESP_PROBE, RESP_ALARM, RESP_ERROR)
+                        t = timers.start()
                         self._send_line(probe_cmd_template)
-                        start_time = time.time()
-                        while time.time() - start_time < 6.0:
-                            try:
-                                line = self.response_queue.get(timeout=0.1)
-                            except queue.Empty:
-                                continue
+                        try:
+                            line = probe.result(timeout=6.0)[1]
+                        except FutureTimeout:
+                            probe.cancel()
+                            line = None
+                        timers.stop("autolevel.probe_wait", t)
+                        if line is not None:
                             line_lower = line.strip().lower()
                             m = re.search(r"prb[:=]\s*([-+]?\d*\.?\d+),\s*([-+]?\d*\.?\d+),\s*([-+]?\d*\.?\d+)", line_lower)
                             if m:
@@ -2824,10 +3010,12 @@ class CNCSenderApp:
 
 
 
+                t = timers.start()
                 try:
                     self._update_al_partial_plot()
                 except Exception:
                     pass
+                timers.stop("autolevel.plot", t)
 
             time.sleep(0.05)
 
@@ -2838,53 +3026,25 @@ class CNCSenderApp:
 
     def _wait_for_ok(self, timeout=5.0):
         """
-        Waits for GRBL 'ok', but is fully interruptible.
+        Waits for GRBL's answer to the last line this thread sent with _send_line.
+        Stop/E-stop resolve it at once.
         Returns:
             True  -> ok received
             False -> stopped, error, alarm, or timeout
         """
-
-        deadline = time.time() + timeout
-
-        while time.time() < deadline:
-
-            # --- INSTANT STOP ---
-            if self.send_manager_stop.is_set():
-                return False
-
-            try:
-                # Very short timeout so stop interruption is instant
-                line = self.response_queue.get(timeout=0.02)
-
-            except queue.Empty:
-                continue
-
-            if not line:
-                continue
-
-            line = line.strip().lower()
-
-            if line == "ok":
-                return True
-
-            if "error" in line or "alarm" in line:
-                self._log(f"GRBL reported: {line}", widget=self.al_console)
-                return False
-
-        # Timeout hit
-        return False
-
-
-
-    def _drain_response_queue(self):
+        ack = getattr(self._acks, "last", None)
+        if ack is None:
+            return False
         try:
-            while not self.response_queue.empty():
-                try:
-                    self.response_queue.get_nowait()
-                except Exception:
-                    break
-        except Exception:
-            pass
+            response = ack.result(timeout=timeout)
+        except FutureTimeout:
+            return False
+
+        if response == "ok":
+            return True
+        if response:
+            self._log(f"GRBL reported: {response}", widget=self.al_console)
+        return False
 
 
     # ------------------------- Auto-Level Visualization / Export -------------------------
@@ -3053,74 +3213,6 @@ class CNCSenderApp:
 
 
 
-    def apply_height_map_to_gcode(self):
-        if not self.gcode_lines:
-            messagebox.showwarning("No G-code", "Load a G-code file first.")
-            return
-        with self._al_lock:
-            if self.al_heights is None or len(self.al_xs) == 0 or len(self.al_ys) == 0:
-                messagebox.showwarning("No map", "No probe map available. Run probing first.")
-                return
-            xs = self.al_xs[:]
-            ys = self.al_ys[:]
-            hs = self.al_heights.copy()
-            ref = self.al_ref_height if self.al_ref_height is not None else 0.0
-
-        corrected = []
-        cur_x = None
-        cur_y = None
-        absolute_mode = True
-        for line in self.gcode_lines:
-            ln = line.strip()
-            if re.search(r"\bG90\b", ln):
-                absolute_mode = True
-            if re.search(r"\bG91\b", ln):
-                absolute_mode = False
-            x_m = re.search(r"X(-?\d+\.?\d*)", ln, flags=re.IGNORECASE)
-            y_m = re.search(r"Y(-?\d+\.?\d*)", ln, flags=re.IGNORECASE)
-            z_m = re.search(r"Z(-?\d+\.?\d*)", ln, flags=re.IGNORECASE)
-            if x_m:
-                cur_x = float(x_m.group(1))
-            if y_m:
-                cur_y = float(y_m.group(1))
-            if z_m:
-                z_val = float(z_m.group(1))
-                lookup_x = cur_x
-                lookup_y = cur_y
-                if lookup_x is None or lookup_y is None:
-                    corrected.append(line)
-                    continue
-                surf_h = self._get_height_at(lookup_x, lookup_y, xs, ys, hs)
-                if surf_h is None or np.isnan(surf_h):
-                    corrected.append(line)
-                    continue
-                delta = surf_h - ref
-                new_z = z_val + delta
-                new_line = re.sub(r"(Z)-?\d+\.?\d*", lambda m: f"Z{new_z:.6f}", line, flags=re.IGNORECASE)
-                corrected.append(new_line)
-            else:
-                corrected.append(line)
-        self.corrected_gcode_lines = corrected
-        messagebox.showinfo("Applied", "Height map corrections applied to loaded G-code (in-memory). Use 'Save Corrected G-code' to write to file.")
-        self._log("Auto-level: corrections applied (in-memory)")
-
-
-    def save_corrected_gcode(self):
-        if not self.corrected_gcode_lines:
-            messagebox.showwarning("No corrected G-code", "Apply correction to G-code first.")
-            return
-        path = filedialog.asksaveasfilename(defaultextension=".gcode", filetypes=[("G-code","*.gcode"),("All files","*.*")])
-        if not path:
-            return
-        try:
-            with open(path, "w", encoding='utf-8') as f:
-                for ln in self.corrected_gcode_lines:
-                    f.write(ln.rstrip() + "\n")
-            messagebox.showinfo("Saved", f"Corrected G-code saved to {path}")
-        except Exception as e:
-            messagebox.showerror("Save failed", str(e))
-
-
     # ------------------------- Apply Height Map to G-code -------------------------
     def apply_height_map_to_gcode(self):
         if not self.gcode_lines:
@@ -3135,41 +3227,7 @@ class CNCSenderApp:
             hs = self.al_heights.copy()
             ref = self.al_ref_height if self.al_ref_height is not None else 0.0
 
-        corrected = []
-        cur_x = None
-        cur_y = None
-        absolute_mode = True
-        for line in self.gcode_lines:
-            ln = line.strip()
-            if re.search(r"\bG90\b", ln):
-                absolute_mode = True
-            if re.search(r"\bG91\b", ln):
-                absolute_mode = False
-            x_m = re.search(r"X(-?\d+\.?\d*)", ln, flags=re.IGNORECASE)
-            y_m = re.search(r"Y(-?\d+\.?\d*)", ln, flags=re.IGNORECASE)
-            z_m = re.search(r"Z(-?\d+\.?\d*)", ln, flags=re.IGNORECASE)
-            if x_m:
-                cur_x = float(x_m.group(1))
-            if y_m:
-                cur_y = float(y_m.group(1))
-            if z_m:
-                z_val = float(z_m.group(1))
-                lookup_x = cur_x
-                lookup_y = cur_y
-                if lookup_x is None or lookup_y is None:
-                    corrected.append(line)
-                    continue
-                surf_h = self._get_height_at(lookup_x, lookup_y, xs, ys, hs)
-                if surf_h is None or np.isnan(surf_h):
-                    corrected.append(line)
-                    continue
-                delta = surf_h - ref
-                new_z = z_val + delta
-                new_line = re.sub(r"(Z)-?\d+\.?\d*", lambda m: f"Z{new_z:.6f}", line, flags=re.IGNORECASE)
-                corrected.append(new_line)
-            else:
-                corrected.append(line)
-        self.corrected_gcode_lines = corrected
+        self.corrected_gcode_lines = apply_height_map(self.program, xs, ys, hs, ref)
         messagebox.showinfo("Applied", "Height map corrections applied to loaded G-code (in-memory). Use 'Save Corrected G-code' to write to file.")
         self._log("Auto-level: corrections applied (in-memory)")
 
@@ -3188,59 +3246,6 @@ class CNCSenderApp:
         except Exception as e:
             messagebox.showerror("Save failed", str(e))
 
-    def _get_height_at(self, x, y, xs, ys, hs):
-        if len(xs) < 2 or len(ys) < 2:
-            return float('nan')
-        nx = len(xs)
-        ny = len(ys)
-        if x <= xs[0]:
-            ix = 0
-            fx = 0.0
-        elif x >= xs[-1]:
-            ix = nx - 2
-            fx = 1.0
-        else:
-            ix = max(0, min(nx - 2, int(floor((x - xs[0]) / (xs[-1] - xs[0] + 1e-12) * (nx - 1)))))
-            while ix + 1 < nx and xs[ix+1] < x:
-                ix += 1
-            while ix > 0 and xs[ix] > x:
-                ix -= 1
-            denom = xs[ix+1] - xs[ix] if xs[ix+1] != xs[ix] else 1e-12
-            fx = (x - xs[ix]) / denom
-        if y <= ys[0]:
-            iy = 0
-            fy = 0.0
-        elif y >= ys[-1]:
-            iy = ny - 2
-            fy = 1.0
-        else:
-            iy = max(0, min(ny - 2, int(floor((y - ys[0]) / (ys[-1] - ys[0] + 1e-12) * (ny - 1)))))
-            while iy + 1 < ny and ys[iy+1] < y:
-                iy += 1
-            while iy > 0 and ys[iy] > y:
-                iy -= 1
-            denomy = ys[iy+1] - ys[iy] if ys[iy+1] != ys[iy] else 1e-12
-            fy = (y - ys[iy]) / denomy
-        try:
-            z00 = hs[iy, ix]
-            z10 = hs[iy, ix+1] if ix+1 < hs.shape[1] else z00
-            z01 = hs[iy+1, ix] if iy+1 < hs.shape[0] else z00
-            z11 = hs[iy+1, ix+1] if (iy+1 < hs.shape[0] and ix+1 < hs.shape[1]) else z00
-            corner_vals = [z00, z10, z01, z11]
-            if any(np.isnan(corner_vals)):
-                nonnan = [v for v in corner_vals if not np.isnan(v)]
-                if nonnan:
-                    return float(np.mean(nonnan))
-                else:
-                    return float('nan')
-            z0 = z00 * (1 - fx) + z10 * fx
-            z1 = z01 * (1 - fx) + z11 * fx
-            z = z0 * (1 - fy) + z1 * fy
-            return float(z)
-        except Exception:
-            return float('nan')
-            
-            
 
 
 
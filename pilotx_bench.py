@@ -0,0 +1,257 @@
+# pilotx_bench.py
+# Headless benchmarks of PilotX's hot paths, for comparing versions:
+# file loading, program parsing and toolpath runs, run time estimate, envelope check, height map correction,
+# height lookups, status report parsing and end-to-end streaming against the
+# virtual controller (pilotx_virtual.py). Prints a table and saves JSON. Timing
+# only: correctness is covered by the tests (python -m pytest).
+#
+#   python pilotx_bench.py                          synthetic 10k / 100k / 1M lines
+#   python pilotx_bench.py --sizes 10000,5000000    other synthetic sizes
+#   python pilotx_bench.py part.nc --json after.json   real files
+#   python pilotx_bench.py --compare before.json after.json
+
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+import numpy as np  # numpy library is needed
+
+from pilotx_engine import StreamEngine, parse_status_report, EMPTY_STATUS, STREAM_MODE_CHARS, STREAM_MODE_LINES
+from pilotx_gcode import (load_gcode_lines, load_gcode_program, toolpath_runs, toolpath_segments,
+                          apply_height_map, height_at, heights_at, check_envelope)
+from pilotx_estimate import estimate_program
+from pilotx_virtual import VirtualGrbl, serve_socket
+
+DEFAULT_SIZES = (10000, 100000, 1000000)
+LOOKUPS = 100000          # height_at / heights_at queries
+STATUS_REPORTS = 100000   # status lines parsed
+STREAM_LINES = 20000      # lines streamed end to end (from the start of each file)
+GRID = 10                 # height map is GRID x GRID over the program's XY bounds
+
+
+# ------------------------- Inputs -------------------------
+def synthetic_gcode(path, lines, seed=1):
+    """Write a 3D-finishing style program: raster passes of short G1 moves with rapids between."""
+    rng = np.random.default_rng(seed)
+    with open(path, "w") as f:
+        f.write("(PilotX benchmark program)\nG21\nG90\nM3 S12000\nG0 Z5.000\n")
+        written = 5
+        y = 0.0
+        chunk = 100000
+        while written < lines:
+            n = min(chunk, lines - written)
+            x = np.cumsum(rng.uniform(0.005, 0.2, n)) % 200.0
+            z = -1.0 + 0.5 * np.sin(x / 7.0) + rng.normal(0, 0.002, n)
+            out = []
+            for i, (xv, zv) in enumerate(zip(x.tolist(), z.tolist())):
+                if i % 500 == 0:
+                    y = (y + 0.25) % 150.0
+                    out.append(f"G0 Z5.000\nG0 X{xv:.3f} Y{y:.3f}\nG1 Z{zv:.3f} F300")
+                else:
+                    out.append(f"G1 X{xv:.3f} Y{y:.3f} Z{zv:.3f} F1200")
+            f.write("\n".join(out) + "\n")
+            written += n
+        f.write("G0 Z5.000\nM5\nM30\n")
+    return path
+
+
+def synthetic_status(count, seed=2):
+    """GRBL 1.1 status reports as a streaming job produces them (WCO:/Ov: every few)."""
+    rng = np.random.default_rng(seed)
+    pos = rng.uniform(-200, 0, (count, 3))
+    out = []
+    for i, (x, y, z) in enumerate(pos.tolist()):
+        extra = "|WCO:-100.000,-75.000,-20.000" if i % 10 == 0 else "|Ov:100,100,100" if i % 10 == 1 else ""
+        out.append(f"<Run|MPos:{x:.3f},{y:.3f},{z:.3f}|Bf:{i % 15},{(i * 7) % 128}|FS:1200,12000{extra}>")
+    return out
+
+
+# ------------------------- Timing -------------------------
+def timed(fn, repeat=1):
+    """Best wall time of repeat calls and the last result."""
+    best = None
+    result = None
+    for _ in range(max(1, repeat)):
+        t = time.perf_counter()
+        result = fn()
+        dt = time.perf_counter() - t
+        best = dt if best is None else min(best, dt)
+    return best, result
+
+
+def bench_file(path, results, repeat=1, stream_lines=STREAM_LINES, stream_mode=STREAM_MODE_CHARS,
+               block_time=0.0, log=print):
+    name = os.path.basename(path)
+
+    def record(stage, seconds, items, unit="lines"):
+        results.append({"file": name, "stage": stage, "items": int(items), "unit": unit,
+                        "seconds": seconds, "rate": items / seconds if seconds else 0.0})
+        log(f"  {stage:<22} {seconds:9.3f} s  {items / seconds if seconds else 0:14,.0f} {unit}/s")
+
+    log(f"{name} ({os.path.getsize(path) / 1e6:.1f} MB)")
+
+    def load():
+        lines = load_gcode_lines(path)
+        for _ in lines:
+            pass
+        return lines
+    dt, lines = timed(load, repeat)
+    record("load + decode", dt, len(lines))
+
+    dt, program = timed(lambda: load_gcode_program(path), repeat)
+    record("parse program", dt, len(program))
+
+    dt, runs = timed(lambda: toolpath_runs(program), repeat)
+    record("toolpath runs", dt, len(runs[0]), "points")
+
+    dt, _ = timed(lambda: toolpath_segments(runs[0], runs[1]), repeat)
+    record("toolpath segments", dt, len(runs[0]), "points")
+
+    dt, _ = timed(lambda: estimate_program(program), repeat)
+    record("run time estimate", dt, len(runs[0]), "moves")
+
+    dt, _ = timed(lambda: check_envelope(program, travel=(200.0, 200.0, 200.0)), repeat)
+    record("envelope check", dt, len(program))
+
+    pts = runs[0]
+    if len(pts):
+        lo = pts.min(axis=0)
+        hi = pts.max(axis=0)
+    else:
+        lo = hi = np.zeros(3)
+    xs = np.linspace(lo[0], hi[0] + 1e-3, GRID)
+    ys = np.linspace(lo[1], hi[1] + 1e-3, GRID)
+    hs = np.random.default_rng(3).normal(0, 0.05, (GRID, GRID))
+
+    dt, _ = timed(lambda: apply_height_map(program, xs, ys, hs), repeat)
+    record("apply_height_map", dt, len(program))
+
+    rng = np.random.default_rng(4)
+    qx = rng.uniform(lo[0], hi[0], LOOKUPS)
+    qy = rng.uniform(lo[1], hi[1], LOOKUPS)
+    dt, _ = timed(lambda: [height_at(x, y, xs, ys, hs) for x, y in zip(qx.tolist(), qy.tolist())], repeat)
+    record("height_at", dt, LOOKUPS, "lookups")
+    dt, _ = timed(lambda: heights_at(qx, qy, xs, ys, hs), repeat)
+    record("heights_at (vector)", dt, LOOKUPS, "lookups")
+
+    if stream_lines:
+        n = min(stream_lines, len(lines))
+        dt, stats = stream(lines[:n], stream_mode, block_time)
+        record("stream (virtual GRBL)", dt, n)
+        results[-1].update(stats)
+    lines.close()
+    program.lines.close()
+
+
+def bench_status(results, repeat=1, log=print):
+    reports = synthetic_status(STATUS_REPORTS)
+
+    def parse_all():
+        report = EMPTY_STATUS
+        for line in reports:
+            report = parse_status_report(line, report)
+        return report
+    dt, _ = timed(parse_all, repeat)
+    results.append({"file": "-", "stage": "parse_status_report", "items": len(reports), "unit": "reports",
+                    "seconds": dt, "rate": len(reports) / dt if dt else 0.0})
+    log(f"  {'parse_status_report':<22} {dt:9.3f} s  {len(reports) / dt:14,.0f} reports/s")
+
+
+def stream(lines, stream_mode=STREAM_MODE_CHARS, block_time=0.0):
+    """Stream lines through the engine to an in-process virtual controller over TCP."""
+    grbl = VirtualGrbl(block_time=block_time).start()
+    url = serve_socket(grbl, 0)
+    engine = StreamEngine(stream_mode=stream_mode, update_interval=max(1, len(lines) // 100))
+    try:
+        engine.connect(url)
+        engine.load_program(lines)
+        t = time.perf_counter()
+        engine.start_job()
+        engine.wait_until_done(poll=0.05)
+        dt = time.perf_counter() - t
+        info = engine.metrics.summary()
+        return dt, {"latency_ms_p50": info.get("latency_ms_p50"), "latency_ms_p95": info.get("latency_ms_p95"),
+                    "rx_overflows": grbl.overflows, "stream_mode": stream_mode}
+    finally:
+        engine.disconnect()
+        grbl.stop()
+        grbl._server.close()
+
+
+# ------------------------- Report -------------------------
+def print_table(results):
+    print()
+    print(f"{'file':<28} {'stage':<22} {'items':>10} {'seconds':>10} {'rate':>14}")
+    for r in results:
+        print(f"{r['file'][:28]:<28} {r['stage']:<22} {r['items']:>10} {r['seconds']:>10.3f} "
+              f"{r['rate']:>14,.0f} {r['unit']}/s")
+
+
+def compare(before_path, after_path):
+    """Table of rate changes between two saved runs (same files/stages)."""
+    with open(before_path) as f:
+        before = {(r["file"], r["stage"]): r for r in json.load(f)["results"]}
+    with open(after_path) as f:
+        after = json.load(f)["results"]
+    print(f"{'file':<28} {'stage':<22} {'before':>14} {'after':>14} {'change':>8}")
+    for r in after:
+        old = before.get((r["file"], r["stage"]))
+        if not old or not old["rate"]:
+            continue
+        change = 100.0 * (r["rate"] / old["rate"] - 1)
+        print(f"{r['file'][:28]:<28} {r['stage']:<22} {old['rate']:>14,.0f} {r['rate']:>14,.0f} {change:>+7.1f}%")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark PilotX's hot paths without the GUI.")
+    parser.add_argument("files", nargs="*", help="real G-code files (default: synthetic programs)")
+    parser.add_argument("--sizes", default=",".join(str(n) for n in DEFAULT_SIZES),
+                        help="synthetic program sizes in lines, comma separated (default %(default)s)")
+    parser.add_argument("--repeat", type=int, default=1, help="runs per stage, best time is kept")
+    parser.add_argument("--stream-lines", type=int, default=STREAM_LINES,
+                        help="lines streamed end to end per file, 0 to skip (default %(default)s)")
+    parser.add_argument("--mode", choices=["lines", "chars"], default="chars", help="streaming protocol")
+    parser.add_argument("--block-time", type=float, default=0.0,
+                        help="virtual planner block time in seconds (0 = host-bound)")
+    parser.add_argument("--json", default="pilotx_bench.json", help="results file (default %(default)s)")
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"), help="compare two results files")
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        compare(*args.compare)
+        return 0
+
+    results = []
+    mode = STREAM_MODE_CHARS if args.mode == "chars" else STREAM_MODE_LINES
+    with tempfile.TemporaryDirectory() as tmp:
+        files = list(args.files)
+        if not files:
+            for n in (int(v) for v in args.sizes.split(",") if v.strip()):
+                print(f"Generating {n} line program...")
+                files.append(synthetic_gcode(os.path.join(tmp, f"synthetic_{n}.nc"), n))
+        for path in files:
+            bench_file(path, results, args.repeat, args.stream_lines, mode, args.block_time)
+        print("status reports")
+        bench_status(results, args.repeat)
+
+    print_table(results)
+    data = {
+        "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "python": sys.version.split()[0],
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "args": vars(args),
+        "results": results,
+    }
+    with open(args.json, "w") as f:
+        json.dump(data, f, indent=1)
+    print(f"\nSaved {args.json}")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,1163 @@
+# pilotx_engine.py
+# Headless GRBL streaming engine for PilotX: serial I/O, buffer accounting,
+# status parsing and the send loop. Nothing here imports tkinter or matplotlib,
+# so a job can be streamed from a bare shop-floor box:
+#
+#   python pilotx_engine.py part.nc --port /dev/ttyUSB0 --baud 115200 --mode chars
+
+import argparse
+import os
+import re
+import sys
+import threading
+import time
+from collections import deque, namedtuple
+from concurrent.futures import Future
+
+import serial  # pyserial library is needed
+
+from pilotx_gcode import (load_gcode_lines, load_gcode_program, decimate_program, CompactedLines,
+                          resume_state, resume_preamble, check_envelope)
+from pilotx_estimate import estimate_program, load_profile, format_duration
+from pilotx_metrics import StreamMetrics, StarvationMonitor, StageTimers, TelemetryRecorder
+
+# ------------------------- Constants -------------------------
+READER_MAX_PARTIAL = 4096 # drop an unterminated line longer than this (line noise)
+GRBL_BUFFER_MAX = 16      # GRBL 1.2h planner buffer (safe)
+GRBL_RX_BUFFER_SIZE = 127 # GRBL serial RX buffer is 128 bytes, keep 1 spare
+
+# GRBL realtime commands: single bytes picked out of the serial stream as they
+# arrive, never queued in the RX buffer and never answered with ok
+RT_STATUS = b"?"
+RT_FEED_HOLD = b"!"
+RT_CYCLE_START = b"~"
+RT_SOFT_RESET = b"\x18"
+RT_SAFETY_DOOR = b"\x84"
+RT_JOG_CANCEL = b"\x85"
+RT_FEED_100 = b"\x90"
+RT_FEED_PLUS_10 = b"\x91"
+RT_FEED_MINUS_10 = b"\x92"
+RT_FEED_PLUS_1 = b"\x93"
+RT_FEED_MINUS_1 = b"\x94"
+RT_RAPID_100 = b"\x95"
+RT_RAPID_50 = b"\x96"
+RT_RAPID_25 = b"\x97"
+RT_SPINDLE_100 = b"\x99"
+RT_SPINDLE_PLUS_10 = b"\x9a"
+RT_SPINDLE_MINUS_10 = b"\x9b"
+RT_SPINDLE_PLUS_1 = b"\x9c"
+RT_SPINDLE_MINUS_1 = b"\x9d"
+RT_SPINDLE_STOP = b"\x9e"
+RT_FLOOD_TOGGLE = b"\xa0"
+RT_MIST_TOGGLE = b"\xa1"
+
+# Response kinds routed by the dispatcher (see StreamEngine.expect)
+RESP_OK = "ok"
+RESP_ERROR = "error"      # error:N
+RESP_ALARM = "alarm"      # ALARM:N
+RESP_PROBE = "probe"      # [PRB:x,y,z:s]
+RESP_MESSAGE = "message"  # [MSG:...], [GC:...], $ settings, banners, ...
+
+_SETTING_RE = re.compile(r"^\$(\d+)=([-+]?[\d.]+)")  # $110=500.000 from $$
+
+
+def classify_response(line):
+    """Return the RESP_* kind of a controller line (status reports excluded)."""
+    head = line[:6].lower()
+    if head == "ok":
+        return RESP_OK
+    if head.startswith("error"):
+        return RESP_ERROR
+    if head.startswith("alarm"):
+        return RESP_ALARM
+    if head.startswith("[prb:"):
+        return RESP_PROBE
+    return RESP_MESSAGE
+
+# Streaming protocols
+STREAM_MODE_LINES = "Line Count"       # gate on number of unacknowledged lines
+STREAM_MODE_CHARS = "Character Count"  # gate on bytes in GRBL's RX buffer
+
+
+# ------------------------- Status Reports -------------------------
+# One parsed <...> report. Positions are tuples of 3 (X, Y, Z) or up to 5
+# (X, Y, Z, A, B on GRBL Mega-5X) floats; absent fields are None, except WCO,
+# Ov and A which GRBL only sends every few reports and are carried forward.
+StatusReport = namedtuple("StatusReport", [
+    "state",        # "Idle", "Run", "Hold", "Jog", "Alarm", "Door", "Check", "Home", "Sleep"
+    "substate",     # int after "Hold:"/"Door:", else None
+    "mpos",         # machine position
+    "wpos",         # work position
+    "wco",          # work coordinate offset
+    "planner",      # Bf: free planner blocks
+    "rx_free",      # Bf: free RX buffer bytes
+    "line",         # Ln: line number being executed
+    "feed",         # FS:/F: current feed rate
+    "spindle",      # FS: current spindle speed
+    "pins",         # Pn: triggered pins, e.g. "XYZP", "" when none
+    "overrides",    # Ov: (feed %, rapid %, spindle %)
+    "accessories",  # A: e.g. "SFM", "" when none
+    "time",         # time.time() when parsed
+])
+
+EMPTY_STATUS = StatusReport("Unknown", None, (0.0, 0.0, 0.0), (0.0, 0.0, 0.0), (0.0, 0.0, 0.0),
+                            None, None, None, None, None, "", (100, 100, 100), "", 0.0)
+
+
+def _axes(value):
+    return tuple([float(v) for v in value.split(",")])
+
+
+def _offset(a, b, sign):
+    # pad with zeros when WCO and the position report different axis counts
+    n = max(len(a), len(b))
+    a = a + (0.0,) * (n - len(a))
+    b = b + (0.0,) * (n - len(b))
+    return tuple([x + sign * y for x, y in zip(a, b)])
+
+
+def parse_status_report(line, previous=EMPTY_STATUS):
+    """
+    Parse a GRBL 1.1 status report in one pass, e.g.
+    <Run|MPos:5.000,10.000,0.000|Bf:15,128|Ln:42|FS:500,8000|WCO:1.000,2.000,0.000>
+    Fields GRBL only sends now and then (WCO, Ov, A) are taken from previous.
+    Whichever of MPos/WPos is missing is derived from the other and WCO.
+    """
+    body = line.strip()
+    if body.startswith("<"):
+        body = body[1:]
+    if body.endswith(">"):
+        body = body[:-1]
+    fields = body.split("|")
+
+    state, _, sub = fields[0].partition(":")
+    substate = int(sub) if sub.isdigit() else None
+    mpos = wpos = None
+    wco = previous.wco
+    planner = rx_free = line_number = feed = spindle = None
+    pins = ""
+    overrides = previous.overrides
+    accessories = previous.accessories
+
+    for field in fields[1:]:
+        key, _, value = field.partition(":")
+        if key == "MPos":
+            mpos = _axes(value)
+        elif key == "WPos":
+            wpos = _axes(value)
+        elif key == "FS":
+            fs = value.split(",")
+            feed = float(fs[0])
+            spindle = float(fs[1]) if len(fs) > 1 else None
+        elif key == "F":
+            feed = float(value)
+        elif key == "Bf":
+            bf = value.split(",")
+            planner = int(bf[0])
+            rx_free = int(bf[1]) if len(bf) > 1 else None
+        elif key == "Ln":
+            line_number = int(value)
+        elif key == "WCO":
+            wco = _axes(value)
+        elif key == "Pn":
+            pins = value
+        elif key == "Ov":
+            overrides = tuple([int(v) for v in value.split(",")])
+            accessories = ""  # A: follows Ov only when something is on
+        elif key == "A":
+            accessories = value
+
+    if mpos is None and wpos is not None:
+        mpos = _offset(wpos, wco, 1)
+    elif mpos is None:
+        mpos = previous.mpos
+    if wpos is None:
+        wpos = _offset(mpos, wco, -1)
+
+    return StatusReport(state, substate, mpos, wpos, wco, planner, rx_free, line_number,
+                        feed, spindle, pins, overrides, accessories, time.time())
+
+
+# ------------------------- Throughput -------------------------
+class ThroughputCounter:
+    """Lines, bytes and write() calls of one job, to compare streaming strategies."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.lines = 0
+        self.bytes = 0
+        self.writes = 0
+        self.started = time.time()
+        self.finished = None
+
+    def add(self, lines, nbytes, writes=1):
+        self.lines += lines
+        self.bytes += nbytes
+        self.writes += writes
+
+    def stop(self):
+        self.finished = time.time()
+
+    def elapsed(self):
+        return max(1e-9, (self.finished or time.time()) - self.started)
+
+    def summary(self):
+        t = self.elapsed()
+        per_write = self.lines / self.writes if self.writes else 0.0
+        return (f"Streamed {self.lines} lines / {self.bytes} bytes in {t:.2f} s: "
+                f"{self.lines / t:.0f} lines/s, {self.bytes / t:.0f} bytes/s, "
+                f"{self.writes} writes ({per_write:.1f} lines/write)")
+
+
+# ------------------------- Stream Engine -------------------------
+class StreamEngine:
+    """
+    GUI-independent GRBL sender.
+
+    Subscribe with engine.on(event, callback). Callbacks run on the engine's
+    worker threads, so GUI subscribers must hand work to their own main loop.
+
+    Events:
+        "log"       (text)          console messages
+        "status"    (report)        a <...> report was parsed into a StatusReport
+        "response"  (line)          every controller line except acks and status reports
+        "alarm"     (line)          ALARM:N (other than the ignored ALARM:11); the job is stopped
+        "line_sent" (index, line)   a program line was handed to the controller
+        "progress"  (index, total)  every update_interval lines and at the end
+        "job"       (state)         "Running", "Resuming...", "Paused", "Stopped", "Idle"
+    """
+
+    def __init__(self, stream_mode=STREAM_MODE_LINES, rx_buffer_limit=GRBL_RX_BUFFER_SIZE, update_interval=20,
+                 batch_writes=True):
+        self._listeners = {}
+
+        # Serial / Thread variables
+        self.serial_connection = None
+        self.is_connected = False
+        self.serial_lock = threading.Lock()
+        self.realtime_out = bytearray()  # realtime bytes waiting to jump the next write
+        self.realtime_lock = threading.Lock()
+        self.reader_thread = None
+        self._waiters = []               # [(kinds, Future)] registered by expect()
+        self._waiters_lock = threading.Lock()
+
+        # Streaming
+        self.stream_mode = stream_mode
+        self.rx_buffer_limit = rx_buffer_limit
+        self.update_interval = update_interval
+        self.batch_writes = batch_writes  # one write()/flush() per buffer window instead of per line
+        self.throughput = ThroughputCounter()
+        self.metrics = StreamMetrics()  # per-line send/ack timing of the current job
+        self.starvation = StarvationMonitor()  # Bf: planner-starvation events of the current job
+        self.timers = StageTimers()  # opt-in per-stage timing (send loop, reader, GUI)
+        self.telemetry = TelemetryRecorder()  # status reports of each job, set .directory to enable
+        self.job_name = "job"
+        self.simulate = False
+        self.sim_speed = 1.0
+        self.send_thread = None
+        self.stop_event = threading.Event()
+        self.pause_event = threading.Event()
+        # (line, nbytes, ack Future or None, program index or -1, perf_counter at send)
+        # for every line sent but waiting for ok
+        self.pending_lines = deque()
+        self.pending_chars = 0        # bytes of pending_lines still in GRBL's RX buffer
+        self.preamble = []            # lines sent ahead of the first program line (resume)
+        # Reader notifies on every ok/error; stop/pause/resume notify too
+        self.pending_cond = threading.Condition()
+
+        # Program
+        self.gcode_lines = []
+        self.total_lines = 0
+        self.current_line_index = 0
+
+        # Machine state from status reports; self.status is the latest StatusReport
+        self.status = EMPTY_STATUS
+        self.busy_status = EMPTY_STATUS  # last report in Run/Hold, for resume_index()
+        self.grbl_settings = {}          # {110: 500.0, ...} from the last $$
+        self.machine_state = "Unknown"
+        self.mpos_x = self.mpos_y = self.mpos_z = self.mpos_a = self.mpos_b = 0.0
+        self.wco_x = self.wco_y = self.wco_z = self.wco_a = self.wco_b = 0.0
+        self.pos_x = self.pos_y = self.pos_z = self.pos_a = self.pos_b = 0.0
+
+        # Status polling
+        self.status_poll_interval = 0.2  # seconds
+        self.polling_paused = threading.Event()
+        self.poll_thread = None
+
+    # ------------------------- Events -------------------------
+    def on(self, event, callback):
+        """Subscribe callback(*args) to an engine event."""
+        self._listeners.setdefault(event, []).append(callback)
+
+    def _emit(self, event, *args):
+        for callback in self._listeners.get(event, ()):
+            try:
+                callback(*args)
+            except Exception as e:
+                print(f"Engine callback error ({event}): {e}")
+
+    def _log(self, text):
+        self._emit("log", text)
+
+    # ------------------------- Serial Functions -------------------------
+    def connect(self, port, baud=115200):
+        """
+        Open the port and reset the controller. Raises on failure.
+        port may also be a pyserial URL, e.g. socket://localhost:23000 (pilotx_virtual.py).
+        """
+        self.serial_connection = serial.serial_for_url(port, baud, timeout=0.5)
+        try:
+            self.serial_connection.dtr = False
+            self.serial_connection.rts = False
+            time.sleep(0.05)
+            self.serial_connection.dtr = True
+            self.serial_connection.rts = True
+        except Exception:
+            pass  # ptys and sockets have no reset line
+        time.sleep(2.0)
+        try:
+            self.serial_connection.reset_input_buffer()
+        except Exception:
+            pass
+        self.is_connected = True
+        self._log(f"Connected to {port} @ {baud}")
+        if self.reader_thread is None or not self.reader_thread.is_alive():
+            self.reader_thread = threading.Thread(target=self._serial_reader_loop, name="grbl-reader", daemon=True)
+            self.reader_thread.start()
+
+    def disconnect(self):
+        self.is_connected = False
+        self.finish_telemetry()
+        if self.serial_connection:
+            try:
+                self.serial_connection.close()
+            except Exception:
+                pass
+            self.serial_connection = None
+        self._log("Serial disconnected")
+
+    def send_line(self, line, index=-1):
+        """
+        Send one command line. Returns a Future resolved with GRBL's answer to
+        this line ("ok" or "error:N"), or None if it is never acknowledged
+        (write failure, reset, stop). Returns None when nothing was sent.
+        index is the program line when the send loop streams it (for metrics).
+        """
+        if self.simulate:
+            # Only log simulation commands that are not "?"
+            if line != "?":
+                self._log(f"[SIM] {line}")
+            ack = Future()
+            ack.set_result(RESP_OK)
+            return ack
+
+        # ?, ! and ~ are realtime commands: no newline, no buffer credit, no ok
+        if line in ("?", "!", "~"):
+            self.send_realtime(line.encode('ascii'))
+            return None
+
+        if self.is_connected and self.serial_connection:
+            ack = Future()
+            conn = self.serial_connection
+            with self.serial_lock:
+                # track before writing: on a fast link the ok can beat the flush
+                self._track_pending(line, ack, index)
+                try:
+                    conn.write(self._take_realtime() + (line + "\n").encode('ascii', errors='ignore'))
+                except Exception as e:
+                    self._untrack_pending(1)
+                    self._log(f"Serial write error: {e}")
+                    return ack
+            try:
+                conn.flush()  # outside the lock: realtime bytes need not wait for the drain
+            except Exception as e:
+                self._log(f"Serial write error: {e}")
+            # Only log actual commands that are not "?"
+            if line != "?":
+                self._log(f">> {line}")
+            return ack
+        return None
+
+    def send_realtime(self, b):
+        """
+        Send realtime command bytes (RT_*). They bypass the buffer accounting and
+        go out ahead of every G-code line not yet written. A write already in
+        progress holds the port: the bytes follow it (or ride in front of the
+        next line write, whichever takes the lock first). Line writes flush
+        outside the lock, so that wait is one write() call, not a serial drain
+        of up to a full RX buffer (~11 ms at 115200 baud).
+        """
+        if not (self.serial_connection and self.serial_connection.is_open):
+            return
+        with self.realtime_lock:
+            self.realtime_out += b
+        try:
+            with self.serial_lock:
+                data = self._take_realtime()
+                if data:
+                    self.serial_connection.write(data)
+        except Exception as e:
+            print("Realtime send error:", e)
+
+    def _take_realtime(self):
+        """Return and clear the queued realtime bytes. Caller holds serial_lock."""
+        with self.realtime_lock:
+            if not self.realtime_out:
+                return b""
+            data = bytes(self.realtime_out)
+            del self.realtime_out[:]
+            return data
+
+    # ------------------------- Buffer Accounting -------------------------
+    def _track_pending(self, line, ack=None, index=-1):
+        """Record a line sent to GRBL that will be answered by ok/error."""
+        nbytes = len(line.encode('ascii', errors='ignore')) + 1
+        now = time.perf_counter()
+        with self.pending_cond:
+            self.pending_lines.append((line, nbytes, ack, index, now))
+            self.pending_chars += nbytes
+            if index >= 0:
+                self.metrics.on_sent(index, now, nbytes, self.pending_chars)
+
+    def _release_pending(self, count=1, response=RESP_OK):
+        """
+        Drop the oldest count pending lines once GRBL has answered them, wake the
+        sender once and resolve their ack futures with response.
+        Returns the released entries.
+        """
+        with self.pending_cond:
+            released = []
+            while len(released) < count and self.pending_lines:
+                entry = self.pending_lines.popleft()
+                self.pending_chars -= entry[1]
+                released.append(entry)
+            if not self.pending_lines:
+                self.pending_chars = 0
+            if released:
+                self.pending_cond.notify_all()
+        now = time.perf_counter()
+        for _, nbytes, ack, index, sent in released:
+            if index >= 0:
+                self.metrics.on_acked(index, sent, now, nbytes)
+            if ack is not None and not ack.done():
+                ack.set_result(response)
+        return released
+
+    def _untrack_pending(self, count):
+        """Forget the newest count pending lines after a failed write; they will never be acknowledged."""
+        with self.pending_cond:
+            dropped = []
+            while len(dropped) < count and self.pending_lines:
+                entry = self.pending_lines.pop()
+                self.pending_chars -= entry[1]
+                dropped.append(entry)
+            if not self.pending_lines:
+                self.pending_chars = 0
+            self.pending_cond.notify_all()
+        self._resolve_unanswered(dropped)
+
+    def _clear_pending(self):
+        with self.pending_cond:
+            dropped = list(self.pending_lines)
+            self.pending_lines.clear()
+            self.pending_chars = 0
+            self.pending_cond.notify_all()
+        self._resolve_unanswered(dropped)
+
+    def _resolve_unanswered(self, entries):
+        # waiters on lines GRBL will never answer get None instead of timing out
+        for _, _, ack, _, _ in entries:
+            if ack is not None and not ack.done():
+                ack.set_result(None)
+
+    def _wake_sender(self):
+        """Wake the send loop after stop/pause/resume so it re-checks its state."""
+        with self.pending_cond:
+            self.pending_cond.notify_all()
+
+    def _buffer_has_room(self, line, char_mode, rx_limit):
+        """
+        Streaming gate for the send loop (call with pending_cond held).
+        - Line Count: at most GRBL_BUFFER_MAX unacknowledged lines
+        - Character Count: bytes in flight + this line must fit GRBL's RX buffer.
+          A line longer than the buffer is still sent once the buffer is empty.
+        """
+        if not char_mode:
+            return len(self.pending_lines) < GRBL_BUFFER_MAX
+        if not self.pending_lines:
+            return True
+        need = len(line.encode('ascii', errors='ignore')) + 1
+        return self.pending_chars + need <= rx_limit
+
+    def _send_burst(self, index, char_mode, rx_limit):
+        """
+        Send every program line from index on that fits the buffer window with
+        one write() under one serial_lock acquisition, then one flush() outside
+        it so realtime bytes need not wait for the burst to drain.
+        Returns the lines handed to the controller.
+        """
+        if not (self.is_connected and self.serial_connection):
+            # same as send_line while disconnected: the line is skipped
+            return [self.gcode_lines[index]]
+
+        batch = []
+        tracked = 0
+        conn = self.serial_connection
+        with self.serial_lock:
+            with self.pending_cond:
+                while index + len(batch) < self.total_lines:
+                    line = self.gcode_lines[index + len(batch)]
+                    if not line:
+                        batch.append(line)  # nothing left after compaction
+                        continue
+                    if not self._buffer_has_room(line, char_mode, rx_limit):
+                        break
+                    self._track_pending(line, None, index + len(batch))
+                    batch.append(line)
+                    tracked += 1
+            if not tracked:
+                return batch
+
+            data = "".join(line + "\n" for line in batch if line).encode('ascii', errors='ignore')
+            try:
+                conn.write(self._take_realtime() + data)
+                self.throughput.add(tracked, len(data))
+            except Exception as e:
+                self._log(f"Serial write error: {e}")
+                self._untrack_pending(tracked)
+                return batch
+        try:
+            conn.flush()
+        except Exception as e:
+            self._log(f"Serial write error: {e}")
+
+        for line in batch:
+            if line:
+                self._log(f">> {line}")
+        return batch
+
+    # ------------------------- Job Control -------------------------
+    def load_program(self, gcode_lines, name="job"):
+        """Set the program to stream and rewind to its first line. name labels telemetry files."""
+        self.gcode_lines = gcode_lines
+        self.job_name = name
+        self.total_lines = len(gcode_lines)
+        self.current_line_index = 0
+
+    def start_job(self, start=0, preamble=None):
+        """
+        Start streaming the loaded program, or resume it if the send thread is still alive.
+        A new job can start at program line `start`, after the `preamble` lines
+        (see pilotx_gcode.resume_preamble) that restore the modal state there.
+        """
+        if self.send_thread and self.send_thread.is_alive():
+            self.pause_event.clear()
+            self.stop_event.clear()
+            self._wake_sender()
+            self._emit("job", "Resuming...")
+            return
+
+        self.stop_event.clear()
+        self.pause_event.clear()
+        self.current_line_index = max(0, min(int(start), self.total_lines))
+        self.preamble = list(preamble or [])
+        self.send_thread = threading.Thread(target=self._send_loop, name="grbl-sender", daemon=True)
+        self.send_thread.start()
+        self._emit("job", "Running...")
+
+    def pause_job(self):
+        self.pause_event.set()
+        self._wake_sender()
+        self._emit("job", "Paused")
+
+    def stop_job(self, spindle_off=True):
+        """Stop streaming and rewind. spindle_off sends M5 straight to the port."""
+        self.stop_event.set()
+        self.pause_event.clear()
+        self._wake_sender()
+
+        # --- Stop spindle ---
+        if spindle_off and self.serial_connection and self.serial_connection.is_open:
+            try:
+                with self.serial_lock:
+                    self.serial_connection.write(b"M5\n")
+                    self.serial_connection.flush()
+            except Exception as e:
+                print("Failed to send M5:", e)
+
+        self.current_line_index = 0
+        self._clear_pending()
+        self._emit("job", "Stopped")
+
+    def resume_index(self):
+        """
+        Program line to restart from after a stop or a lost connection: the
+        oldest acknowledged line that may still have been queued in GRBL's
+        planner (from the last Bf: report in Run/Hold, else a full planner).
+        Blocks and lines are counted alike, so this errs towards re-cutting.
+        """
+        acked = self.metrics.last_index
+        if acked < 0:
+            return 0
+        report = self.busy_status
+        size = self.starvation.planner_size
+        queued = size - report.planner if report.planner is not None and size else GRBL_BUFFER_MAX
+        return max(0, acked - max(0, queued) + 1)
+
+    def wait_until_done(self, poll=0.2):
+        """Block until the send loop has finished and every sent line is acknowledged."""
+        while self.send_thread and self.send_thread.is_alive():
+            self.send_thread.join(poll)
+        with self.pending_cond:
+            while self.pending_lines and self.is_connected and not self.stop_event.is_set():
+                self.pending_cond.wait(poll)
+
+    def _send_loop(self):
+        update_interval = self.update_interval
+        timers = self.timers
+        sim_yield = 0.002
+
+        # Streaming protocol is fixed for the whole job
+        char_mode = self.stream_mode == STREAM_MODE_CHARS
+        try:
+            rx_limit = max(1, int(self.rx_buffer_limit))
+        except Exception:
+            rx_limit = GRBL_RX_BUFFER_SIZE
+        self._log(f"Streaming: {STREAM_MODE_CHARS if char_mode else STREAM_MODE_LINES}"
+                  + (f" ({rx_limit} bytes)" if char_mode else f" ({GRBL_BUFFER_MAX} lines)")
+                  + (", batched writes" if self.batch_writes else ", one write per line"))
+        self.throughput.reset()
+        self.metrics.start(self.total_lines)
+        self.starvation.start()
+        if not self.simulate:
+            self.telemetry.start(self.job_name)
+
+        # --- Resume preamble: modal state and approach, before the first program line ---
+        for line in self.preamble:
+            if not self.simulate:
+                with self.pending_cond:
+                    self.pending_cond.wait_for(
+                        lambda: self.stop_event.is_set()
+                        or self._buffer_has_room(line, char_mode, rx_limit)
+                    )
+            if self.stop_event.is_set():
+                break
+            self.send_line(line)
+        if self.preamble and not self.stop_event.is_set():
+            self._log(f"Preamble sent ({len(self.preamble)} lines), streaming from line "
+                      f"{self.current_line_index + 1} of {self.total_lines}")
+
+        while self.current_line_index < self.total_lines:
+
+            # --- Check STOP instantly ---
+            if self.stop_event.is_set():
+                break
+
+            # --- Handle Pause (woken by resume/stop) ---
+            if self.pause_event.is_set():
+                with self.pending_cond:
+                    self.pending_cond.wait_for(
+                        lambda: not self.pause_event.is_set()
+                        or self.stop_event.is_set()
+                    )
+            if self.stop_event.is_set():
+                break
+
+            # --- Get line ---
+            index = self.current_line_index
+            line = self.gcode_lines[index]
+            simulate = self.simulate
+
+            # --- GRBL Buffer wait: each ok/error from the reader releases credit ---
+            if line and not simulate:
+                t = timers.start()
+                with self.pending_cond:
+                    self.pending_cond.wait_for(
+                        lambda: self.stop_event.is_set()
+                        or self._buffer_has_room(line, char_mode, rx_limit)
+                    )
+                timers.stop("send.buffer_wait", t)
+            if self.stop_event.is_set():
+                break
+
+            # --- Send to machine: the whole open window at once, or one line ---
+            t = timers.start()
+            if simulate or not line:
+                batch = [line]  # compaction can leave nothing to send
+            elif self.batch_writes:
+                batch = self._send_burst(index, char_mode, rx_limit)
+            else:
+                self.send_line(line, index)
+                self.throughput.add(1, len(line.encode('ascii', errors='ignore')) + 1)
+                batch = [line]
+            timers.stop("send.write", t)
+
+            # --- Events: GUI/CLI subscribers run on this thread ---
+            t = timers.start()
+            for sent in batch:
+                self._emit("line_sent", self.current_line_index, sent)
+                self.current_line_index += 1
+
+                # --- Progress (throttled) ---
+                if (
+                    self.current_line_index % update_interval == 0
+                    or self.current_line_index == self.total_lines
+                ):
+                    self._emit("progress", self.current_line_index, self.total_lines)
+            timers.stop("send.events", t)
+
+            # --- Simulation mode sleep (returns early on stop) ---
+            if simulate:
+                scaled = sim_yield / max(0.01, self.sim_speed)
+                if self.stop_event.wait(scaled):
+                    break
+
+        # Finish
+        self.throughput.stop()
+        if self.throughput.lines:
+            self._log(self.throughput.summary())
+        self._emit("job", "Idle")
+
+    # ------------------------- Status Parsing -------------------------
+    def _update_position_from_status(self, status_line):
+        """Parse a <...> status report into self.status and the flat position fields."""
+        try:
+            report = parse_status_report(status_line, self.status)
+        except Exception as e:
+            self._log(f"Error parsing position: {e}")
+            return
+
+        self.status = report
+        self.machine_state = report.state
+        if report.state in ("Run", "Hold"):
+            self.busy_status = report
+        mpos = report.mpos + (0.0,) * (5 - len(report.mpos))
+        wco = report.wco + (0.0,) * (5 - len(report.wco))
+        wpos = report.wpos + (0.0,) * (5 - len(report.wpos))
+        self.mpos_x, self.mpos_y, self.mpos_z, self.mpos_a, self.mpos_b = mpos[:5]
+        self.wco_x, self.wco_y, self.wco_z, self.wco_a, self.wco_b = wco[:5]
+        self.pos_x, self.pos_y, self.pos_z, self.pos_a, self.pos_b = wpos[:5]
+
+        if self.send_thread is not None and self.send_thread.is_alive() and not self.simulate:
+            self.starvation.sample(report, self.metrics.last_index, self.current_line_index - 1)
+
+        if self.telemetry.active:
+            self.telemetry.record(report, self.metrics.last_index)
+            # The job ends when the machine does: everything sent, acknowledged and executed
+            if (report.state in ("Idle", "Alarm") and not self.pending_lines
+                    and not (self.send_thread and self.send_thread.is_alive())):
+                self.finish_telemetry()
+
+        self._emit("status", report)
+
+    def finish_telemetry(self):
+        """Save the current job's telemetry file (packed in the background), if one is being recorded."""
+        self.telemetry.stop({"job": self.job_name, "stream_mode": self.stream_mode,
+                             "lines": self.total_lines, "lines_sent": self.current_line_index},
+                            done=lambda path: self._log(f"Telemetry saved: {path}"))
+
+    # ------------------------- Serial Reader Loop -------------------------
+    def _serial_reader_loop(self):
+        """
+        GRBL serial reader. Pulls everything waiting on the port in one read(),
+        frames complete lines out of a reusable bytearray and dispatches them as a batch.
+        """
+        buf = bytearray()
+        timers = self.timers
+        while True:
+            ser = self.serial_connection
+            if self.is_connected and ser:
+                try:
+                    # Block (up to the port timeout) for the first byte, then take the rest
+                    data = ser.read(ser.in_waiting or 1)
+                    if not data:
+                        continue
+                    t = timers.start()  # the blocking wait above is idle time, not read cost
+                    waiting = ser.in_waiting
+                    if waiting:
+                        data += ser.read(waiting)
+                    buf += data
+                    timers.stop("reader.read", t)
+
+                    t = timers.start()
+                    end = buf.rfind(b"\n")
+                    if end < 0:
+                        if len(buf) > READER_MAX_PARTIAL:
+                            del buf[:]
+                        continue
+                    text = buf[:end].decode('ascii', errors='ignore')
+                    del buf[:end + 1]
+                    lines = text.split("\n")
+                    timers.stop("reader.decode", t)
+
+                    t = timers.start()
+                    self._dispatch_lines(lines)
+                    timers.stop("reader.dispatch", t)
+
+                except Exception:
+                    del buf[:]
+                    time.sleep(0.01)
+
+            else:
+                del buf[:]
+                time.sleep(0.1)
+
+    def _dispatch_lines(self, lines):
+        """
+        Handle one batch of controller lines in arrival order. Status reports are
+        applied as soon as they are reached; consecutive oks are released together.
+        """
+        acks = 0
+        for line in lines:
+            line = line.strip()
+            if not line:
+                continue
+
+            # ------------------------------------------------------
+            # DRO / Position updates
+            # ------------------------------------------------------
+            if line.startswith("<"):
+                self._update_position_from_status(line)
+                continue
+
+            # ------------------------------------------------------
+            # Handle OK -> dequeue next G-code line (batched)
+            # ------------------------------------------------------
+            if line.lower() == "ok":
+                acks += 1
+                continue
+
+            # Anything else keeps its order relative to the acks before it
+            if acks:
+                self._flush_acks(acks)
+                acks = 0
+            self._handle_response(line)
+
+        if acks:
+            self._flush_acks(acks)
+
+    def _flush_acks(self, acks):
+        released = len(self._release_pending(acks))
+        # oks nobody was waiting on still go to the response consumers
+        for _ in range(acks - released):
+            self._handle_response("ok")
+
+    def _handle_response(self, line):
+        """
+        Route one controller line: error:N answers the oldest pending line,
+        alarms go to the safety handler, and every line resolves matching
+        expect() waiters and goes to "response" subscribers (the log).
+        """
+        kind = classify_response(line)
+
+        if kind == RESP_ALARM:
+            # ------------------------------------------------------
+            # IGNORE ALARM 11 (GRBL Mega-5X hard-limit false trigger)
+            # ------------------------------------------------------
+            if line.startswith("ALARM:11"):
+                self._log("Ignoring ALARM:11 (auto-reset)")
+                self.send_realtime(RT_SOFT_RESET)  # CTRL-X soft reset
+                self._clear_pending()         # reset flushes GRBL's buffers
+                time.sleep(0.05)
+                self.send_line("$X")          # Unlock GRBL
+                return  # DO NOT stop or notify anyone
+            self._on_alarm(line)
+
+        elif kind == RESP_ERROR:
+            # error:N also consumes the line from GRBL's RX buffer
+            released = self._release_pending(1, response=line)
+            if released:
+                line = f"{line} ({released[0][0]})"
+
+        elif kind == RESP_MESSAGE and line.startswith("$"):
+            setting = _SETTING_RE.match(line)
+            if setting:
+                self.grbl_settings[int(setting.group(1))] = float(setting.group(2))
+
+        self._resolve_waiters(kind, line)
+        if kind == RESP_ALARM:
+            self._emit("alarm", line)
+        self._emit("response", line)
+
+    def _on_alarm(self, line):
+        """Safety handler: GRBL halts and flushes its buffers on every alarm, so stop the job."""
+        self._clear_pending()
+        if self.send_thread and self.send_thread.is_alive() and not self.stop_event.is_set():
+            self._log(f"{line}: job stopped at line {self.current_line_index}")
+            self.stop_event.set()
+            self.pause_event.clear()
+            self._wake_sender()
+            self._emit("job", "Stopped")
+
+    def check_envelope(self, program, stock=None, force_set_origin=False, start=0, preamble=None):
+        """
+        pilotx_gcode.check_envelope() of a program at the work offset of the last
+        status report, against the travel in $130-$132 once $$ has been read.
+        force_set_origin: the firmware is built with HOMING_FORCE_SET_ORIGIN, so
+        the axes homing to negative ($23) travel 0..+travel. start/preamble:
+        a resume, checked from line start with its preamble moves.
+        """
+        s = self.grbl_settings
+        travel = tuple(s[k] for k in (130, 131, 132)) if all(k in s for k in (130, 131, 132)) else None
+        positive = int(s.get(23, 0)) if force_set_origin else 0
+        return check_envelope(program, self.status.wco, travel, stock, positive, start, preamble)
+
+    def read_settings(self, timeout=3.0):
+        """Send $$ and wait for its ok; returns {number: value} (also kept in self.grbl_settings)."""
+        ack = self.send_line("$$")
+        if ack is None:
+            return dict(self.grbl_settings)
+        ack.result(timeout)
+        return dict(self.grbl_settings)
+
+    # ------------------------- Response Waiters -------------------------
+    def expect(self, *kinds):
+        """
+        Register for the next response of one of the RESP_* kinds and return a
+        Future resolved with (kind, line). Register before sending the command
+        that triggers it, e.g.
+
+            probe = engine.expect(RESP_PROBE, RESP_ALARM, RESP_ERROR)
+            engine.send_line("G38.2 Z-10 F50")
+            kind, line = probe.result(timeout=6.0)
+
+        Cancel the future if you stop waiting for it.
+        """
+        waiter = Future()
+        with self._waiters_lock:
+            self._waiters.append((kinds, waiter))
+        return waiter
+
+    def _resolve_waiters(self, kind, line):
+        if not self._waiters:
+            return
+        with self._waiters_lock:
+            matched = [w for k, w in self._waiters if kind in k or w.done()]
+            self._waiters = [(k, w) for k, w in self._waiters if w not in matched]
+        for waiter in matched:
+            try:
+                waiter.set_result((kind, line))
+            except Exception:
+                pass  # cancelled by the waiter
+
+    # ------------------------- Position Poll Loop -------------------------
+    def start_polling(self):
+        if self.poll_thread is None or not self.poll_thread.is_alive():
+            self.poll_thread = threading.Thread(target=self._position_poll_loop, name="grbl-status-poll", daemon=True)
+            self.poll_thread.start()
+
+    def _position_poll_loop(self):
+        while True:
+            if self.is_connected and not self.polling_paused.is_set():
+                # realtime: no newline, no pending line, never logged
+                self.send_realtime(RT_STATUS)
+            time.sleep(self.status_poll_interval)
+
+
+# ------------------------- Command Line -------------------------
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Stream a G-code file to GRBL without the PilotX GUI.")
+    parser.add_argument("file", help="G-code file (*.gcode, *.nc, *.tap)")
+    parser.add_argument("--port", help="serial port, e.g. COM3 or /dev/ttyUSB0")
+    parser.add_argument("--baud", type=int, default=115200)
+    parser.add_argument("--mode", choices=["lines", "chars"], default="lines",
+                        help="streaming protocol: line count or character counting")
+    parser.add_argument("--rx-buffer", type=int, default=GRBL_RX_BUFFER_SIZE,
+                        help="RX buffer limit in bytes for --mode chars")
+    parser.add_argument("--no-batch", action="store_true",
+                        help="write and flush one line at a time instead of a whole buffer window")
+    parser.add_argument("--simulate", action="store_true", help="run the job without a controller")
+    parser.add_argument("--verbose", action="store_true", help="echo every line sent")
+    parser.add_argument("--stats", metavar="PATH",
+                        help="save per-line send/ack timing of the job (.json or .csv)")
+    parser.add_argument("--compact", type=float, metavar="RES", nargs="?", const=0.001,
+                        help="strip comments/spaces, elide modal repeats and round to RES mm "
+                             "(default 0.001) before streaming")
+    parser.add_argument("--profile", metavar="PATH",
+                        help="time the send loop and reader stages and save the summary as JSON")
+    parser.add_argument("--trace", metavar="PATH",
+                        help="save the timed stages as a Chrome trace (chrome://tracing, ui.perfetto.dev)")
+    parser.add_argument("--start-line", type=int, metavar="N",
+                        help="resume at line N of the file: restore the modal state, retract, "
+                             "move over the resume point, plunge and stream from there")
+    parser.add_argument("--safe-z", type=float, default=5.0,
+                        help="work Z in mm to retract to before moving to the resume point (default %(default)s)")
+    parser.add_argument("--spin-up", type=float, default=2.0,
+                        help="seconds to dwell after restarting the spindle on resume (default %(default)s)")
+    parser.add_argument("--estimate", action="store_true",
+                        help="print the estimated run time (and an ETA with progress); without --port "
+                             "only the estimate is printed")
+    parser.add_argument("--machine-profile", metavar="PATH",
+                        help="JSON of $11, $110-$112 and $120-$122 for --estimate "
+                             "(default: read $$ from the controller, or GRBL's defaults offline)")
+    parser.add_argument("--check", action="store_true",
+                        help="check the program against the machine travel ($130-$132 at the current work "
+                             "offset) and --stock before streaming; refuse to run if anything is outside")
+    parser.add_argument("--stock", metavar="XMIN,XMAX,YMIN,YMAX,ZMIN,ZMAX",
+                        help="stock box in work mm for --check: cutting moves must stay inside it")
+    parser.add_argument("--force-set-origin", action="store_true",
+                        help="for --check: GRBL is built with HOMING_FORCE_SET_ORIGIN, axes homing to "
+                             "negative ($23) travel 0..+travel")
+    parser.add_argument("--telemetry", metavar="DIR",
+                        help="record every status report of the job to a compressed .npz file in DIR")
+    parser.add_argument("--decimate", type=float, metavar="TOL", nargs="?", const=0.005,
+                        help="merge nearly collinear G1 runs within TOL mm (default 0.005) before streaming")
+    args = parser.parse_args(argv)
+
+    if not args.port and not args.simulate and not (args.estimate or args.check):
+        parser.error("--port is required unless --simulate, --estimate or --check is given")
+    stock = None
+    if args.stock:
+        try:
+            stock = [float(v) for v in args.stock.split(",")]
+        except ValueError:
+            stock = []
+        if len(stock) != 6:
+            parser.error("--stock takes XMIN,XMAX,YMIN,YMAX,ZMIN,ZMAX")
+
+    start_index, preamble = 0, []
+    program = estimate = None
+    if args.decimate or args.start_line or args.estimate or args.check:
+        program = load_gcode_program(args.file)
+        if args.decimate:
+            program, result = decimate_program(program, args.decimate)
+            print(result.summary())
+        lines = program.lines
+        if args.start_line:
+            start_index = program.index_of_line(args.start_line)
+            if start_index >= len(lines):
+                parser.error(f"--start-line {args.start_line} is past the end of the program")
+            state = resume_state(program, start_index)
+            preamble = resume_preamble(state, args.safe_z, spin_up=args.spin_up, line=lines[start_index])
+            start_index = state.start
+            print(f"Resuming at line {args.start_line}: " + " | ".join(preamble))
+            if state.unknown_axes():
+                print(f"Warning: {state.unknown_axes()} position unknown at line {args.start_line} "
+                      "(only G91 moves before it), left where the machine is")
+    else:
+        lines = load_gcode_lines(args.file)
+    if not (args.port or args.simulate):
+        # Offline: report and exit (no work offset or travel without a controller)
+        if args.estimate:
+            profile = load_profile(args.machine_profile) if args.machine_profile else None
+            print(estimate_program(program, profile).summary())
+        if args.check:
+            report = check_envelope(program, stock=stock, start=start_index, preamble=preamble)
+            print(report.summary())
+            return 0 if report.ok else 2
+        return 0
+    if args.compact:
+        lines = CompactedLines(lines, args.compact)
+    engine = StreamEngine(
+        stream_mode=STREAM_MODE_CHARS if args.mode == "chars" else STREAM_MODE_LINES,
+        rx_buffer_limit=args.rx_buffer,
+        update_interval=max(1, len(lines) // 100),
+        batch_writes=not args.no_batch,
+    )
+    engine.simulate = args.simulate
+    engine.timers.enabled = bool(args.profile or args.trace)
+    engine.telemetry.directory = args.telemetry
+    engine.sim_speed = 5.0
+
+    failures = []
+
+    def on_log(text):
+        if args.verbose or not (text.startswith(">> ") or text.startswith("[SIM] ")):
+            print(text)
+
+    def on_response(line):
+        print(f"<< {line}")
+        lower = line.lower()
+        if lower.startswith("error") or lower.startswith("alarm"):
+            failures.append(line)
+
+    def on_progress(index, total):
+        if estimate is not None:
+            print(f"Line: {index} / {total}, ETA {format_duration(estimate.remaining(index - 1))}")
+        else:
+            print(f"Line: {index} / {total}")
+
+    engine.on("log", on_log)
+    engine.on("response", on_response)
+    engine.on("progress", on_progress)
+
+    print(f"Loaded {len(lines)} lines from {args.file}")
+    if not args.simulate:
+        try:
+            engine.connect(args.port, args.baud)
+        except Exception as e:
+            print(f"Connection failed: {e}")
+            return 1
+    if args.estimate:
+        if args.machine_profile:
+            profile = load_profile(args.machine_profile)
+        else:
+            try:
+                profile = engine.read_settings() if not args.simulate else None
+            except Exception as e:
+                print(f"Could not read $$ ({e}), using GRBL defaults")
+                profile = None
+        estimate = estimate_program(program, profile)
+        print(estimate.summary())
+    if args.check:
+        if not args.simulate:
+            try:
+                engine.read_settings()
+            except Exception as e:
+                print(f"Could not read $$ ({e}), travel not checked")
+            engine.send_realtime(RT_STATUS)  # the first report after connecting carries WCO:
+            deadline = time.time() + 2.0
+            while engine.status is EMPTY_STATUS and time.time() < deadline:
+                time.sleep(0.05)
+        report = engine.check_envelope(program, stock, args.force_set_origin, start_index, preamble)
+        print(report.summary())
+        if not report.ok:
+            print("Job not started")
+            engine.disconnect()
+            return 2
+
+    start = time.time()
+    engine.load_program(lines, os.path.splitext(os.path.basename(args.file))[0])
+    if not args.simulate:
+        engine.start_polling()  # status reports feed the starvation report and telemetry
+    engine.start_job(start_index, preamble)
+    try:
+        engine.wait_until_done()
+        while engine.telemetry.active and engine.is_connected:
+            time.sleep(0.1)  # the file closes once the machine is idle again
+    except KeyboardInterrupt:
+        engine.stop_job()
+        print("Stopped")
+        return 130
+    finally:
+        if engine.is_connected:
+            engine.disconnect()
+        engine.telemetry.wait()
+
+    print(f"Done in {time.time() - start:.1f} s, {len(failures)} error/alarm responses")
+    if args.compact:
+        print(lines.summary())
+    info = engine.metrics.summary()
+    if info["lines_acked"]:
+        print(f"Ack latency: mean {info['latency_ms_mean']:.1f} ms, p50 {info['latency_ms_p50']:.1f}, "
+              f"p95 {info['latency_ms_p95']:.1f}, max {info['latency_ms_max']:.1f} ms; "
+              f"mean RX occupancy {info['mean_occupancy']:.0f} bytes")
+    if engine.starvation.reports and (engine.starvation.samples or not engine.starvation.seen_bf):
+        print(engine.starvation.report())
+    if engine.timers.enabled:
+        print(engine.timers.report())
+        if args.profile:
+            engine.timers.export(args.profile)
+        if args.trace:
+            engine.timers.export(args.trace, trace=True)
+    if args.stats:
+        engine.metrics.export(args.stats, extra={"file": args.file, "stream_mode": engine.stream_mode,
+                                                 "starvation": engine.starvation.summary()})
+        print(f"Stream stats saved: {args.stats}")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
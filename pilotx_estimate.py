@@ -0,0 +1,274 @@
+# pilotx_estimate.py
+# Job time estimate for PilotX from the controller's own motion limits:
+# max rate ($110-$112, mm/min), acceleration ($120-$122, mm/s^2) and junction
+# deviation ($11, mm). Every move of the parsed program gets GRBL's planner
+# treatment in NumPy: nominal speed limited per axis, junction speeds from
+# the junction deviation model, then forward/backward acceleration passes and
+# a trapezoid (or triangle) profile per segment.
+#
+# Not modelled: dwells, spindle spin-up, tool changes, overrides and the
+# planner's finite lookahead (GRBL plans 15-16 blocks ahead, this plans the
+# whole program), so short-segment programs on a slow link run a bit longer.
+
+import json
+
+import numpy as np  # numpy library is needed
+
+from pilotx_gcode import FLAG_XYZ, FLAG_OTHER, FLAG_INCHES, arc_geometry
+
+# GRBL defaults, used for any setting the profile does not give
+DEFAULT_PROFILE = {
+    11: 0.010,    # junction deviation, mm
+    110: 500.0,   # X max rate, mm/min
+    111: 500.0,   # Y max rate, mm/min
+    112: 500.0,   # Z max rate, mm/min
+    120: 10.0,    # X acceleration, mm/s^2
+    121: 10.0,    # Y acceleration, mm/s^2
+    122: 10.0,    # Z acceleration, mm/s^2
+}
+PROFILE_KEYS = tuple(DEFAULT_PROFILE)
+MIN_JUNCTION_SPEED = 0.0      # mm/s, GRBL's MINIMUM_JUNCTION_SPEED
+COS_STRAIGHT = 0.999999       # junctions closer to straight (or to reversal) than this
+
+
+# ------------------------- Machine Profile -------------------------
+def normalize_profile(settings):
+    """{number: float} with every PROFILE_KEYS entry, from $$ settings or a saved profile ("$110" keys allowed)."""
+    profile = dict(DEFAULT_PROFILE)
+    for key, value in (settings or {}).items():
+        try:
+            number = int(str(key).lstrip("$"))
+            if number in profile:
+                profile[number] = float(value)
+        except (TypeError, ValueError):
+            pass
+    return profile
+
+
+def load_profile(path):
+    with open(path, "r") as f:
+        return normalize_profile(json.load(f))
+
+
+def save_profile(path, settings):
+    profile = normalize_profile(settings)
+    with open(path, "w") as f:
+        json.dump({f"${k}": v for k, v in profile.items()}, f, indent=1)
+
+
+def format_duration(seconds):
+    """'1:02:03' or '2:03'."""
+    seconds = int(round(max(0.0, seconds)))
+    h, rest = divmod(seconds, 3600)
+    m, s = divmod(rest, 60)
+    return f"{h}:{m:02d}:{s:02d}" if h else f"{m}:{s:02d}"
+
+
+# ------------------------- Estimate -------------------------
+class TimeEstimate:
+    """
+    Estimated timing of a program.
+    - line_end[i]: seconds from the start of the job to the end of line i
+    - total: estimated run time in seconds
+    """
+
+    def __init__(self, line_end, profile):
+        self.line_end = line_end
+        self.total = float(line_end[-1]) if len(line_end) else 0.0
+        self.profile = profile
+
+    def elapsed(self, index):
+        """Estimated seconds to the end of line index (-1 = nothing run yet)."""
+        if index < 0 or not len(self.line_end):
+            return 0.0
+        return float(self.line_end[min(index, len(self.line_end) - 1)])
+
+    def remaining(self, index):
+        return self.total - self.elapsed(index)
+
+    def fraction(self, index):
+        """Share of the run time done at the end of line index, 0..1."""
+        return self.elapsed(index) / self.total if self.total else 0.0
+
+    def summary(self):
+        return f"Estimated run time: {format_duration(self.total)}"
+
+
+def _axis_limit(limits, inverse):
+    """Per-segment limit along unit vectors given as 1/|u| (3, n): min over axes of limit / |u|."""
+    out = limits[0] * inverse[0]
+    np.minimum(out, limits[1] * inverse[1], out=out)
+    np.minimum(out, limits[2] * inverse[2], out=out)
+    return out
+
+
+def _inverse(u):
+    """1/|u| (3, n), inf where a component is 0."""
+    out = np.abs(u)
+    with np.errstate(divide="ignore"):
+        np.reciprocal(out, out=out)
+    return out
+
+
+def _norm(v):
+    """Column lengths of v (3, n)."""
+    out = v[0] * v[0]
+    out += v[1] * v[1]
+    out += v[2] * v[2]
+    return np.sqrt(out, out=out)
+
+
+def estimate_program(program, settings=None):
+    """
+    TimeEstimate of a GcodeProgram with the given $$ settings or profile
+    (missing entries fall back to GRBL's defaults).
+    """
+    profile = normalize_profile(settings)
+    vmax = np.array([profile[110], profile[111], profile[112]]) / 60.0  # mm/s
+    amax = np.array([profile[120], profile[121], profile[122]])         # mm/s^2
+    deviation = profile[11]
+
+    rec = program.records
+    n_lines = len(rec)
+    line_time = np.zeros(n_lines)
+    moves = program.moves()
+    if not len(moves):
+        return TimeEstimate(np.cumsum(line_time), profile)
+
+    # Axis-major (3, n) arrays keep every per-axis operation on contiguous rows;
+    # one (3, n + 1) buffer holds the start (origin, then every end) and end points
+    flags = rec["flags"]
+    points = np.zeros((3, len(moves) + 1))
+    for a, axis in enumerate("xyz"):
+        np.take(rec[axis], moves, out=points[a, 1:])
+    inches = (flags[moves] & FLAG_INCHES) != 0
+    scale = np.where(inches, 25.4, 1.0) if inches.any() else np.ones(len(moves))
+    if inches.any():
+        points[:, 1:] *= scale
+    start, end = points[:, :-1], points[:, 1:]
+    motion = rec["motion"][moves]
+
+    u = end - start
+    length = _norm(u)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        u /= length
+    zero = length == 0
+    if zero.any():
+        u[:, zero] = 0.0
+
+    # Arcs: true length, and GRBL's chordal segments cap the speed at sqrt(a * r)
+    arc_radius = None
+    arcs = np.flatnonzero((motion == 2) | (motion == 3))
+    if len(arcs):
+        arc_radius = np.full(len(moves), np.nan)
+        arc = arc_geometry(program.lines, moves[arcs], start[:, arcs], end[:, arcs], motion[arcs], scale[arcs])
+        arc_length = np.hypot(arc.radius * arc.sweep, end[2, arcs] - start[2, arcs])
+        length[arcs] = np.where(arc.valid, arc_length, length[arcs])
+        arc_radius[arcs] = np.where(arc.valid, arc.radius, np.nan)
+        zero = arcs[(length[arcs] > 0) & np.all(u[:, arcs] == 0, axis=0)]
+        u[:, zero] = np.array([[np.sqrt(0.5)], [np.sqrt(0.5)], [0.0]])  # full circles: no chord, limit by X and Y
+    del points, start, end
+
+    # GRBL drops zero-length blocks
+    seg_lines = moves
+    if len(arcs):
+        zero = length == 0
+    if zero.any():
+        keep = np.flatnonzero(~zero)
+        seg_lines = moves[keep]
+        u, length, motion, scale = u.take(keep, axis=1), length[keep], motion[keep], scale[keep]
+        if arc_radius is not None:
+            arc_radius = arc_radius[keep]
+    n = len(seg_lines)
+    if not n:
+        return TimeEstimate(np.cumsum(line_time), profile)
+    feed = rec["feed"][seg_lines] * (scale / 60.0)
+
+    # Nominal speed and acceleration along each segment
+    inverse = _inverse(u)
+    nominal = _axis_limit(vmax, inverse)
+    accel = _axis_limit(amax, inverse)
+    del inverse
+    feeding = (motion > 0) & (feed > 0)
+    np.minimum(nominal, feed, out=nominal, where=feeding)
+    if arc_radius is not None:
+        np.fmin(nominal, np.sqrt(accel * arc_radius), out=nominal)  # NaN radius = not an arc
+
+    # Junction speeds^2 at the n+1 nodes (start and end of job are stops)
+    junction = np.zeros(n + 1)
+    if n > 1:
+        u0, u1 = u[:, :-1], u[:, 1:]
+        cos_theta = np.einsum("ij,ij->j", u0, u1)
+        np.negative(cos_theta, out=cos_theta)
+        # acceleration along the junction vector u1 - u0, without normalizing it:
+        # min over axes of a / |j_a / |j||  =  |j| * min over axes of a / |j_a|
+        jvec = u1 - u0
+        norm = _norm(jvec)
+        a_junction = _axis_limit(amax, _inverse(jvec))
+        del jvec
+        with np.errstate(invalid="ignore"):
+            a_junction *= norm  # inf * 0 on straight junctions, set below
+        del norm
+        sin_half = 1.0 - cos_theta
+        sin_half *= 0.5
+        np.clip(sin_half, 0.0, 1.0, out=sin_half)
+        np.sqrt(sin_half, out=sin_half)
+        vj2 = a_junction
+        vj2 *= deviation
+        vj2 *= sin_half
+        with np.errstate(invalid="ignore", divide="ignore"):
+            vj2 /= 1.0 - sin_half
+        vj2[cos_theta < -COS_STRAIGHT] = np.inf
+        vj2[cos_theta > COS_STRAIGHT] = MIN_JUNCTION_SPEED ** 2
+        np.maximum(vj2, MIN_JUNCTION_SPEED ** 2, out=vj2)
+        cap = np.minimum(nominal[:-1], nominal[1:])
+        cap *= cap
+        np.minimum(vj2, cap, out=vj2)
+
+        # Standalone M/S/G4... lines between two moves make GRBL finish the motion first
+        sync = np.flatnonzero((flags & (FLAG_OTHER | FLAG_XYZ)) == FLAG_OTHER)
+        if len(sync):
+            after = np.searchsorted(seg_lines, sync)  # junction after segment after-1
+            vj2[after[(after > 0) & (after < n)] - 1] = 0.0
+        junction[1:-1] = vj2
+
+    # Forward then backward passes: w[i+1] <= w[i] + 2 a L, solved in closed form
+    # with prefix sums, w[i] = P[i] + min_{j<=i}(J[j] - P[j]), and mirrored backwards
+    reach = accel * length
+    reach *= 2.0
+    prefix = np.zeros(n + 1)
+    np.cumsum(reach, out=prefix[1:])
+    junction -= prefix
+    forward = np.minimum.accumulate(junction)
+    forward += prefix
+    forward += prefix
+    speed2 = np.minimum.accumulate(forward[::-1])[::-1]
+    speed2 -= prefix
+    np.maximum(speed2, 0.0, out=speed2)
+
+    # Trapezoid (or triangle) per segment:
+    # t = (2 peak - vi - vf) / a + cruise / peak
+    vi2, vf2 = speed2[:-1], speed2[1:]
+    peak2 = reach + vi2
+    peak2 += vf2
+    peak2 *= 0.5
+    np.minimum(peak2, nominal * nominal, out=peak2)
+    np.maximum(peak2, np.maximum(vi2, vf2), out=peak2)
+    cruise = vi2 + vf2
+    cruise -= peak2
+    cruise -= peak2
+    cruise /= 2.0 * accel
+    cruise += length
+    np.maximum(cruise, 0.0, out=cruise)
+    peak = np.sqrt(peak2)
+    speed = np.sqrt(speed2)
+    seconds = peak + peak
+    seconds -= speed[:-1]
+    seconds -= speed[1:]
+    seconds /= accel
+    with np.errstate(invalid="ignore", divide="ignore"):
+        cruise /= peak
+    cruise[peak <= 0] = 0.0
+    seconds += cruise
+    line_time[seg_lines] = seconds
+    return TimeEstimate(np.cumsum(line_time), profile)
@@ -0,0 +1,1251 @@
+# pilotx_gcode.py
+# G-code file handling for PilotX that does not need the GUI:
+# loading/cleaning programs, compiling them once into NumPy arrays that the
+# sender, visualizer and auto-level code share, decimating and compacting
+# lines before they are streamed, resuming part way through, checking a
+# program against the machine travel and applying height maps.
+#
+# Files are memory-mapped: only a line-offset index is kept in memory and each
+# line is decoded when the sender or viewer asks for it.
+
+import mmap
+import os
+import re
+import threading
+from array import array
+from collections import namedtuple
+from itertools import islice
+from math import floor
+
+import numpy as np  # numpy library is needed
+
+# ------------------------- Program Representation -------------------------
+# Per-line flags
+FLAG_X = 0x01            # line has an X target
+FLAG_Y = 0x02            # line has a Y target
+FLAG_Z = 0x04            # line has a Z target
+FLAG_F = 0x08            # line has an F word
+FLAG_MOTION_WORD = 0x10  # line states G0/G1/G2/G3 explicitly
+FLAG_ABSOLUTE = 0x20     # G90 in effect after the line
+FLAG_INCHES = 0x40       # G20 in effect after the line
+FLAG_OTHER = 0x80        # line has words besides G0-G3, X/Y/Z, F and N (M, S, G90, ...)
+FLAG_XYZ = FLAG_X | FLAG_Y | FLAG_Z
+
+MOTION_NONE = -1  # no G0/G1/G2/G3 seen yet
+
+# Modal spindle/coolant/work offset/plane/feed mode bits
+MODE_SPINDLE_CW = 0x01   # M3
+MODE_SPINDLE_CCW = 0x02  # M4
+MODE_MIST = 0x04         # M7
+MODE_FLOOD = 0x08        # M8
+MODE_WCS_SHIFT = 4       # bits 4-6: work offset, 0 = G54 .. 5 = G59
+MODE_PLANE_SHIFT = 7     # bits 7-8: arc plane, 0 = G17, 1 = G18, 2 = G19
+MODE_INVERSE_TIME = 0x200  # G93
+MODE_SPINDLE = MODE_SPINDLE_CW | MODE_SPINDLE_CCW
+MODE_COOLANT = MODE_MIST | MODE_FLOOD
+MODE_WCS = 0x70
+MODE_PLANE = 0x180
+
+# M word -> (bits cleared, bits set); M2/M30 end the program: M5, M9, G54, G17, G94
+_M_MODES = {3.0: (MODE_SPINDLE, MODE_SPINDLE_CW), 4.0: (MODE_SPINDLE, MODE_SPINDLE_CCW),
+            5.0: (MODE_SPINDLE, 0), 7.0: (0, MODE_MIST), 8.0: (0, MODE_FLOOD), 9.0: (MODE_COOLANT, 0),
+            2.0: (0xFFFF, 0), 30.0: (0xFFFF, 0)}
+
+# One record per streamed line. x/y/z/feed/motion/modes/speed are the modal state after the line.
+PROGRAM_DTYPE = np.dtype([
+    ("motion", np.int8),   # G0..G3 in effect, MOTION_NONE before the first one
+    ("x", np.float64),     # absolute target (G91 moves are accumulated)
+    ("y", np.float64),
+    ("z", np.float64),
+    ("feed", np.float32),  # modal feed rate
+    ("speed", np.float32), # modal spindle speed (S)
+    ("flags", np.uint8),   # FLAG_* bits
+    ("modes", np.uint16),  # MODE_* bits: spindle, coolant, work offset, plane, G93
+    ("src", np.int64),     # 1-based line number in the source file, 0 for injected lines
+])
+
+# Axis words on these lines are not program targets (dwell, offsets, homing, machine coords)
+NON_TARGET_G = (4.0, 10.0, 28.0, 30.0, 53.0, 92.0)
+
+_COMMENT_RE = re.compile(r"\([^)]*\)")
+_WORD_RE = re.compile(r"([A-Z])\s*([-+]?(?:\d+\.?\d*|\.\d+))")
+# Byte classes of "simple" lines (G0-G3/X/Y/Z/F/N words only): 0 = anything else
+_SIMPLE_CLASS = np.zeros(256, dtype=np.int8)
+_SIMPLE_CLASS[np.frombuffer(b" \t", dtype=np.uint8)] = 1
+_SIMPLE_CLASS[10] = 2
+_SIMPLE_CLASS[np.frombuffer(b"0123456789.+-", dtype=np.uint8)] = 3
+_SIMPLE_CLASS[np.frombuffer(b"GXYZFN", dtype=np.uint8)] = 4
+_SIMPLE_KIND = np.zeros(256, dtype=np.int8)  # letter -> 0..5 for G X Y Z F N
+_SIMPLE_KIND[np.frombuffer(b"GXYZFN", dtype=np.uint8)] = np.arange(6)
+_SIMPLE_BLANKS = bytes.maketrans(b"GXYZFN\t\n", b"        ")
+_Z_WORD_RE = re.compile(r"(Z)-?\d+\.?\d*", flags=re.IGNORECASE)
+_ARC_WORD_RE = re.compile(r"([IJR])\s*([-+]?(?:\d+\.?\d*|\.\d+))")
+
+INDEX_CHUNK = 1 << 22        # bytes scanned per indexing step (4 MB)
+PROGRESS_EVERY = 100000      # lines parsed between progress callbacks
+SIMPLE_RUN = 32              # runs of simple lines at least this long are compiled as arrays
+_WHITESPACE = np.array([9, 10, 11, 12, 13, 32], dtype=np.uint8)
+
+
+class GcodeProgram:
+    """
+    A program compiled once at load time.
+    - lines: the text lines exactly as they are streamed
+    - records: PROGRAM_DTYPE array, records[i] describes lines[i]
+    """
+
+    def __init__(self, lines, records, path=None):
+        self.lines = lines
+        self.records = records
+        self.path = path
+
+    def __len__(self):
+        return len(self.lines)
+
+    def moves(self):
+        """Indices of the lines that carry an X/Y/Z target."""
+        return np.flatnonzero(self.records["flags"] & FLAG_XYZ)
+
+    def index_of_line(self, line):
+        """Index of the first streamed line at or after 1-based source line `line`."""
+        return int(np.searchsorted(self.records["src"], line))
+
+
+def compile_program(lines, src=None, path=None, progress=None):
+    """
+    Parse every line once into a GcodeProgram. src gives source line numbers (default 1..n).
+    progress(stage, done, total) is called every PROGRESS_EVERY lines with stage "Parsing".
+
+    Runs of plain [G0-G3] X Y Z F lines, the bulk of CAM output, are found and
+    compiled with array operations a chunk at a time; every other line goes
+    through the word loop (~200k lines/s, against ~450k/s for the runs).
+    """
+    total = len(lines)
+    records = np.zeros(total, dtype=PROGRAM_DTYPE)
+    # motion, x, y, z, feed, speed, modes, absolute, inches
+    state = (MOTION_NONE, 0.0, 0.0, 0.0, 0.0, 0.0, 0, True, False)
+    it = iter(lines)
+    done = 0
+    while done < total:
+        if progress is not None:
+            progress("Parsing", done, total)
+        chunk = list(islice(it, PROGRESS_EVERY))
+        if not chunk:
+            break
+        state = _compile_chunk(chunk, records[done:done + len(chunk)], state)
+        done += len(chunk)
+    if total:
+        records["src"] = np.arange(1, total + 1) if src is None else src
+    if progress is not None:
+        progress("Parsing", total, total)
+    return GcodeProgram(lines, records, path)
+
+
+def _compile_chunk(chunk, out, state):
+    """Fill out (records of chunk) from the modal state before it; returns the state after it."""
+    text = "\n".join(chunk).upper()
+    ups = text.split("\n")
+    words = _simple_words(text, len(chunk)) if len(ups) == len(chunk) >= SIMPLE_RUN else None
+    if words is None:
+        return _compile_lines(ups if len(ups) == len(chunk) else [line.upper() for line in chunk], out, state)
+
+    at = 0
+    for a, b in _long_runs(words[0]):
+        if at < a:
+            state = _compile_lines(ups[at:a], out[at:a], state)
+        state = _compile_simple([w[a:b] for w in words[1:]], out[a:b], state)
+        at = b
+    if at < len(chunk):
+        state = _compile_lines(ups[at:], out[at:], state)
+    return state
+
+
+def _long_runs(simple):
+    """[start, end) of the runs of at least SIMPLE_RUN True values."""
+    edges = np.flatnonzero(np.diff(np.concatenate(([False], simple, [False])).astype(np.int8)))
+    starts, ends = edges[::2], edges[1::2]
+    long_runs = (ends - starts) >= SIMPLE_RUN
+    return list(zip(starts[long_runs].tolist(), ends[long_runs].tolist()))
+
+
+def _simple_words(text, count):
+    """
+    Split count upper-cased lines joined by newlines into "simple" lines, made
+    only of G0-G3/X/Y/Z/F/N words each at most once with plain numbers, and
+    the rest, with array operations on the bytes. Returns (simple, g,
+    g_present, x, x_present, y, ..., f, f_present) as arrays over the lines,
+    or None if the text is not ASCII or long runs of simple lines do not
+    make up half of it.
+    """
+    try:
+        raw = text.encode("ascii")
+    except UnicodeEncodeError:
+        return None
+    buf = np.frombuffer(raw, dtype=np.uint8)
+    newlines = np.flatnonzero(buf == 10)
+    lengths = np.diff(np.append(newlines, len(buf) - 1), prepend=-1)  # with the newline
+    simple = np.ones(count, dtype=bool)
+
+    # other bytes: blank their lines, the word loop reads them
+    cls = _SIMPLE_CLASS[buf]
+    simple[np.searchsorted(newlines, np.flatnonzero(cls == 0))] = False
+    if sum(b - a for a, b in _long_runs(simple)) < count // 2:
+        return None  # mostly other lines or short runs: not worth it
+    if not simple.all():
+        cls[np.repeat(~simple, lengths)] = 1
+
+    # a word is a letter, then spaces, then one run of number bytes
+    letters = np.flatnonzero(cls == 4)
+    number = cls == 3
+    numbers = np.flatnonzero(number & ~np.concatenate(([False], number[:-1])))
+    blanked = np.where(cls == 1, 32, buf).astype(np.uint8).tobytes().translate(_SIMPLE_BLANKS)
+    try:
+        value = np.array(blanked.split(), dtype=np.float64)
+    except ValueError:  # "1.2.3", "-", ...: find them one by one
+        value = np.array([_float_or_nan(v) for v in blanked.split()])
+        simple[np.searchsorted(newlines, numbers[np.isnan(value)])] = False
+    letter_line = np.searchsorted(newlines, letters)
+    number_line = np.searchsorted(newlines, numbers)
+    simple[np.bincount(letter_line, minlength=count) != np.bincount(number_line, minlength=count)] = False
+    keep_letter = simple[letter_line]
+    letters, letter_line = letters[keep_letter], letter_line[keep_letter]
+    keep_number = simple[number_line]
+    numbers, value = numbers[keep_number], value[keep_number]
+    # same count on every line left: letter k must come before number k, number k before letter k + 1
+    simple[letter_line[letters > numbers]] = False
+    simple[letter_line[1:][numbers[:-1] > letters[1:]]] = False
+
+    kind = _SIMPLE_KIND[buf[letters]]
+    # a G word other than G0-G3, or a word twice: the word loop decides
+    simple[letter_line[(kind == 0) & ~np.isin(value, (0.0, 1.0, 2.0, 3.0))]] = False
+    simple[np.flatnonzero(np.bincount(letter_line * 6 + kind, minlength=count * 6) > 1) // 6] = False
+
+    out = [simple]
+    for k in range(5):  # N is only a label
+        mine = kind == k
+        values = np.full(count, np.nan)
+        present = np.zeros(count, dtype=bool)
+        values[letter_line[mine]] = value[mine]
+        present[letter_line[mine]] = True
+        out += [values, present & simple]
+    return out
+
+
+def _float_or_nan(text):
+    try:
+        return float(text)
+    except ValueError:
+        return float("nan")
+
+
+def _carry(values, present, before):
+    """Modal value after each line: the last value stated so far, else before."""
+    last = np.where(present, np.arange(len(values)), -1)
+    np.maximum.accumulate(last, out=last)
+    return np.where(last >= 0, values[last], before)
+
+
+def _compile_simple(words, out, state):
+    """Compile a run of simple lines from their _simple_words() columns."""
+    motion, x, y, z, feed, speed, modes, absolute, inches = state
+    g, has_g, xs, has_x, ys, has_y, zs, has_z, fs, has_f = words
+    flags = np.where(has_g, FLAG_MOTION_WORD, 0)
+    flags |= (FLAG_ABSOLUTE if absolute else 0) | (FLAG_INCHES if inches else 0)
+    out["motion"] = _carry(g, has_g, motion)
+    positions = []
+    for values, present, before, bit, field in ((xs, has_x, x, FLAG_X, "x"), (ys, has_y, y, FLAG_Y, "y"),
+                                                (zs, has_z, z, FLAG_Z, "z")):
+        if absolute:
+            pos = _carry(values, present, before)
+        else:
+            pos = np.cumsum(np.concatenate(([before], np.where(present, values, 0.0))))[1:]
+        out[field] = pos
+        positions.append(float(pos[-1]))
+        flags |= np.where(present, bit, 0)
+    feeds = _carry(fs, has_f, feed)
+    out["feed"] = feeds
+    flags |= np.where(has_f, FLAG_F, 0)
+    out["speed"] = speed
+    out["flags"] = flags
+    out["modes"] = modes
+    return (int(out["motion"][-1]), positions[0], positions[1], positions[2], float(feeds[-1]),
+            speed, modes, absolute, inches)
+
+
+def _compile_lines(ups, out, state):
+    """Compile upper-cased lines one by one (any G-code the program format tracks)."""
+    motion, x, y, z, feed, speed, modes, absolute, inches = state
+    motion_a = array('b')
+    x_a, y_a, z_a, feed_a, speed_a = array('d'), array('d'), array('d'), array('d'), array('d')
+    flags_a, modes_a = array('B'), array('H')
+
+    for up in ups:
+        if "(" in up:
+            up = _COMMENT_RE.sub(" ", up)
+        if ";" in up:
+            up = up.split(";", 1)[0]
+        flags = 0
+        nx = ny = nz = None
+        targets = True
+        for letter, value in _WORD_RE.findall(up):
+            if letter == "G":
+                g = float(value)
+                if g in (0.0, 1.0, 2.0, 3.0):
+                    motion = int(g)
+                    flags |= FLAG_MOTION_WORD
+                elif g == 90.0:
+                    absolute = True
+                elif g == 91.0:
+                    absolute = False
+                elif g == 20.0:
+                    inches = True
+                elif g == 21.0:
+                    inches = False
+                elif g in NON_TARGET_G:
+                    targets = False
+                elif g in (54.0, 55.0, 56.0, 57.0, 58.0, 59.0):
+                    modes = (modes & ~MODE_WCS) | (int(g) - 54) << MODE_WCS_SHIFT
+                elif g in (17.0, 18.0, 19.0):
+                    modes = (modes & ~MODE_PLANE) | (int(g) - 17) << MODE_PLANE_SHIFT
+                elif g == 93.0:
+                    modes |= MODE_INVERSE_TIME
+                elif g == 94.0:
+                    modes &= ~MODE_INVERSE_TIME
+                if g not in (0.0, 1.0, 2.0, 3.0):
+                    flags |= FLAG_OTHER
+            elif letter == "X":
+                nx = float(value)
+            elif letter == "Y":
+                ny = float(value)
+            elif letter == "Z":
+                nz = float(value)
+            elif letter == "F":
+                feed = float(value)
+                flags |= FLAG_F
+            elif letter != "N":
+                flags |= FLAG_OTHER
+                if letter == "S":
+                    speed = float(value)
+                elif letter == "M":
+                    change = _M_MODES.get(float(value))
+                    if change is not None:
+                        modes = (modes & ~change[0]) | change[1]
+
+        if targets:
+            if nx is not None:
+                x = nx if absolute else x + nx
+                flags |= FLAG_X
+            if ny is not None:
+                y = ny if absolute else y + ny
+                flags |= FLAG_Y
+            if nz is not None:
+                z = nz if absolute else z + nz
+                flags |= FLAG_Z
+        if absolute:
+            flags |= FLAG_ABSOLUTE
+        if inches:
+            flags |= FLAG_INCHES
+
+        motion_a.append(motion)
+        x_a.append(x)
+        y_a.append(y)
+        z_a.append(z)
+        feed_a.append(feed)
+        speed_a.append(speed)
+        flags_a.append(flags)
+        modes_a.append(modes)
+
+    if ups:
+        out["motion"] = np.frombuffer(motion_a, dtype=np.int8)
+        out["x"] = np.frombuffer(x_a, dtype=np.float64)
+        out["y"] = np.frombuffer(y_a, dtype=np.float64)
+        out["z"] = np.frombuffer(z_a, dtype=np.float64)
+        out["feed"] = np.frombuffer(feed_a, dtype=np.float64)
+        out["speed"] = np.frombuffer(speed_a, dtype=np.float64)
+        out["flags"] = np.frombuffer(flags_a, dtype=np.uint8)
+        out["modes"] = np.frombuffer(modes_a, dtype=np.uint16)
+    return motion, x, y, z, feed, speed, modes, absolute, inches
+
+
+def toolpath_runs(program):
+    """
+    Points of every line with an X/Y/Z target, split into continuous runs of
+    rapids (G0) and cuts (G1/G2/G3), for drawing the toolpath.
+    Returns (pts (n, 3), rapid (n,) bool, starts, ends); run k is pts[starts[k]:ends[k]].
+    """
+    rec = program.records
+    moves = program.moves()
+    pts = np.column_stack((rec["x"][moves], rec["y"][moves], rec["z"][moves]))
+    rapid = rec["motion"][moves] == 0
+    breaks = np.flatnonzero(rapid[1:] != rapid[:-1]) + 1
+    starts = np.concatenate(([0], breaks))
+    ends = np.concatenate((breaks, [len(moves)]))
+    return pts, rapid, starts, ends
+
+
+def toolpath_segments(pts, rapid):
+    """
+    toolpath_runs() points as line segments for one collection per kind:
+    (cuts (m, 2, 3), rapids (k, 2, 3), single_cuts, single_rapids), where the
+    singles are the points of one-point runs, drawn as markers.
+    """
+    same = rapid[1:] == rapid[:-1]
+    lone = np.ones(len(pts), dtype=bool)
+    lone[1:] &= ~same
+    lone[:-1] &= ~same
+
+    def pairs(mask):
+        i = np.flatnonzero(mask)
+        return np.stack((pts[i], pts[i + 1]), axis=1)
+    return (pairs(same & ~rapid[1:]), pairs(same & rapid[1:]),
+            pts[lone & ~rapid], pts[lone & rapid])
+
+
+ArcGeometry = namedtuple("ArcGeometry", "centre radius start_angle sweep valid")
+
+
+def arc_geometry(lines, index, start, end, motion, scale):
+    """
+    Centres (n, 2), radii, start angles and swept angles (always positive,
+    clockwise for G2) of G2/G3 moves in the XY plane, from their I/J or R words.
+    index: program lines of the arcs; start/end: (3, n) positions in mm;
+    scale: mm per program unit of each line. Only these lines are read as text;
+    valid is False for arcs with neither I/J nor R.
+    """
+    n = len(index)
+    ij = np.zeros((n, 2))
+    r = np.full(n, np.nan)
+    has_ij = np.zeros(n, dtype=bool)
+    for k, i in enumerate(index.tolist()):
+        up = lines[i].upper()
+        if "(" in up:
+            up = _COMMENT_RE.sub(" ", up)
+        for letter, value in _ARC_WORD_RE.findall(up.split(";", 1)[0]):
+            if letter == "R":
+                r[k] = float(value)
+            else:
+                ij[k, 0 if letter == "I" else 1] = float(value)
+                has_ij[k] = True
+    ij *= scale[:, None]
+    r *= scale
+
+    s, e = start[:2].T, end[:2].T
+    d = e - s
+    chord = np.hypot(d[:, 0], d[:, 1])
+    cw = motion == 2
+
+    # R format: centre from GRBL's construction (negative R = the long way round)
+    use_r = ~has_ij & ~np.isnan(r)
+    radius_r = np.abs(np.nan_to_num(r))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        h = -np.sqrt(np.maximum(4 * radius_r ** 2 - chord ** 2, 0.0)) / chord
+    h = np.where(cw, h, -h)
+    h = np.where(np.nan_to_num(r) < 0, -h, h)
+    ij_r = 0.5 * np.column_stack((d[:, 0] - d[:, 1] * h, d[:, 1] + d[:, 0] * h))
+    ij = np.where(use_r[:, None], np.nan_to_num(ij_r), ij)
+
+    centre = s + ij
+    a0 = np.arctan2(s[:, 1] - centre[:, 1], s[:, 0] - centre[:, 0])
+    a1 = np.arctan2(e[:, 1] - centre[:, 1], e[:, 0] - centre[:, 0])
+    sweep = np.where(cw, a0 - a1, a1 - a0)
+    sweep = np.where(sweep <= 1e-9, sweep + 2 * np.pi, sweep)  # same start and end = full circle
+    radius = np.hypot(ij[:, 0], ij[:, 1])
+    return ArcGeometry(centre, radius, a0, sweep, has_ij | use_r)
+
+
+# ------------------------- Loading -------------------------
+class MappedLines:
+    """
+    Read-only sequence of program lines backed by a memory-mapped file.
+    Only the byte offsets of the kept lines live in memory (starts/ends, int64);
+    a line is decoded and rstripped when it is asked for. prefix lines
+    (e.g. the injected G90) come before the file's lines.
+    """
+
+    def __init__(self, path, starts, ends, prefix=()):
+        self.path = path
+        self.starts = starts
+        self.ends = ends
+        self.prefix = list(prefix)
+        self._file = open(path, "rb")
+        if len(starts):
+            self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self._mm = b""
+
+    def __len__(self):
+        return len(self.prefix) + len(self.starts)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        n = len(self)
+        if i < 0:
+            i += n
+        if not 0 <= i < n:
+            raise IndexError("line index out of range")
+        if i < len(self.prefix):
+            return self.prefix[i]
+        i -= len(self.prefix)
+        return self._mm[int(self.starts[i]):int(self.ends[i])].decode('utf-8', errors='ignore').rstrip()
+
+    def __iter__(self):
+        yield from self.prefix
+        mm = self._mm
+        # decode in blocks so iterating never materializes the whole offset index as Python ints
+        for a in range(0, len(self.starts), PROGRESS_EVERY):
+            for s, e in zip(self.starts[a:a + PROGRESS_EVERY].tolist(), self.ends[a:a + PROGRESS_EVERY].tolist()):
+                yield mm[s:e].decode('utf-8', errors='ignore').rstrip()
+
+    def close(self):
+        if isinstance(self._mm, mmap.mmap):
+            self._mm.close()
+        self._file.close()
+
+
+def index_gcode_file(path, progress=None):
+    """
+    Build the line-offset index of a G-code file without reading it into Python strings.
+    Returns (starts, ends, numbers) for every line that is not empty and not a ';' comment;
+    numbers are 1-based source line numbers. progress(stage, done, total) is called
+    per INDEX_CHUNK with stage "Indexing" and byte counts.
+    """
+    size = os.path.getsize(path)
+    empty = np.zeros(0, dtype=np.int64)
+    if size == 0:
+        return empty, empty, empty
+
+    with open(path, "rb") as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            buf = np.frombuffer(mm, dtype=np.uint8)
+            newline_parts = []
+            for a in range(0, size, INDEX_CHUNK):
+                if progress is not None:
+                    progress("Indexing", a, size)
+                b = min(size, a + INDEX_CHUNK)
+                newline_parts.append(np.flatnonzero(buf[a:b] == 10) + a)
+            newlines = np.concatenate(newline_parts) if newline_parts else empty
+
+            starts = np.concatenate(([0], newlines + 1))
+            ends = np.concatenate((newlines, [size]))
+            if starts[-1] >= size:
+                # file ends with a newline: no trailing line
+                starts = starts[:-1]
+                ends = ends[:-1]
+
+            # Lines are kept unless blank or a ';' comment. Most lines start with a
+            # non-blank byte and are decided from it; indented lines are checked one by one.
+            nonempty = starts < ends
+            first = np.zeros(len(starts), dtype=np.uint8)
+            first[nonempty] = buf[starts[nonempty]]
+            indented = nonempty & np.isin(first, _WHITESPACE)
+            keep = nonempty & ~indented & (first != ord(';'))
+            for i in np.flatnonzero(indented).tolist():
+                text = mm[int(starts[i]):int(ends[i])].strip()
+                if text and not text.startswith(b';'):
+                    keep[i] = True
+            del buf, first
+        finally:
+            mm.close()
+
+    if progress is not None:
+        progress("Indexing", size, size)
+    numbers = np.flatnonzero(keep) + 1
+    return starts[keep], ends[keep], numbers
+
+
+def load_gcode_lines(path, progress=None):
+    """
+    Open a G-code file the way the sender streams it:
+    empty lines and ';' comments removed, G90 injected at the start.
+    Returns a MappedLines sequence; lines are decoded on access.
+    """
+    starts, ends, _ = index_gcode_file(path, progress)
+    return MappedLines(path, starts, ends, prefix=["G90"])
+
+
+def load_gcode_program(path, progress=None):
+    """load_gcode_lines() + compile_program(), keeping each line's source line number."""
+    starts, ends, numbers = index_gcode_file(path, progress)
+    lines = MappedLines(path, starts, ends, prefix=["G90"])
+    src = np.concatenate(([0], numbers))
+    return compile_program(lines, src=src, path=path, progress=progress)
+
+
+# ------------------------- Compaction -------------------------
+# Optional byte reduction before streaming. Each line is rewritten to the
+# shortest text GRBL executes identically: comments and spaces dropped,
+# modal words that repeat the state in effect elided, numbers rounded to
+# the compaction resolution (except G91 axis words: relative moves would add
+# up the rounding error). Lines are never added or removed, so index i of the
+# compacted program is still line i of the GcodeProgram.
+
+ROUNDED_WORDS = "XYZABCIJKRF"   # values rounded to the resolution
+_AXIS_WORDS = "XYZABC"
+_COMPACT_WORD_RE = re.compile(r"([A-Z])([-+]?(?:\d+\.?\d*|\.\d+))")
+
+# Modal G groups whose repeats can be elided
+_G_GROUP = {0.0: "motion", 1.0: "motion", 2.0: "motion", 3.0: "motion",
+            38.2: "motion", 38.3: "motion", 38.4: "motion", 38.5: "motion", 80.0: "motion",
+            17.0: "plane", 18.0: "plane", 19.0: "plane",
+            20.0: "units", 21.0: "units",
+            90.0: "distance", 91.0: "distance",
+            93.0: "feedmode", 94.0: "feedmode"}
+# G words after which the work position is no longer known from the program text
+_G_MOVES_ORIGIN = (10.0, 28.0, 30.0, 43.1, 49.0, 53.0, 54.0, 55.0, 56.0, 57.0, 58.0, 59.0,
+                   92.0, 92.1)
+
+
+def _decimals(resolution):
+    text = f"{resolution:.10f}".rstrip("0")
+    return len(text.split(".")[1]) if "." in text else 0
+
+
+def _format_number(value, resolution, decimals):
+    """Round to resolution and print without trailing or leading zeros ("-0.50" -> "-.5")."""
+    text = f"{round(value / resolution) * resolution:.{decimals}f}"
+    if "." in text:
+        text = text.rstrip("0").rstrip(".")
+    if text in ("-0", ""):
+        return "0"
+    if text.startswith("0."):
+        return text[1:]
+    if text.startswith("-0."):
+        return "-" + text[2:]
+    return text
+
+
+def _format_code(value):
+    """G01 -> G1, M03 -> M3, 38.20 -> 38.2."""
+    v = float(value)
+    return str(int(v)) if v == int(v) else f"{v:g}"
+
+
+class CompactState:
+    """Modal state seen by the compactor. None = unknown, nothing is elided against it."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.modes = {}
+        self.feed = None
+        self.pos = {}
+
+    def forget_position(self):
+        self.pos = {}
+
+
+def compact_line(line, state, resolution=0.001):
+    """
+    Shortest equivalent of one G-code line given the modal state before it
+    (updated in place). resolution is in mm; inch programs are rounded 100x finer.
+    Lines the compactor does not understand (system commands, parameters,
+    expressions) only lose their comments and forget the state. Every line is
+    assumed to be accepted: after an error: the elided words may be missing.
+    """
+    up = line.upper()
+    if "(" in up:
+        up = _COMMENT_RE.sub("", up)
+    if ";" in up:
+        up = up.split(";", 1)[0]
+    text = "".join(up.split())
+    if not text:
+        return ""
+    words = _COMPACT_WORD_RE.findall(text)
+    if text[0] == "$" or sum(len(l) + len(v) for l, v in words) != len(text):
+        state.reset()
+        return up.strip()
+
+    gs = [float(v) for l, v in words if l == "G"]
+    special = any(g not in _G_GROUP for g in gs)  # non-modal or untracked G words: no elision
+    new = {}
+    for g in gs:
+        if g in _G_GROUP:
+            new[_G_GROUP[g]] = g
+    if "units" in new and state.modes.get("units") != new["units"]:
+        state.feed = None  # F and positions now mean other units
+        state.forget_position()
+    if "feedmode" in new and state.modes.get("feedmode") != new["feedmode"]:
+        state.feed = None  # GRBL drops the feed rate when G93/G94 changes
+    motion = new.get("motion", state.modes.get("motion"))
+    distance = new.get("distance", state.modes.get("distance"))
+    feedmode = new.get("feedmode", state.modes.get("feedmode"))
+    if new.get("units", state.modes.get("units")) == 20.0:
+        resolution /= 100.0
+    decimals = _decimals(resolution)
+    linear = not special and distance == 90.0 and motion in (0.0, 1.0)
+    tracked = distance == 90.0 and motion in (0.0, 1.0, 2.0, 3.0)  # target is where the move ends
+
+    out = []
+    for letter, value in words:
+        if letter == "G":
+            g = float(value)
+            group = _G_GROUP.get(g)
+            if group is not None and not special and state.modes.get(group) == g:
+                continue
+            if group is not None:
+                state.modes[group] = g
+            out.append("G" + _format_code(value))
+        elif letter == "M":
+            out.append("M" + _format_code(value))
+        elif letter == "F":
+            f = _format_number(float(value), resolution, decimals)
+            if feedmode != 93.0 and not special and state.feed == f:
+                continue
+            state.feed = f if feedmode != 93.0 else None
+            out.append("F" + f)
+        elif letter in _AXIS_WORDS and distance == 91.0:
+            if not special:
+                state.pos[letter] = None
+            out.append(letter + value)  # unrounded: the error would accumulate over the job
+        elif letter in ROUNDED_WORDS:
+            v = _format_number(float(value), resolution, decimals)
+            if letter in _AXIS_WORDS and not special:
+                if linear and state.pos.get(letter) == v:
+                    continue
+                state.pos[letter] = v if tracked else None
+            out.append(letter + v)
+        else:
+            out.append(letter + value)
+
+    if special:
+        state.forget_position()
+    if any(l == "M" and float(v) in (2.0, 30.0) for l, v in words):
+        state.reset()  # program end restores GRBL's default modes
+    return "".join(out)
+
+
+class CompactedLines:
+    """
+    Read-only sequence that compacts another line sequence on access, so
+    MappedLines stay lazy. The modal state follows sequential reads (the
+    sender's order); any other access restarts from an unknown state, which
+    only elides less. Counts the bytes read and produced for the report.
+    """
+
+    CACHE = 256  # recently compacted lines kept for re-reads by the send loop
+
+    def __init__(self, lines, resolution=0.001):
+        self.lines = lines
+        self.resolution = resolution
+        self.state = CompactState()
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self._next = 0
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.lines)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        with self._lock:
+            cached = self._cache.get(i)
+            if cached is not None:
+                return cached
+            if i != self._next:
+                self.state.reset()
+            raw = self.lines[i]
+            line = compact_line(raw, self.state, self.resolution)
+            self.bytes_in += len(raw) + 1
+            self.bytes_out += len(line) + 1 if line else 0  # empty lines are not sent
+            self._next = i + 1
+            self._cache[i] = line
+            if len(self._cache) > self.CACHE:
+                self._cache.pop(next(iter(self._cache)))
+            return line
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def summary(self):
+        """'Compaction: 1234567 -> 789012 bytes (-36.1%)' for the lines read so far."""
+        saved = 100.0 * (1 - self.bytes_out / self.bytes_in) if self.bytes_in else 0.0
+        return f"Compaction: {self.bytes_in} -> {self.bytes_out} bytes (-{saved:.1f}%)"
+
+
+# ------------------------- Decimation -------------------------
+RDP_CHUNK = 1024  # a run is anchored every this many lines
+
+
+class DecimationReport(namedtuple("DecimationReport", "lines_before lines_after max_deviation")):
+    """Outcome of decimate_program(); max_deviation is in mm."""
+
+    def summary(self):
+        removed = self.lines_before - self.lines_after
+        pct = 100.0 * removed / self.lines_before if self.lines_before else 0.0
+        return (f"Decimation: {self.lines_before} -> {self.lines_after} lines "
+                f"(-{pct:.1f}%), max deviation {self.max_deviation:.4f} mm")
+
+
+def _segment_distance(p, a, b):
+    """Distance of each point p[i] to the segment a[i]-b[i] (rows of 3D points)."""
+    ab = b - a
+    ap = p - a
+    length2 = (ab * ab).sum(axis=1)
+    t = np.clip((ap * ab).sum(axis=1) / np.where(length2 > 0, length2, 1.0), 0.0, 1.0)
+    return np.sqrt(((ap - t[:, None] * ab) ** 2).sum(axis=1))
+
+
+def _rdp_keep(points, keep, tolerance):
+    """
+    Ramer-Douglas-Peucker over every run at once. keep marks the points that
+    must stay (run ends, first and last point); each pass splits every open
+    interval at its farthest point until all are within tolerance.
+    """
+    keep = keep.copy()
+    active = np.flatnonzero(~keep)
+    while len(active):
+        anchors = np.flatnonzero(keep)
+        k = np.searchsorted(anchors, active) - 1  # interval of each point
+        d = _segment_distance(points[active], points[anchors[k]], points[anchors[k + 1]])
+
+        order = np.lexsort((-d, k))  # by interval, farthest first
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = k[order[1:]] != k[order[:-1]]
+        far = order[first]
+        split = far[d[far] > tolerance]
+        if not len(split):
+            break
+        keep[active[split]] = True
+
+        done = np.zeros(len(anchors), dtype=bool)
+        done[k[far[d[far] <= tolerance]]] = True
+        active = active[~done[k] & ~keep[active]]
+    return keep
+
+
+def decimate_program(program, tolerance=0.005):
+    """
+    Merge runs of (nearly) collinear G1 moves: a line is dropped when the
+    chord that replaces it stays within tolerance (mm) of its end point.
+    Only plain absolute G1 lines that neither change the feed nor carry other
+    words are candidates, so the result cuts the same path at the same feeds.
+    A kept line that loses an axis word's modal value gets it written out.
+    Returns (GcodeProgram, DecimationReport).
+    """
+    rec = program.records
+    n = len(rec)
+    if n < 3:
+        return program, DecimationReport(n, n, 0.0)
+
+    flags = rec["flags"]
+    motion = rec["motion"]
+    feed = rec["feed"]
+    inches = (flags & FLAG_INCHES) != 0
+    plain_g1 = ((motion == 1) & ((flags & FLAG_XYZ) != 0) & ((flags & FLAG_ABSOLUTE) != 0)
+                & ((flags & FLAG_OTHER) == 0))
+    removable = np.zeros(n, dtype=bool)
+    removable[1:-1] = (plain_g1[1:-1] & plain_g1[2:]
+                       & (motion[:-2] == 1)                 # G1 already in effect before the line
+                       & (feed[:-2] == feed[1:-1]) & (feed[1:-1] == feed[2:])
+                       & (inches[:-2] == inches[1:-1]) & (inches[1:-1] == inches[2:]))
+    if not removable.any():
+        return program, DecimationReport(n, n, 0.0)
+
+    points = np.column_stack((rec["x"], rec["y"], rec["z"]))
+    points[inches] *= 25.4
+    anchors = ~removable
+    anchors[::RDP_CHUNK] = True  # bounds the number of passes on very long runs
+    keep = _rdp_keep(points, anchors, tolerance)
+
+    kept = np.flatnonzero(keep)
+    dropped = np.flatnonzero(~keep)
+    nxt = kept[np.searchsorted(kept, dropped)]
+    prev = kept[np.searchsorted(kept, dropped) - 1]
+    deviation = _segment_distance(points[dropped], points[prev], points[nxt])
+
+    # Axis words dropped with a line must reappear on the next kept line
+    missing = np.zeros(n, dtype=np.uint8)
+    np.bitwise_or.at(missing, nxt, flags[dropped] & FLAG_XYZ)
+    missing &= ~flags & FLAG_XYZ
+
+    lines = program.lines
+    new_lines = [lines[i] for i in kept.tolist()]
+    new_rec = rec[keep]
+    pos = np.searchsorted(kept, np.flatnonzero(missing))
+    for j, i in zip(pos.tolist(), np.flatnonzero(missing).tolist()):
+        words = "".join(f" {axis}{rec[axis.lower()][i]:.6f}"
+                        for axis, bit in (("X", FLAG_X), ("Y", FLAG_Y), ("Z", FLAG_Z))
+                        if missing[i] & bit)
+        code, sep, comment = new_lines[j].partition(";")
+        new_lines[j] = code.rstrip() + words + (" " + sep + comment if sep else "")
+        new_rec["flags"][j] |= missing[i]
+
+    report = DecimationReport(n, len(kept), float(deviation.max()) if len(deviation) else 0.0)
+    return GcodeProgram(new_lines, new_rec, program.path), report
+
+
+# ------------------------- Resume -------------------------
+class ResumeState(namedtuple("ResumeState", "index absolute inches wcs plane inverse_time motion feed spindle "
+                                            "speed mist flood x y z arc_continues")):
+
+    @property
+    def start(self):
+        """Program line to stream from after the preamble (past line index if the preamble carries it)."""
+        return self.index + 1 if self.arc_continues else self.index
+
+    def unknown_axes(self):
+        """Axes without a known work position ('XY', '' if all known): the preamble leaves them where they are."""
+        return "".join(axis for axis, v in zip("XYZ", (self.x, self.y, self.z)) if v is None)
+
+
+def resume_state(program, index):
+    """
+    Modal state in effect when program line `index` is about to run. The
+    records already carry it (the state after line index-1); one OR over the
+    flags of the prefix's absolute (G90) lines tells which axes have had a
+    known position. An axis only moved in G91 so far is None: its records are
+    summed from an assumed 0, not a real work coordinate.
+    spindle is 3, 4 or 5, wcs 54..59 and plane 17..19, as the G/M numbers.
+    arc_continues: line index is a G2/G3 move without its own motion word,
+    which GRBL cannot be put back into (a bare G2/G3 is error:26), so
+    resume_preamble() sends that line itself with the word added.
+    """
+    rec = program.records
+    index = max(0, min(int(index), len(rec)))
+    if index == 0:
+        return ResumeState(0, True, False, 54, 17, False, MOTION_NONE, 0.0, 5, 0.0, False, False,
+                           None, None, None, False)
+    last = rec[index - 1]
+    prefix = rec["flags"][:index]
+    seen = int(np.bitwise_or.reduce(np.where(prefix & FLAG_ABSOLUTE, prefix, 0)))
+    flags = int(last["flags"])
+    modes = int(last["modes"])
+    spindle = 3 if modes & MODE_SPINDLE_CW else 4 if modes & MODE_SPINDLE_CCW else 5
+    motion = int(last["motion"])
+    here = int(rec["flags"][index]) if index < len(rec) else 0
+    return ResumeState(
+        index=index,
+        absolute=bool(flags & FLAG_ABSOLUTE),
+        inches=bool(flags & FLAG_INCHES),
+        wcs=54 + ((modes & MODE_WCS) >> MODE_WCS_SHIFT),
+        plane=17 + ((modes & MODE_PLANE) >> MODE_PLANE_SHIFT),
+        inverse_time=bool(modes & MODE_INVERSE_TIME),
+        motion=motion,
+        feed=float(last["feed"]),
+        spindle=spindle,
+        speed=float(last["speed"]),
+        mist=bool(modes & MODE_MIST),
+        flood=bool(modes & MODE_FLOOD),
+        x=float(last["x"]) if seen & FLAG_X else None,
+        y=float(last["y"]) if seen & FLAG_Y else None,
+        z=float(last["z"]) if seen & FLAG_Z else None,
+        arc_continues=motion in (2, 3) and bool(here & FLAG_XYZ) and not here & FLAG_MOTION_WORD,
+    )
+
+
+def resume_preamble(state, safe_z=5.0, plunge_feed=None, spin_up=0.0, line=None):
+    """
+    Lines that bring the machine into `state` before streaming from state.start:
+    units, G90, work offset and plane, retract to safe_z, spindle (with a
+    spin_up dwell in seconds) and coolant, rapid to the last XY, plunge to the
+    last Z at plunge_feed (default: the program's feed), then the program's
+    feed and motion mode, G91 and G93 if they were in effect. safe_z and
+    plunge_feed are in mm and mm/min whatever the program's units.
+    A G2/G3 mode is not sent on its own (GRBL needs axis words with it): when
+    state.arc_continues, line (the text of program line state.index) ends the
+    preamble with the motion word added.
+    """
+    scale = 1 / 25.4 if state.inches else 1.0
+
+    def num(value):
+        return _format_number(value, 0.0001, 4)
+
+    out = [f"G{20 if state.inches else 21} G90 G{state.wcs} G{state.plane} G94"]
+    out.append(f"G0 Z{num(safe_z * scale)}")
+    if state.spindle in (3, 4):
+        out.append(f"M{state.spindle} S{num(state.speed)}")
+        if spin_up > 0:
+            out.append(f"G4 P{num(spin_up)}")
+    if state.mist:
+        out.append("M7")
+    if state.flood:
+        out.append("M8")
+    if state.x is not None or state.y is not None:
+        xy = "".join(f" {axis}{num(v)}" for axis, v in (("X", state.x), ("Y", state.y)) if v is not None)
+        out.append("G0" + xy)
+    feed = state.feed if state.feed > 0 else 100.0 * scale
+    plunge = plunge_feed * scale if plunge_feed else feed
+    if state.z is not None:
+        out.append(f"G1 Z{num(state.z)} F{num(plunge)}")
+    modal = f"G{state.motion}" if state.motion in (0, 1) else ""
+    if state.feed > 0 and not state.inverse_time:
+        modal += f" F{num(state.feed)}"
+    if modal.strip():
+        out.append(modal.strip())
+    tail = ([] if state.absolute else ["G91"]) + (["G93"] if state.inverse_time else [])
+    if tail:
+        out.append(" ".join(tail))
+    if state.arc_continues:
+        if line is None:
+            raise ValueError("resume inside an arc run needs the text of the resume line")
+        out.append(f"G{state.motion} {line.strip()}")
+    return out
+
+
+# ------------------------- Envelope -------------------------
+ENVELOPE_TOLERANCE = 0.001  # mm, slack on every bound
+ENVELOPE_LISTED = 50        # offending lines described in a report
+
+
+class EnvelopeReport(namedtuple("EnvelopeReport", "work_min work_max machine_min machine_max "
+                                                  "travel_lines stock_lines problems")):
+    """
+    Bounding box of a program (mm, NaN without moves), the program lines that
+    leave the machine travel or cut outside the stock box, and a description
+    of the first ENVELOPE_LISTED of them as (source line, text).
+    """
+
+    @property
+    def ok(self):
+        return not len(self.travel_lines) and not len(self.stock_lines)
+
+    def summary(self, limit=ENVELOPE_LISTED):
+        def box(lo, hi):
+            return "  ".join(f"{axis} {a:.3f}..{b:.3f}" for axis, a, b in zip("XYZ", lo, hi))
+        out = [f"Work bounds:    {box(self.work_min, self.work_max)}",
+               f"Machine bounds: {box(self.machine_min, self.machine_max)}"]
+        if self.ok:
+            out.append("All moves inside the machine travel and the stock box")
+            return "\n".join(out)
+        if len(self.travel_lines):
+            out.append(f"{len(self.travel_lines)} lines outside the machine travel")
+        if len(self.stock_lines):
+            out.append(f"{len(self.stock_lines)} lines cutting outside the stock box")
+        out += [f"  line {line}: {text}" if line else f"  resume preamble: {text}"
+                for line, text in self.problems[:limit]]
+        more = len(self.travel_lines) + len(self.stock_lines) - min(limit, len(self.problems))
+        if more > 0:
+            out.append(f"  ... and {more} more")
+        return "\n".join(out)
+
+
+def _envelope_points(program, first=0):
+    """
+    Every point the moves of program lines first.. reach, in work mm, as
+    (points (3, m), program line of each point, cutting move?): move end points
+    plus the X/Y extremes of arcs that pass a quadrant.
+    """
+    rec = program.records
+    moves = program.moves()
+    scale = np.where(rec["flags"][moves] & FLAG_INCHES, 25.4, 1.0)
+    end = np.vstack((rec["x"][moves], rec["y"][moves], rec["z"][moves])) * scale
+    motion = rec["motion"][moves]
+    pts, lines, cutting = [end], [moves], [motion > 0]
+
+    arcs = np.flatnonzero((motion == 2) | (motion == 3))
+    if len(arcs):
+        start = np.hstack((np.zeros((3, 1)), end[:, :-1]))[:, arcs]
+        arc = arc_geometry(program.lines, moves[arcs], start, end[:, arcs], motion[arcs], scale[arcs])
+        cw = motion[arcs] == 2
+        for angle in (0.0, 0.5 * np.pi, np.pi, 1.5 * np.pi):
+            passed = np.where(cw, arc.start_angle - angle, angle - arc.start_angle) % (2 * np.pi)
+            hit = arc.valid & (passed <= arc.sweep)
+            if hit.any():
+                pts.append(np.vstack((arc.centre[hit, 0] + arc.radius[hit] * np.cos(angle),
+                                      arc.centre[hit, 1] + arc.radius[hit] * np.sin(angle),
+                                      end[2, arcs[hit]])))
+                lines.append(moves[arcs[hit]])
+                cutting.append(np.ones(hit.sum(), dtype=bool))
+    pts, lines, cutting = np.hstack(pts), np.concatenate(lines), np.concatenate(cutting)
+    if first > 0:
+        keep = lines >= first
+        pts, lines, cutting = pts[:, keep], lines[keep], cutting[keep]
+    return pts, lines, cutting
+
+
+def check_envelope(program, wco=(0.0, 0.0, 0.0), travel=None, stock=None, positive_axes=0,
+                   start=0, preamble=None):
+    """
+    Check every move of a program before it runs. Work coordinates plus the
+    work offset wco (MPos - WPos, from the status reports) give machine
+    coordinates, which must stay within travel ($130-$132, None = skip):
+    -travel to 0, as GRBL's soft limits see it whatever the homing direction.
+    positive_axes is a bit mask of axes whose machine space is 0 to +travel
+    instead, only on GRBL built with HOMING_FORCE_SET_ORIGIN (where it is $23).
+    Cutting moves (G1-G3) must also stay inside stock,
+    (xmin, xmax, ymin, ymax, zmin, zmax) in work mm (None = skip).
+    For a resume, only lines start.. are checked, plus the moves of the
+    resume_preamble() lines (program line -1, source line 0 in problems).
+    G53/G28/G30 moves are not checked. Returns an EnvelopeReport.
+    """
+    nan3 = np.full(3, np.nan)
+    empty = np.zeros(0, dtype=np.int64)
+    if len(program.moves()):
+        pts, lines, cutting = _envelope_points(program, start)
+    else:
+        pts, lines, cutting = np.zeros((3, 0)), empty, np.zeros(0, dtype=bool)
+    if preamble:
+        extra = compile_program(list(preamble))
+        if len(extra.moves()):
+            more, more_lines, more_cutting = _envelope_points(extra)
+            # axes the preamble has not moved yet are wherever the machine is: not checked
+            seen = np.bitwise_or.accumulate(extra.records["flags"])[more_lines]
+            for a, bit in enumerate((FLAG_X, FLAG_Y, FLAG_Z)):
+                more[a, (seen & bit) == 0] = np.nan
+            pts = np.hstack((more, pts))
+            lines = np.concatenate((np.full(more.shape[1], -1), lines))
+            cutting = np.concatenate((more_cutting, cutting))
+    if not len(lines):
+        return EnvelopeReport(nan3, nan3, nan3, nan3, empty, empty, [])
+
+    wco = np.asarray(wco, dtype=np.float64)[:3]
+    work_min, work_max = np.nanmin(pts, axis=1), np.nanmax(pts, axis=1)
+    src = program.records["src"]
+    problems = []
+
+    def offending(out, lo, hi, frame, prefix, what):
+        """Program lines with a point outside lo..hi, the first few described."""
+        bad = np.flatnonzero(out.any(axis=0))
+        found, first = np.unique(lines[bad], return_index=True)
+        for line, k in zip(found[:ENVELOPE_LISTED - len(problems)].tolist(), bad[first].tolist()):
+            axes = [f"{prefix}{axis} {frame[a, k]:.3f}" for a, axis in enumerate("XYZ") if out[a, k]]
+            limits = [f"{lo[a]:.3f}..{hi[a]:.3f}" for a in range(3) if out[a, k]]
+            source = int(src[line]) if line >= 0 else 0
+            problems.append((source, f"{', '.join(axes)} outside {what} {', '.join(limits)}"))
+        return found
+
+    travel_lines = empty
+    if travel is not None:
+        travel = np.abs(np.asarray(travel, dtype=np.float64)[:3])
+        positive = np.array([bool(positive_axes & (1 << a)) for a in range(3)])
+        lo = np.where(positive, 0.0, -travel)
+        hi = np.where(positive, travel, 0.0)
+        machine = pts + wco[:, None]
+        out = (machine < lo[:, None] - ENVELOPE_TOLERANCE) | (machine > hi[:, None] + ENVELOPE_TOLERANCE)
+        travel_lines = offending(out, lo, hi, machine, "machine ", "travel")
+
+    stock_lines = empty
+    if stock is not None:
+        lo = np.asarray(stock, dtype=np.float64)[0::2]
+        hi = np.asarray(stock, dtype=np.float64)[1::2]
+        out = ((pts < lo[:, None] - ENVELOPE_TOLERANCE) | (pts > hi[:, None] + ENVELOPE_TOLERANCE)) & cutting
+        stock_lines = offending(out, lo, hi, pts, "", "stock")
+
+    return EnvelopeReport(work_min, work_max, work_min + wco, work_max + wco, travel_lines, stock_lines, problems)
+
+
+# ------------------------- Height Map -------------------------
+def height_at(x, y, xs, ys, hs):
+    """Bilinear interpolation of the probe grid hs (ny x nx) at X/Y. NaN if unknown."""
+    if len(xs) < 2 or len(ys) < 2:
+        return float('nan')
+    nx = len(xs)
+    ny = len(ys)
+    if x <= xs[0]:
+        ix = 0
+        fx = 0.0
+    elif x >= xs[-1]:
+        ix = nx - 2
+        fx = 1.0
+    else:
+        ix = max(0, min(nx - 2, int(floor((x - xs[0]) / (xs[-1] - xs[0] + 1e-12) * (nx - 1)))))
+        while ix + 1 < nx and xs[ix+1] < x:
+            ix += 1
+        while ix > 0 and xs[ix] > x:
+            ix -= 1
+        denom = xs[ix+1] - xs[ix] if xs[ix+1] != xs[ix] else 1e-12
+        fx = (x - xs[ix]) / denom
+    if y <= ys[0]:
+        iy = 0
+        fy = 0.0
+    elif y >= ys[-1]:
+        iy = ny - 2
+        fy = 1.0
+    else:
+        iy = max(0, min(ny - 2, int(floor((y - ys[0]) / (ys[-1] - ys[0] + 1e-12) * (ny - 1)))))
+        while iy + 1 < ny and ys[iy+1] < y:
+            iy += 1
+        while iy > 0 and ys[iy] > y:
+            iy -= 1
+        denomy = ys[iy+1] - ys[iy] if ys[iy+1] != ys[iy] else 1e-12
+        fy = (y - ys[iy]) / denomy
+    try:
+        z00 = hs[iy, ix]
+        z10 = hs[iy, ix+1] if ix+1 < hs.shape[1] else z00
+        z01 = hs[iy+1, ix] if iy+1 < hs.shape[0] else z00
+        z11 = hs[iy+1, ix+1] if (iy+1 < hs.shape[0] and ix+1 < hs.shape[1]) else z00
+        corner_vals = [z00, z10, z01, z11]
+        if any(np.isnan(corner_vals)):
+            nonnan = [v for v in corner_vals if not np.isnan(v)]
+            if nonnan:
+                return float(np.mean(nonnan))
+            else:
+                return float('nan')
+        z0 = z00 * (1 - fx) + z10 * fx
+        z1 = z01 * (1 - fx) + z11 * fx
+        z = z0 * (1 - fy) + z1 * fy
+        return float(z)
+    except Exception:
+        return float('nan')
+
+
+def heights_at(qx, qy, xs, ys, hs):
+    """Vectorized height_at() for arrays of X/Y (grid axes must be ascending)."""
+    qx = np.asarray(qx, dtype=float)
+    qy = np.asarray(qy, dtype=float)
+    xs = np.asarray(xs, dtype=float)
+    ys = np.asarray(ys, dtype=float)
+    hs = np.asarray(hs, dtype=float)
+    if len(xs) < 2 or len(ys) < 2:
+        return np.full(qx.shape, np.nan)
+    if hs.shape != (len(ys), len(xs)):
+        return np.array([height_at(x, y, xs, ys, hs) for x, y in zip(qx.tolist(), qy.tolist())])
+
+    ix = np.clip(np.searchsorted(xs, qx, side='left') - 1, 0, len(xs) - 2)
+    iy = np.clip(np.searchsorted(ys, qy, side='left') - 1, 0, len(ys) - 2)
+    dx = xs[ix+1] - xs[ix]
+    dy = ys[iy+1] - ys[iy]
+    fx = np.clip((qx - xs[ix]) / np.where(dx != 0, dx, 1e-12), 0.0, 1.0)
+    fy = np.clip((qy - ys[iy]) / np.where(dy != 0, dy, 1e-12), 0.0, 1.0)
+
+    z00 = hs[iy, ix]
+    z10 = hs[iy, ix+1]
+    z01 = hs[iy+1, ix]
+    z11 = hs[iy+1, ix+1]
+    z0 = z00 * (1 - fx) + z10 * fx
+    z1 = z01 * (1 - fx) + z11 * fx
+    z = z0 * (1 - fy) + z1 * fy
+
+    # Unprobed corners: fall back to the mean of the known ones (NaN if none)
+    corners = np.stack([z00, z10, z01, z11])
+    known = ~np.isnan(corners)
+    partial = ~known.all(axis=0)
+    if partial.any():
+        count = known.sum(axis=0)
+        total = np.where(known, corners, 0.0).sum(axis=0)
+        fallback = np.where(count > 0, total / np.maximum(count, 1), np.nan)
+        z = np.where(partial, fallback, z)
+    return z
+
+
+def apply_height_map(program, xs, ys, hs, ref=0.0):
+    """
+    Return a copy of program.lines with every absolute Z word shifted by the
+    probed surface height at that line's X/Y. Lines before the first X and Y,
+    relative (G91) lines and points off the map are left unchanged.
+    """
+    rec = program.records
+    flags = rec["flags"]
+    seen_x = np.maximum.accumulate((flags & FLAG_X) != 0) if len(flags) else flags
+    seen_y = np.maximum.accumulate((flags & FLAG_Y) != 0) if len(flags) else flags
+    targets = np.flatnonzero(((flags & FLAG_Z) != 0) & ((flags & FLAG_ABSOLUTE) != 0) & seen_x & seen_y)
+
+    corrected = list(program.lines)
+    if len(targets) == 0:
+        return corrected
+    delta = heights_at(rec["x"][targets], rec["y"][targets], xs, ys, hs) - ref
+    new_zs = rec["z"][targets] + delta
+    for i, new_z in zip(targets.tolist(), new_zs.tolist()):
+        if new_z != new_z:  # NaN: no surface data here
+            continue
+        corrected[i] = _Z_WORD_RE.sub(lambda m: f"Z{new_z:.6f}", corrected[i])
+    return corrected
@@ -0,0 +1,89 @@
+# pilotx_log.py
+# Console log pipeline for PilotX. Any thread may put() messages; the GUI
+# drains them in batches on a timer, so a long job costs one widget insert
+# per flush instead of one Tk callback per line. Every message still goes to
+# the log file, whatever the console shows.
+
+import time
+from collections import deque
+
+# ------------------------- Categories -------------------------
+LOG_INFO = "info"
+LOG_SENT = "sent"  # ">> ..." / "[SIM] ..." echoes of lines sent
+LOG_ACK = "ok"     # "<< ok" responses
+
+DRAIN_MAX = 5000   # messages handled per drain, keeps one flush short
+
+
+def log_category(text):
+    """Classify a console message for sampling."""
+    if text.startswith(">> ") or text.startswith("[SIM] "):
+        return LOG_SENT
+    if text == "<< ok":
+        return LOG_ACK
+    return LOG_INFO
+
+
+class LogPipeline:
+    """
+    Batches console messages between threads and the GUI.
+
+    sample maps a category to N: show every Nth message of it, 0 hides it.
+    Categories not in sample are always shown.
+    """
+
+    def __init__(self, path=None, max_lines=2000, sample=None):
+        self.queue = deque()  # append/popleft are atomic, no lock needed
+        self.max_lines = max_lines
+        self.sample = dict(sample or {})
+        self._seen = {}
+        self._file = None
+        if path:
+            try:
+                self._file = open(path, "a", encoding="utf-8")
+            except Exception as e:
+                print(f"Could not open log file {path}: {e}")
+
+    def put(self, text, widget=None):
+        """Queue a message for the console (widget None = main console). Any thread."""
+        self.queue.append((time.time(), text, widget))
+
+    def drain(self):
+        """
+        Take the queued messages. Writes all of them to the log file and returns
+        [(widget, text), ...] for the ones the console should show.
+        """
+        shown = []
+        records = []
+        for _ in range(DRAIN_MAX):
+            try:
+                stamp, text, widget = self.queue.popleft()
+            except IndexError:
+                break
+            records.append(f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(stamp))}"
+                           f".{int(stamp * 1000) % 1000:03d} {text}\n")
+
+            category = log_category(text)
+            every = self.sample.get(category, 1)
+            if every != 1:
+                if every <= 0:
+                    continue
+                seen = self._seen.get(category, 0) + 1
+                self._seen[category] = seen
+                if seen % every:
+                    continue
+            shown.append((widget, text))
+
+        if records and self._file:
+            try:
+                self._file.write("".join(records))
+                self._file.flush()
+            except Exception as e:
+                print(f"Log file write error: {e}")
+                self._file = None
+        return shown
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
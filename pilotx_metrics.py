@@ -0,0 +1,476 @@
+# pilotx_metrics.py
+# Per-line streaming instrumentation for PilotX. The engine stamps every
+# program line when it is written and again when its ok/error comes back
+# through the pending_lines FIFO, so a job can be examined afterwards:
+# high ack latency with a full RX buffer points at GRBL (planner or parser),
+# low latency with an empty buffer points at the host or the USB link.
+# StageTimers (opt-in) time the stages of the send loop, reader, UI and
+# auto-level so the hot spots can be measured instead of guessed.
+
+import csv
+import json
+import os
+import threading
+import time
+from bisect import bisect_right
+from collections import deque
+
+import numpy as np  # numpy library is needed
+
+LATENCY_BINS_MS = np.array([0, 1, 2, 3, 5, 7.5, 10, 15, 20, 30, 50, 75, 100, 150, 200,
+                            300, 500, 750, 1000, 2000, 5000, np.inf])
+_BIN_UPPER = LATENCY_BINS_MS[1:-1].tolist()
+
+
+class StreamMetrics:
+    """
+    Send/ack timing of one job, one slot per program line (12 bytes/line).
+
+    Slots are indexed by program line (engine.gcode_lines index).
+    sent       seconds from job start when the line was written (NaN = not sent)
+    latency    ms from write to ok/error (NaN = not acknowledged)
+    nbytes     bytes on the wire including the newline
+    occupancy  bytes in GRBL's RX buffer once the line was written
+    """
+
+    def __init__(self):
+        self.start(0)
+
+    def start(self, total_lines):
+        self.sent = np.full(total_lines, np.nan, dtype=np.float32)
+        self.latency = np.full(total_lines, np.nan, dtype=np.float32)
+        self.nbytes = np.zeros(total_lines, dtype=np.uint16)
+        self.occupancy = np.zeros(total_lines, dtype=np.uint16)
+        self.t0 = time.perf_counter()
+        self.started = time.time()
+        self.acked = 0
+        self.acked_bytes = 0
+        self.last_index = -1
+        self.bin_counts = [0] * (len(LATENCY_BINS_MS) - 1)  # live histogram
+        self._last_snapshot = (self.t0, 0, 0, -1)
+
+    # ------------------------- Recording (engine threads) -------------------------
+    def on_sent(self, index, t, nbytes, occupancy):
+        if 0 <= index < len(self.sent):
+            self.sent[index] = t - self.t0
+            self.nbytes[index] = min(nbytes, 0xFFFF)
+            self.occupancy[index] = min(occupancy, 0xFFFF)
+
+    def on_acked(self, index, t_sent, t, nbytes):
+        if 0 <= index < len(self.latency):
+            ms = (t - t_sent) * 1000.0
+            self.latency[index] = ms
+            self.bin_counts[bisect_right(_BIN_UPPER, ms)] += 1
+            self.last_index = index
+        self.acked += 1
+        self.acked_bytes += nbytes
+
+    # ------------------------- Live view -------------------------
+    def snapshot(self):
+        """
+        Rates and ack latency percentiles of the lines acknowledged since the
+        previous snapshot: dict(lines_per_s, bytes_per_s, acked, p50, p95, max).
+        """
+        now = time.perf_counter()
+        t, lines, nbytes, index = self._last_snapshot
+        dt = max(1e-6, now - t)
+        self._last_snapshot = (now, self.acked, self.acked_bytes, self.last_index)
+
+        window = self.latency[index + 1:self.last_index + 1]
+        lat = window[np.isfinite(window)]
+        p50, p95, worst = (np.percentile(lat, [50, 95]).tolist() + [float(lat.max())]) if len(lat) else (0.0, 0.0, 0.0)
+        return {
+            "lines_per_s": (self.acked - lines) / dt,
+            "bytes_per_s": (self.acked_bytes - nbytes) / dt,
+            "acked": self.acked,
+            "p50": p50,
+            "p95": p95,
+            "max": worst,
+        }
+
+    def histogram(self):
+        """Ack latency counts of the whole job per LATENCY_BINS_MS bin: (counts, edges)."""
+        return np.array(self.bin_counts), LATENCY_BINS_MS
+
+    def summary(self):
+        lat = self.latency[np.isfinite(self.latency)]
+        sent = np.isfinite(self.sent)
+        elapsed = float(np.nanmax(self.sent)) if sent.any() else 0.0
+        out = {
+            "started": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(self.started)),
+            "lines_sent": int(sent.sum()),
+            "lines_acked": int(len(lat)),
+            "bytes_sent": int(self.nbytes[sent].sum()),
+            "elapsed_s": elapsed,
+            "lines_per_s": float(sent.sum() / elapsed) if elapsed else 0.0,
+            "bytes_per_s": float(self.nbytes[sent].sum() / elapsed) if elapsed else 0.0,
+            "mean_occupancy": float(self.occupancy[sent].mean()) if sent.any() else 0.0,
+        }
+        if len(lat):
+            p50, p95, p99 = np.percentile(lat, [50, 95, 99]).tolist()
+            out.update(latency_ms_mean=float(lat.mean()), latency_ms_p50=p50,
+                       latency_ms_p95=p95, latency_ms_p99=p99, latency_ms_max=float(lat.max()))
+        counts, edges = self.histogram()
+        out["histogram_ms"] = {"edges": [float(e) for e in edges[:-1]] + ["inf"],
+                               "counts": counts.tolist()}
+        return out
+
+    # ------------------------- Export -------------------------
+    def export(self, path, extra=None):
+        """Write the job to path: .csv = one row per line sent, anything else = JSON."""
+        sent = np.flatnonzero(np.isfinite(self.sent))
+        if path.lower().endswith(".csv"):
+            with open(path, "w", newline="") as f:
+                w = csv.writer(f)
+                w.writerow(["index", "sent_s", "latency_ms", "bytes", "rx_occupancy"])
+                w.writerows(zip(sent.tolist(),
+                                np.round(self.sent[sent].astype(np.float64), 6).tolist(),
+                                np.round(self.latency[sent].astype(np.float64), 3).tolist(),
+                                self.nbytes[sent].tolist(),
+                                self.occupancy[sent].tolist()))
+            return
+
+        data = self.summary()
+        if extra:
+            data.update(extra)
+        data["lines"] = {
+            "index": sent.tolist(),
+            "sent_s": np.round(self.sent[sent].astype(np.float64), 6).tolist(),
+            "latency_ms": [None if np.isnan(v) else v
+                           for v in np.round(self.latency[sent].astype(np.float64), 3).tolist()],
+            "bytes": self.nbytes[sent].tolist(),
+            "rx_occupancy": self.occupancy[sent].tolist(),
+        }
+        with open(path, "w") as f:
+            json.dump(data, f, indent=1)
+
+
+# ------------------------- Planner Starvation -------------------------
+class StarvationMonitor:
+    """
+    Flags stretches where GRBL's planner runs (nearly) empty while in Run, from
+    the Bf: field of status reports. Needs Bf: in the reports ($10 buffer bit).
+
+    Each sample attributes the planner to program lines: everything up to the
+    last acknowledged line has been planned, so the blocks still queued are the
+    last `queued` acked lines, and GRBL is waiting on the line after them.
+    Consecutive starved samples are merged into one event.
+    """
+
+    def __init__(self, threshold=2):
+        self.threshold = threshold  # blocks queued at or below this = starved
+        self.start()
+
+    def start(self):
+        self.t0 = time.time()
+        self.events = []
+        self.reports = 0           # status reports fed, with or without Bf:
+        self.samples = 0           # Run samples with Bf:
+        self.starved = 0           # of which starved
+        self.planner_size = 0      # largest free-block count seen = planner capacity
+        self.seen_bf = False
+        self._armed = False        # planner has filled up once since start
+        self._open = None
+
+    def sample(self, report, acked_index, sent_index):
+        """Feed one StatusReport with the last acked and last sent program line."""
+        self.reports += 1
+        if report.planner is None:
+            return
+        self.seen_bf = True
+        self.planner_size = max(self.planner_size, report.planner)
+        if report.state != "Run":
+            self._close()
+            return
+
+        queued = self.planner_size - report.planner
+        self.samples += 1
+        if queued > self.threshold:
+            self._armed = True
+            self._close()
+            return
+        if not self._armed:
+            return  # still filling at job start
+
+        self.starved += 1
+        first = max(0, acked_index - queued + 1)
+        last = acked_index + 1
+        t = report.time - self.t0
+        ev = self._open
+        if ev is None:
+            ev = self._open = {"start_s": t, "end_s": t, "first_line": first, "last_line": last,
+                               "min_queued": queued, "samples": 0, "sent_line": sent_index}
+            self.events.append(ev)
+        ev["end_s"] = t
+        ev["first_line"] = min(ev["first_line"], first)
+        ev["last_line"] = max(ev["last_line"], last)
+        ev["min_queued"] = min(ev["min_queued"], queued)
+        ev["samples"] += 1
+        ev["sent_line"] = sent_index
+
+    def _close(self):
+        self._open = None
+
+    def summary(self):
+        return {
+            "threshold_blocks": self.threshold,
+            "planner_blocks": self.planner_size,
+            "run_samples": self.samples,
+            "starved_samples": self.starved,
+            "events": [dict(ev) for ev in self.events],
+        }
+
+    def report(self, line_name=None, limit=20):
+        """
+        Post-job text report. line_name(index) turns a program index into
+        something readable (e.g. the source line number); default is the
+        program index (0 = the injected G90).
+        """
+        line_name = line_name or str
+        if not self.seen_bf:
+            return "Planner starvation: no Bf: field in status reports (enable the buffer bit of $10)"
+        pct = 100.0 * self.starved / self.samples if self.samples else 0.0
+        out = [f"Planner starvation: {len(self.events)} events, {self.starved} of {self.samples} "
+               f"Run samples ({pct:.1f}%) with <= {self.threshold} of {self.planner_size} blocks queued"]
+        for n, ev in enumerate(self.events[:limit], 1):
+            out.append(f"  #{n}  t={ev['start_s']:.1f}-{ev['end_s']:.1f} s  "
+                       f"lines {line_name(ev['first_line'])}-{line_name(ev['last_line'])}  "
+                       f"min {ev['min_queued']} queued, {ev['samples']} samples")
+        if len(self.events) > limit:
+            out.append(f"  ... {len(self.events) - limit} more (see the exported stats)")
+        return "\n".join(out)
+
+
+# ------------------------- Stage Timers -------------------------
+TRACE_EVENTS = 200000  # spans kept for the Chrome trace (oldest dropped first)
+
+
+class StageTimers:
+    """
+    Opt-in wall-clock timers around the hot stages (send loop, reader, UI
+    tick, auto-level). Call sites do
+
+        t = timers.start()
+        ...
+        timers.stop("send.write", t)
+
+    start() returns 0 while disabled and stop() ignores it, so a disabled
+    timer costs two cheap calls. The send, reader and Tk threads all call
+    stop(), so updates, reset() and reads share a lock. Per stage: count,
+    total and worst time; the last TRACE_EVENTS spans are kept for a Chrome
+    trace (chrome://tracing, ui.perfetto.dev).
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.trace = deque(maxlen=TRACE_EVENTS)
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.stats = {}  # name -> [count, total_s, max_s]
+            self.trace.clear()
+            self.t0 = time.perf_counter()
+
+    def start(self):
+        return time.perf_counter() if self.enabled else 0.0
+
+    def stop(self, name, t):
+        if not t:
+            return
+        dt = time.perf_counter() - t
+        ident = threading.get_ident()
+        with self._lock:
+            s = self.stats.get(name)
+            if s is None:
+                s = self.stats[name] = [0, 0.0, 0.0]
+            s[0] += 1
+            s[1] += dt
+            if dt > s[2]:
+                s[2] = dt
+            self.trace.append((name, t, dt, ident))
+
+    def summary(self):
+        """{stage: {count, total_ms, mean_us, max_ms}} sorted by total time."""
+        with self._lock:
+            stats = [(name, tuple(s)) for name, s in self.stats.items()]
+        out = {}
+        for name, (count, total, worst) in sorted(stats, key=lambda kv: -kv[1][1]):
+            out[name] = {"count": count, "total_ms": total * 1000.0,
+                         "mean_us": total / count * 1e6 if count else 0.0, "max_ms": worst * 1000.0}
+        return out
+
+    def report(self):
+        lines = [f"{'stage':<22} {'count':>9} {'total ms':>10} {'mean us':>9} {'max ms':>8}"]
+        for name, s in self.summary().items():
+            lines.append(f"{name:<22} {s['count']:>9} {s['total_ms']:>10.1f} {s['mean_us']:>9.1f} {s['max_ms']:>8.2f}")
+        return "\n".join(lines)
+
+    def export(self, path, trace=False):
+        """Write the stage summary as JSON, or with trace=True the kept spans as a Chrome trace."""
+        if not trace:
+            data = {"elapsed_s": time.perf_counter() - self.t0, "stages": self.summary()}
+        else:
+            pid = os.getpid()
+            threads = {}
+            events = []
+            with self._lock:
+                spans = list(self.trace)
+            for name, t, dt, ident in spans:
+                tid = threads.setdefault(ident, len(threads) + 1)
+                events.append({"name": name, "cat": name.split(".", 1)[0], "ph": "X", "pid": pid, "tid": tid,
+                               "ts": round((t - self.t0) * 1e6, 1), "dur": round(dt * 1e6, 1)})
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, tid in threads.items():
+                events.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": tid,
+                               "args": {"name": names.get(ident, f"thread {tid}")}})
+            data = {"traceEvents": events, "displayTimeUnit": "ms"}
+        with open(path, "w") as f:
+            json.dump(data, f)
+
+
+# ------------------------- Telemetry -------------------------
+TELEMETRY_STATES = ("Unknown", "Idle", "Run", "Hold", "Jog", "Alarm", "Door", "Check", "Home", "Sleep")
+_STATE_CODE = {name: code for code, name in enumerate(TELEMETRY_STATES)}
+
+# One status report, 42 bytes: 8 h at 10 Hz is ~12 MB raw, a few MB compressed
+TELEMETRY_DTYPE = np.dtype([
+    ("t", np.float64),          # time.time() of the report
+    ("state", np.uint8),        # index into TELEMETRY_STATES
+    ("substate", np.int8),      # Hold:/Door: number, -1 if none
+    ("mpos", np.float32, (3,)), # machine X/Y/Z
+    ("feed", np.float32),       # FS: feed (NaN if not reported)
+    ("spindle", np.float32),    # FS: spindle speed (NaN if not reported)
+    ("planner", np.int16),      # Bf: free planner blocks, -1 if not reported
+    ("rx_free", np.int16),      # Bf: free RX bytes, -1 if not reported
+    ("line", np.int32),         # Ln: line number, -1 if not reported
+    ("index", np.int32),        # last program line acknowledged by GRBL
+])
+TELEMETRY_CHUNK = 36000  # ring size in reports (1 h at 10 Hz, 1.5 MB)
+
+
+class TelemetryRecorder:
+    """
+    Records every status report of a job into a preallocated ring of
+    TELEMETRY_DTYPE rows. A full ring is appended to <name>.tlm.part as raw
+    rows, so memory stays at one ring whatever the job length; stop() closes
+    it and a worker thread packs it into <name>.npz (compressed, with the
+    state names) and removes the part file, so the reader thread that sees
+    the job end is not held up. Read it back with load_telemetry().
+    """
+
+    def __init__(self, directory=None, chunk=TELEMETRY_CHUNK):
+        self.directory = directory  # None/"" = disabled
+        self.chunk = chunk
+        self.ring = None    # allocated by the first start()
+        self.count = 0      # rows in the ring
+        self.total = 0      # rows this job
+        self.active = False
+        self.path = None
+        self._part = None
+        self._savers = []
+        self._lock = threading.Lock()  # reader records, sender starts, any thread stops
+
+    def start(self, name="job"):
+        """Begin a job file; does nothing unless a directory is set."""
+        self.stop()
+        if not self.directory:
+            return
+        name = "".join(c if c.isalnum() or c in "-_." else "_" for c in name) or "job"
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            base = os.path.join(self.directory, f"{time.strftime('%Y%m%d-%H%M%S')}_{name}")
+            self._part = open(base + ".tlm.part", "wb")
+        except Exception as e:
+            print(f"Telemetry disabled: {e}")
+            return
+        if self.ring is None:
+            self.ring = np.zeros(self.chunk, dtype=TELEMETRY_DTYPE)
+        self.path = base + ".npz"
+        self.count = 0
+        self.total = 0
+        self.active = True
+
+    def record(self, report, index=-1):
+        """Append one StatusReport (reader thread)."""
+        with self._lock:
+            if self.active:
+                self._record(report, index)
+
+    def _record(self, report, index):
+        row = self.ring[self.count]
+        row["t"] = report.time
+        row["state"] = _STATE_CODE.get(report.state, 0)
+        row["substate"] = -1 if report.substate is None else report.substate
+        row["mpos"] = report.mpos[:3]
+        row["feed"] = np.nan if report.feed is None else report.feed
+        row["spindle"] = np.nan if report.spindle is None else report.spindle
+        row["planner"] = -1 if report.planner is None else report.planner
+        row["rx_free"] = -1 if report.rx_free is None else report.rx_free
+        row["line"] = -1 if report.line is None else report.line
+        row["index"] = index
+        self.count += 1
+        self.total += 1
+        if self.count == len(self.ring):
+            self._spill()
+
+    def _spill(self):
+        try:
+            self.ring[:self.count].tofile(self._part)
+        except Exception as e:
+            print(f"Telemetry write error: {e}")
+        self.count = 0
+
+    def stop(self, extra=None, done=None):
+        """
+        Finish the job file. Returns the .npz path (written in the background,
+        done(path) is called once it is there), or None if nothing was recorded.
+        """
+        with self._lock:
+            if not self.active:
+                return None
+            self.active = False
+            self._spill()
+            part = self._part.name
+            self._part.close()
+            self._part = None
+            if not self.total:
+                self._remove(part)
+                return None
+            path = self.path
+        saver = threading.Thread(target=self._save, args=(part, path, extra, done), name="telemetry-save")
+        self._savers = [t for t in self._savers if t.is_alive()] + [saver]
+        saver.start()
+        return path
+
+    def wait(self, timeout=None):
+        """Wait for files still being packed (before exiting)."""
+        for saver in list(self._savers):
+            saver.join(timeout)
+
+    def _save(self, part, path, extra, done):
+        try:
+            data = np.fromfile(part, dtype=TELEMETRY_DTYPE)
+            np.savez_compressed(path, telemetry=data, states=np.array(TELEMETRY_STATES),
+                                meta=np.array(json.dumps(extra or {})))
+        except Exception as e:
+            print(f"Telemetry save error: {e}")
+            return
+        finally:
+            self._remove(part)
+        if done is not None:
+            done(path)
+
+    @staticmethod
+    def _remove(part):
+        try:
+            os.remove(part)
+        except OSError:
+            pass
+
+
+def load_telemetry(path):
+    """(rows, state names, meta dict) of a file written by TelemetryRecorder."""
+    with np.load(path) as f:
+        return f["telemetry"], [str(s) for s in f["states"]], json.loads(str(f["meta"]))
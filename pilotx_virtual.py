@@ -0,0 +1,701 @@
+# pilotx_virtual.py
+# Virtual GRBL 1.1 controller for PilotX: benchmark and test the sender at
+# full speed with no machine attached. It speaks the serial protocol over a
+# pseudo-terminal or a TCP socket, both of which pyserial (and so the GUI and
+# pilotx_engine.py) can open:
+#
+#   python pilotx_virtual.py --pty              -> prints e.g. /dev/pts/5
+#   python pilotx_virtual.py --socket 23000     -> connect to socket://localhost:23000
+#
+# Emulated: the 128-byte RX buffer (bytes beyond it are dropped, as on the
+# real board), a planner queue whose blocks take a configurable time, ok /
+# error:N replies, status reports with Bf:, realtime commands, probing
+# against a configurable bed surface with [PRB:] results, soft limits and
+# alarms. Motion is not interpolated: the position jumps to a block's target
+# when the block completes.
+
+import argparse
+import math
+import os
+import re
+import socket
+import threading
+import time
+from collections import deque
+
+RX_BUFFER_SIZE = 128   # GRBL serial RX ring, 127 bytes usable
+PLANNER_BLOCKS = 15    # GRBL 1.1 block buffer on an ATmega328p
+BLOCK_TIME = 0.002     # seconds each planner block takes to execute
+LINE_MAX = 80          # longer lines are rejected with error:14
+STATUS_WCO_EVERY = 10  # WCO:/Ov: are added to every Nth status report
+BANNER = "Grbl 1.1h ['$' for help]"
+
+DEFAULT_SETTINGS = {
+    0: 10, 1: 25, 2: 0, 3: 0, 4: 0, 5: 0, 6: 0,
+    10: 3,  # MPos + buffer state (Bf:) in status reports
+    11: 0.010, 12: 0.002, 13: 0,
+    20: 0, 21: 0, 22: 1, 23: 0, 24: 25.0, 25: 500.0, 26: 250, 27: 1.0,
+    30: 1000, 31: 0, 32: 0,
+    100: 250.0, 101: 250.0, 102: 250.0,
+    110: 500.0, 111: 500.0, 112: 500.0,
+    120: 10.0, 121: 10.0, 122: 10.0,
+    130: 200.0, 131: 200.0, 132: 200.0,
+}
+
+_WORD_RE = re.compile(r"([A-Z])([-+]?(?:\d+\.?\d*|\.\d+))")
+_COMMENT_RE = re.compile(r"\([^)]*\)")
+
+MOTION_G = (0.0, 1.0, 2.0, 3.0, 38.2, 38.3, 38.4, 38.5, 80.0)
+SUPPORTED_G = MOTION_G + (4.0, 10.0, 17.0, 18.0, 19.0, 20.0, 21.0, 28.0, 28.1, 30.0, 30.1,
+                          40.0, 43.1, 49.0, 53.0, 54.0, 55.0, 56.0, 57.0, 58.0, 59.0,
+                          61.0, 90.0, 91.0, 91.1, 92.0, 92.1, 93.0, 94.0)
+SUPPORTED_M = (0.0, 1.0, 2.0, 3.0, 4.0, 5.0, 7.0, 8.0, 9.0, 30.0, 56.0)
+WORD_LETTERS = "FGIJKLMNPRSTXYZ"
+
+
+def flat_bed(z=0.0, tilt_x=0.0, tilt_y=0.0, wave=0.0, period=50.0):
+    """Bed surface for probing: machine Z at machine X/Y, a tilted plane plus an optional ripple."""
+    def surface(x, y):
+        h = z + tilt_x * x + tilt_y * y
+        if wave:
+            h += wave * math.sin(2 * math.pi * x / period) * math.cos(2 * math.pi * y / period)
+        return h
+    return surface
+
+
+class VirtualGrbl:
+    """
+    The controller itself, independent of the transport: receive() takes the
+    bytes the host wrote, output(bytes) is called with everything GRBL sends.
+    One worker thread parses lines and executes planner blocks.
+    """
+
+    def __init__(self, block_time=BLOCK_TIME, planner_blocks=PLANNER_BLOCKS,
+                 rx_size=RX_BUFFER_SIZE, bed=None, time_scale=0.0):
+        self.block_time = block_time
+        self.planner_blocks = planner_blocks
+        self.rx_size = rx_size
+        self.bed = bed or flat_bed()
+        self.time_scale = time_scale  # > 0: blocks also take distance/feed * time_scale
+        self.settings = dict(DEFAULT_SETTINGS)
+        self.output = None
+        self.cond = threading.Condition()
+        self.running = False
+        self.thread = None
+
+        # counters for tests and benchmarks
+        self.lines = 0
+        self.blocks = 0
+        self.overflows = 0
+        self.max_rx = 0
+
+        # survive soft resets
+        self.state = "Idle"
+        self.pos = [0.0, 0.0, 0.0]  # machine position
+        self.wcs = {p: [0.0, 0.0, 0.0] for p in range(1, 7)}  # G54..G59 offsets
+        self._reset()
+
+    # ------------------------- Host side -------------------------
+    def attach(self, output):
+        """Connect a host: output(bytes) receives the controller's replies. Resets like DTR does."""
+        with self.cond:
+            self.output = output
+            self._reset()
+            if self.state != "Alarm":
+                self.state = "Idle"
+            self._send("\r\n" + BANNER)
+
+    def detach(self):
+        with self.cond:
+            self.output = None
+
+    def receive(self, data):
+        """Bytes written by the host. Realtime commands act at once, the rest goes to the RX buffer."""
+        with self.cond:
+            for b in data:
+                if b == 0x3F:                       # ?
+                    self._send(self._status())
+                elif b == 0x21:                     # !
+                    if self.state in ("Run", "Jog"):
+                        self._hold_planner()
+                elif b == 0x7E:                     # ~
+                    if self.state.startswith("Hold") or self.state.startswith("Door"):
+                        self._resume_planner()
+                elif b == 0x18:                     # ctrl-x
+                    self._soft_reset()
+                elif b >= 0x80:
+                    self._realtime(b)
+                elif len(self.rx) >= self.rx_size - 1:
+                    self.overflows += 1             # the real ring drops it too
+                else:
+                    self.rx.append(b)
+            self.max_rx = max(self.max_rx, len(self.rx))
+            self.cond.notify()
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+
+    # ------------------------- State -------------------------
+    def _reset(self):
+        """Clear buffers and modal state, as GRBL's reset does; position and offsets stay."""
+        self.rx = bytearray()
+        self.planner = deque()      # (target, duration)
+        self.block_end = None       # perf_counter when the head block finishes
+        self.hold_left = None       # remaining head time while in feed hold
+        self.busy_until = 0.0       # dwell/probe: no parsing before this
+        self.deferred = []          # replies sent when busy_until passes
+        self.g92 = [0.0, 0.0, 0.0]
+        self.tlo = 0.0
+        self.prb = ([0.0, 0.0, 0.0], 0)
+        self.modes = {"motion": 0.0, "wcs": 54.0, "plane": 17.0, "units": 21.0,
+                      "distance": 90.0, "feedmode": 94.0, "spindle": 5.0, "coolant": 9.0}
+        self.feed = 0.0
+        self.speed = 0.0
+        self.overrides = [100, 100, 100]
+        self.reports = 0
+
+    def _send(self, text):
+        if self.output is not None:
+            try:
+                self.output((text + "\r\n").encode("ascii"))
+            except Exception:
+                self.output = None
+
+    def _offset(self):
+        """Work offset (WCO): active coordinate system + G92 + tool length offset."""
+        base = self.wcs[int(self.modes["wcs"]) - 53]
+        return [base[0] + self.g92[0], base[1] + self.g92[1], base[2] + self.g92[2] + self.tlo]
+
+    def _status(self):
+        self.reports += 1
+        mask = int(self.settings.get(10, 1))
+        fields = [self.state]
+        if mask & 1:
+            fields.append("MPos:" + ",".join(f"{v:.3f}" for v in self.pos))
+        else:
+            off = self._offset()
+            fields.append("WPos:" + ",".join(f"{p - o:.3f}" for p, o in zip(self.pos, off)))
+        if mask & 2:
+            fields.append(f"Bf:{self.planner_blocks - len(self.planner)},{self.rx_size - 1 - len(self.rx)}")
+        running = self.state in ("Run", "Jog") or self.state.startswith("Hold")
+        fields.append(f"FS:{self.feed if running else 0:.0f},{self.speed if self.modes['spindle'] != 5.0 else 0:.0f}")
+        n = self.reports % STATUS_WCO_EVERY
+        if n == 0:
+            fields.append("WCO:" + ",".join(f"{v:.3f}" for v in self._offset()))
+        elif n == 1:
+            fields.append("Ov:" + ",".join(str(v) for v in self.overrides))
+            acc = ("S" if self.modes["spindle"] == 3.0 else "C" if self.modes["spindle"] == 4.0 else "") \
+                + ("F" if self.modes["coolant"] == 8.0 else "") + ("M" if self.modes["coolant"] == 7.0 else "")
+            if acc:
+                fields.append("A:" + acc)
+        return "<" + "|".join(fields) + ">"
+
+    # ------------------------- Realtime -------------------------
+    def _hold_planner(self):
+        if self.block_end is not None:
+            self.hold_left = max(0.0, self.block_end - time.perf_counter())
+            self.block_end = None
+        self.state = "Hold:0"
+
+    def _resume_planner(self):
+        if self.hold_left is not None and self.planner:
+            self.block_end = time.perf_counter() + self.hold_left
+        self.hold_left = None
+        self.state = "Run" if self.planner else "Idle"
+
+    def _soft_reset(self):
+        moving = bool(self.planner) and self.state in ("Run", "Jog")
+        if moving:
+            self._send("ALARM:3")  # position lost: reset while in motion
+        alarm = moving or self.state == "Alarm"
+        self._reset()
+        self.state = "Alarm" if alarm else "Idle"
+        self._send("\r\n" + BANNER)
+        if alarm:
+            self._send("[MSG:'$H'|'$X' to unlock]")
+
+    def _realtime(self, b):
+        ov = self.overrides
+        if b == 0x84:
+            self._hold_planner()
+            self.state = "Door:0"
+        elif b == 0x85:
+            if self.state == "Jog":
+                self.planner.clear()
+                self.block_end = None
+                self.state = "Idle"
+        elif b == 0x90:
+            ov[0] = 100
+        elif 0x91 <= b <= 0x94:
+            ov[0] = min(200, max(10, ov[0] + {0x91: 10, 0x92: -10, 0x93: 1, 0x94: -1}[b]))
+        elif 0x95 <= b <= 0x97:
+            ov[1] = {0x95: 100, 0x96: 50, 0x97: 25}[b]
+        elif b == 0x99:
+            ov[2] = 100
+        elif 0x9A <= b <= 0x9D:
+            ov[2] = min(200, max(10, ov[2] + {0x9A: 10, 0x9B: -10, 0x9C: 1, 0x9D: -1}[b]))
+        elif b == 0xA0:
+            self.modes["coolant"] = 9.0 if self.modes["coolant"] == 8.0 else 8.0
+        elif b == 0xA1:
+            self.modes["coolant"] = 9.0 if self.modes["coolant"] == 7.0 else 7.0
+
+    def alarm(self, code):
+        """Raise ALARM:code as if the machine tripped (e.g. 1 = hard limit). Any thread."""
+        with self.cond:
+            self._alarm(code)
+
+    def _alarm(self, code, message="[MSG:Reset to continue]"):
+        self.planner.clear()
+        self.block_end = None
+        self.hold_left = None
+        self.rx.clear()
+        self.deferred = []
+        self.state = "Alarm"
+        self._send(f"ALARM:{code}")
+        if message:
+            self._send(message)
+
+    # ------------------------- Worker -------------------------
+    def _run(self):
+        with self.cond:
+            while self.running:
+                now = time.perf_counter()
+                self._execute(now)
+                if self.deferred and now >= self.busy_until:
+                    for text in self.deferred:
+                        self._send(text)
+                    self.deferred = []
+                parsed = self._parse(now)
+                if parsed:
+                    continue
+                waits = [0.05]
+                if self.block_end is not None:
+                    waits.append(self.block_end - now)
+                if self.deferred:
+                    waits.append(self.busy_until - now)
+                self.cond.wait(max(0.0, min(waits)))
+
+    def _execute(self, now):
+        """Retire the planner blocks whose time is up."""
+        if self.hold_left is not None or self.state == "Alarm":
+            return
+        if self.planner and self.block_end is None:
+            self.block_end = now + self.planner[0][1]
+        while self.planner and self.block_end is not None and self.block_end <= now:
+            target, _ = self.planner.popleft()
+            self.pos = list(target)
+            self.blocks += 1
+            self.block_end = self.block_end + self.planner[0][1] if self.planner else None
+        if self.state in ("Run", "Jog") and not self.planner:
+            self.state = "Idle"
+
+    def _parse(self, now):
+        """Take complete lines from the RX buffer while the planner has room. True if any."""
+        if now < self.busy_until or self.deferred:
+            return False
+        done = False
+        while len(self.planner) < self.planner_blocks:
+            end = self.rx.find(b"\n")
+            if end < 0:
+                break
+            text = self.rx[:end].decode("ascii", errors="ignore")
+            if _needs_sync(text) and (self.planner or self.state.startswith("Hold")):
+                break  # dwell, probe, homing: wait for the motion to finish
+            del self.rx[:end + 1]
+            self.lines += 1
+            reply = self._execute_line(text)
+            if reply is not None:
+                if self.deferred:
+                    self.deferred.append(reply)
+                else:
+                    self._send(reply)
+            done = True
+            if self.deferred:
+                break
+        return done
+
+    def _queue(self, target, feed=None, rapid=False):
+        duration = self.block_time
+        if self.time_scale > 0:
+            dist = math.dist(self.planner[-1][0] if self.planner else self.pos, target)
+            rate = min(self.settings[110], self.settings[111], self.settings[112]) if rapid else feed
+            if rate:
+                duration = max(duration, dist / rate * 60.0 * self.time_scale)
+        self.planner.append((tuple(target), duration))
+        if self.state not in ("Jog",) and not self.state.startswith("Hold"):
+            self.state = "Run"
+
+    def _end_position(self):
+        """Where the machine will be once the planner has run out."""
+        return list(self.planner[-1][0]) if self.planner else list(self.pos)
+
+    # ------------------------- Line execution -------------------------
+    def _execute_line(self, raw):
+        text = _COMMENT_RE.sub("", raw.upper())
+        text = "".join(text.split(";", 1)[0].split())
+        if not text:
+            return "ok"
+        if len(raw) > LINE_MAX:
+            return "error:14"
+        if text[0] == "$":
+            return self._system(text)
+        if self.state == "Alarm":
+            return "error:9"
+        return self._gcode(text)
+
+    def _system(self, text):
+        if text == "$":
+            self._send("[HLP:$$ $# $G $I $N $x=val $Nx=line $J=line $SLP $C $X $H ~ ! ? ctrl-x]")
+        elif text == "$$":
+            for k in sorted(self.settings):
+                v = self.settings[k]
+                self._send(f"${k}={v:.3f}" if isinstance(v, float) else f"${k}={v}")
+        elif text == "$#":
+            for p in range(1, 7):
+                self._send(f"[G{53 + p}:" + ",".join(f"{v:.3f}" for v in self.wcs[p]) + "]")
+            self._send("[G28:0.000,0.000,0.000]")
+            self._send("[G30:0.000,0.000,0.000]")
+            self._send("[G92:" + ",".join(f"{v:.3f}" for v in self.g92) + "]")
+            self._send(f"[TLO:{self.tlo:.3f}]")
+            self._send("[PRB:" + ",".join(f"{v:.3f}" for v in self.prb[0]) + f":{self.prb[1]}]")
+        elif text == "$G":
+            m = self.modes
+            self._send(f"[GC:G{m['motion']:g} G{m['wcs']:g} G{m['plane']:g} G{m['units']:g} "
+                       f"G{m['distance']:g} G{m['feedmode']:g} M{m['spindle']:g} M{m['coolant']:g} "
+                       f"T0 F{self.feed:g} S{self.speed:g}]")
+        elif text == "$I":
+            self._send("[VER:1.1h.20190825:]")
+            self._send(f"[OPT:V,{self.planner_blocks},{self.rx_size}]")
+        elif text == "$X":
+            if self.state == "Alarm":
+                self.state = "Idle"
+                self._send("[MSG:Caution: Unlocked]")
+        elif text == "$H":
+            if not self.settings.get(22):
+                return "error:5"
+            pull = float(self.settings.get(27, 1.0))
+            self.pos = [-pull, -pull, -pull]
+            self.state = "Idle"
+        elif text.startswith("$J="):
+            if self.state == "Alarm":
+                return "error:9"
+            return self._gcode(text[3:], jog=True)
+        elif text in ("$C", "$SLP", "$N") or text.startswith("$N"):
+            pass
+        else:
+            m = re.fullmatch(r"\$(\d+)=([-+]?(?:\d+\.?\d*|\.\d+))", text)
+            if not m:
+                return "error:3"
+            key, value = int(m.group(1)), float(m.group(2))
+            if key not in self.settings:
+                return "error:3"
+            self.settings[key] = value if isinstance(self.settings[key], float) else int(value)
+        return "ok"
+
+    def _gcode(self, text, jog=False):
+        words = _WORD_RE.findall(text)
+        if sum(len(l) + len(v) for l, v in words) != len(text):
+            return "error:1"
+        vals = {}
+        gs = []
+        ms = []
+        for letter, value in words:
+            if letter not in WORD_LETTERS:
+                return "error:20"
+            v = float(value)
+            if letter == "G":
+                if v not in SUPPORTED_G:
+                    return "error:20"
+                gs.append(v)
+            elif letter == "M":
+                if v not in SUPPORTED_M:
+                    return "error:20"
+                ms.append(v)
+            elif letter in vals:
+                return "error:25"  # repeated word
+            else:
+                vals[letter] = v
+
+        modes = dict(self.modes)
+        non_modal = None
+        for g in gs:
+            if g in MOTION_G:
+                modes["motion"] = g
+            elif g in (17.0, 18.0, 19.0):
+                modes["plane"] = g
+            elif g in (20.0, 21.0):
+                modes["units"] = g
+            elif g in (90.0, 91.0):
+                modes["distance"] = g
+            elif g in (93.0, 94.0):
+                modes["feedmode"] = g
+            elif 54.0 <= g <= 59.0:
+                modes["wcs"] = g
+            elif g in (4.0, 10.0, 28.0, 28.1, 30.0, 30.1, 53.0, 92.0, 92.1):
+                non_modal = g
+            elif g == 43.1:
+                self.tlo = vals.get("Z", 0.0) * (25.4 if modes["units"] == 20.0 else 1.0)
+                vals.pop("Z", None)
+            elif g == 49.0:
+                self.tlo = 0.0
+        if jog:
+            modes["motion"] = 1.0
+        scale = 25.4 if modes["units"] == 20.0 else 1.0
+        if "F" in vals:
+            self.feed = vals["F"] * scale
+        if "S" in vals:
+            self.speed = vals["S"]
+        for code in ms:
+            if code in (3.0, 4.0, 5.0):
+                modes["spindle"] = code
+            elif code in (7.0, 8.0, 9.0):
+                modes["coolant"] = code
+
+        axes = [vals.get(a) for a in "XYZ"]
+        has_axes = any(v is not None for v in axes)
+
+        if non_modal == 4.0:
+            self.busy_until = time.perf_counter() + vals.get("P", 0.0)
+            self.deferred = ["ok"]
+            self.modes.update(modes)
+            return None
+        if non_modal == 10.0:
+            p = int(vals.get("P", 0)) or int(modes["wcs"]) - 53
+            if p not in self.wcs:
+                return "error:29"
+            off = self.wcs[p]
+            for i, v in enumerate(axes):
+                if v is None:
+                    continue
+                if vals.get("L") == 20.0:
+                    off[i] = self.pos[i] - self.g92[i] - (self.tlo if i == 2 else 0.0) - v * scale
+                else:
+                    off[i] = v * scale
+            self.modes.update(modes)
+            return "ok"
+        if non_modal == 92.0:
+            base = self.wcs[int(modes["wcs"]) - 53]
+            end = self._end_position()
+            for i, v in enumerate(axes):
+                if v is not None:
+                    self.g92[i] = end[i] - base[i] - (self.tlo if i == 2 else 0.0) - v * scale
+            self.modes.update(modes)
+            return "ok"
+        if non_modal == 92.1:
+            self.g92 = [0.0, 0.0, 0.0]
+            self.modes.update(modes)
+            return "ok"
+
+        if not has_axes:
+            if 2.0 in gs or 3.0 in gs:
+                return "error:26"  # arc with no axis words
+            self.modes.update(modes)
+            if any(code in (2.0, 30.0) for code in ms):
+                self._program_end()
+            return "ok"
+
+        # target in machine coordinates; a G54..G59 on this line already applies
+        end = self._end_position()
+        off = [0.0, 0.0, 0.0]
+        if non_modal != 53.0:
+            base = self.wcs[int(modes["wcs"]) - 53]
+            off = [base[0] + self.g92[0], base[1] + self.g92[1], base[2] + self.g92[2] + self.tlo]
+        relative = modes["distance"] == 91.0 and non_modal != 53.0
+        target = []
+        for i, v in enumerate(axes):
+            if v is None:
+                target.append(end[i])
+            elif relative:
+                target.append(end[i] + v * scale)
+            else:
+                target.append(v * scale + off[i])
+        if non_modal in (28.0, 30.0):
+            target = [0.0, 0.0, 0.0]  # stored positions are the machine origin here
+
+        motion = modes["motion"]
+        if non_modal not in (28.0, 30.0, 53.0) and motion in (1.0, 2.0, 3.0) and not self.feed:
+            return "error:22"
+        if self.settings.get(20) and not self._within_travel(target):
+            if jog:
+                return "error:15"
+            self.modes.update(modes)
+            self._alarm(2)
+            return None
+        self.modes.update(modes)
+        if jog:
+            self.state = "Jog"
+
+        if motion in (38.2, 38.3, 38.4, 38.5) and non_modal is None:
+            return self._probe(target, motion)
+        self._queue(target, self.feed, rapid=motion == 0.0 or non_modal in (28.0, 30.0))
+        if any(code in (2.0, 30.0) for code in ms):
+            self._program_end()
+        return "ok"
+
+    def _within_travel(self, target):
+        for i, v in enumerate(target):
+            travel = float(self.settings.get(130 + i, 0.0))
+            if not -travel - 1e-6 <= v <= 1e-6:
+                return False
+        return True
+
+    def _program_end(self):
+        self.modes.update(motion=1.0, wcs=54.0, plane=17.0, distance=90.0, feedmode=94.0,
+                          spindle=5.0, coolant=9.0)
+        self.g92 = [0.0, 0.0, 0.0]
+
+    def _probe(self, target, motion):
+        """Straight probe move from the current position; stops where the tip meets the bed."""
+        start = list(self.pos)
+        if start[2] <= self.bed(start[0], start[1]) and motion in (38.2, 38.3):
+            self._alarm(4, None)  # probe already triggered
+            return None
+        contact = None
+        steps = 200
+        for k in range(1, steps + 1):
+            t = k / steps
+            p = [a + (b - a) * t for a, b in zip(start, target)]
+            if p[2] <= self.bed(p[0], p[1]):
+                lo, hi = (k - 1) / steps, t
+                for _ in range(30):
+                    mid = (lo + hi) / 2
+                    q = [a + (b - a) * mid for a, b in zip(start, target)]
+                    if q[2] <= self.bed(q[0], q[1]):
+                        hi = mid
+                    else:
+                        lo = mid
+                contact = [a + (b - a) * hi for a, b in zip(start, target)]
+                break
+
+        duration = self.block_time
+        if self.time_scale > 0 and self.feed:
+            duration = max(duration, math.dist(start, contact or target) / self.feed * 60.0 * self.time_scale)
+        self.busy_until = time.perf_counter() + duration
+        if contact is None:
+            self.pos = list(target)
+            self.prb = (list(target), 0)
+            if motion in (38.2, 38.4):
+                self.busy_until = 0.0
+                self._alarm(5, None)  # no contact within the programmed travel
+                return None
+            self.deferred = ["[PRB:" + ",".join(f"{v:.3f}" for v in target) + ":0]", "ok"]
+            return None
+        self.pos = contact
+        self.prb = (contact, 1)
+        self.deferred = ["[PRB:" + ",".join(f"{v:.3f}" for v in contact) + ":1]", "ok"]
+        return None
+
+
+_SYNC_RE = re.compile(r"^\$(?!J=)|G0*4(?![\d.])|G0*38\.")
+
+
+def _needs_sync(text):
+    """Lines GRBL only runs once the planner is empty (dwell, probing, $ commands but jogs)."""
+    return _SYNC_RE.search("".join(text.upper().split())) is not None
+
+
+# ------------------------- Transports -------------------------
+def serve_pty(grbl):
+    """Expose grbl on a new pseudo-terminal. Returns the device path to open (POSIX only)."""
+    import tty
+    master, slave = os.openpty()
+    tty.setraw(slave)
+    path = os.ttyname(slave)
+
+    def write(data):
+        os.write(master, data)
+
+    def reader():
+        while grbl.running:
+            try:
+                data = os.read(master, 4096)
+            except OSError:
+                break
+            if data:
+                grbl.receive(data)
+
+    grbl.attach(write)
+    threading.Thread(target=reader, daemon=True).start()
+    grbl._pty = (master, slave)  # keep the slave open so hosts can reconnect
+    return path
+
+
+def serve_socket(grbl, port=23000, host="127.0.0.1"):
+    """Expose grbl on a TCP port, one host at a time. Returns the pyserial URL."""
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind((host, port))
+    server.listen(1)
+    port = server.getsockname()[1]
+
+    def accept_loop():
+        while grbl.running:
+            try:
+                conn, _ = server.accept()
+            except OSError:
+                break
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            grbl.attach(conn.sendall)
+            while grbl.running:
+                try:
+                    data = conn.recv(4096)
+                except OSError:
+                    break
+                if not data:
+                    break
+                grbl.receive(data)
+            grbl.detach()
+            conn.close()
+
+    threading.Thread(target=accept_loop, daemon=True).start()
+    grbl._server = server
+    return f"socket://{host}:{port}"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Virtual GRBL 1.1 controller for testing PilotX without a machine.")
+    where = parser.add_mutually_exclusive_group(required=True)
+    where.add_argument("--pty", action="store_true", help="serve on a pseudo-terminal (Linux/macOS)")
+    where.add_argument("--socket", type=int, metavar="PORT", help="serve on TCP PORT (socket://localhost:PORT)")
+    parser.add_argument("--block-time", type=float, default=BLOCK_TIME,
+                        help="seconds each planner block takes (default %(default)s)")
+    parser.add_argument("--time-scale", type=float, default=0.0,
+                        help="also take distance/feed x this long per block (1 = real time)")
+    parser.add_argument("--planner", type=int, default=PLANNER_BLOCKS, help="planner blocks")
+    parser.add_argument("--rx-buffer", type=int, default=RX_BUFFER_SIZE, help="RX buffer bytes")
+    parser.add_argument("--bed", default="0,0,0", metavar="Z,TX,TY",
+                        help="bed surface for probing: machine Z at X0 Y0 and the X/Y tilt (mm/mm)")
+    parser.add_argument("--bed-wave", type=float, default=0.0, metavar="MM",
+                        help="add a ripple of this amplitude (50 mm period) to the bed")
+    parser.add_argument("--soft-limits", action="store_true", help="start with $20=1 (travel from $130-$132)")
+    args = parser.parse_args(argv)
+
+    z, tx, ty = (float(v) for v in args.bed.split(","))
+    grbl = VirtualGrbl(block_time=args.block_time, planner_blocks=args.planner,
+                       rx_size=args.rx_buffer, bed=flat_bed(z, tx, ty, args.bed_wave),
+                       time_scale=args.time_scale)
+    if args.soft_limits:
+        grbl.settings[20] = 1
+    grbl.start()
+    where = serve_pty(grbl) if args.pty else serve_socket(grbl, args.socket)
+    print(f"Virtual GRBL on {where} (Ctrl+C to quit)")
+    try:
+        while True:
+            time.sleep(5)
+            print(f"lines {grbl.lines}, blocks {grbl.blocks}, max RX {grbl.max_rx} bytes, "
+                  f"overflows {grbl.overflows}, state {grbl.state}")
+    except KeyboardInterrupt:
+        grbl.stop()
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
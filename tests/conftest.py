@@ -0,0 +1,44 @@
+# Shared fixtures: an in-process virtual controller served over TCP and a
+# helper that streams a program to it through StreamEngine.
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pilotx_engine import StreamEngine, STREAM_MODE_CHARS  # noqa: E402
+from pilotx_virtual import VirtualGrbl, serve_socket  # noqa: E402
+
+
+@pytest.fixture
+def virtual_grbl():
+    grbl = VirtualGrbl().start()
+    url = serve_socket(grbl, 0)
+    yield grbl, url
+    grbl.stop()
+    grbl._server.close()
+
+
+@pytest.fixture
+def stream(virtual_grbl):
+    """stream(lines, start=0, preamble=None) -> controller responses, after the job finishes."""
+    grbl, url = virtual_grbl
+    engines = []
+
+    def run(lines, start=0, preamble=None):
+        engine = StreamEngine(stream_mode=STREAM_MODE_CHARS)
+        engines.append(engine)
+        responses = []
+        engine.on("response", responses.append)
+        engine.connect(url)
+        engine.load_program(lines)
+        engine.start_job(start, preamble)
+        engine.wait_until_done(poll=0.05)
+        grbl._execute(float("inf"))  # retire the planner
+        return responses
+
+    yield run
+    for engine in engines:
+        engine.disconnect()
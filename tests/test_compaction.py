@@ -0,0 +1,48 @@
+import numpy as np
+
+from pilotx_gcode import CompactState, CompactedLines, compact_line, compile_program
+
+
+def compact_all(lines, resolution=0.001):
+    state = CompactState()
+    return [compact_line(line, state, resolution) for line in lines]
+
+
+def test_drops_comments_whitespace_and_modal_repeats():
+    out = compact_all(["G21 G90 (setup)", "G1 X1.00000 Y2 F500 ; first",
+                       "G1 X1.0004 Y3 F500", "G1 X2 Y3 F600"])
+    assert out == ["G21G90", "G1X1Y2F500", "Y3", "X2F600"]
+
+
+def test_keeps_lines_it_does_not_understand():
+    state = CompactState()
+    assert compact_line("G1 X1 F100", state) == "G1X1F100"
+    assert compact_line("$H", state) == "$H"
+    assert compact_line("G1 X1 F100", state) == "G1X1F100"  # state was forgotten
+
+
+def test_feed_mode_change_resends_feed():
+    assert compact_all(["G94 G1 X1 F100", "G93 X2 F100", "G94 X3 F100"])[1:] == ["G93X2F100", "G94X3F100"]
+
+
+def test_same_path_after_compaction():
+    lines = ["G21 G90", "G0 X0 Y0 Z5", "G1 Z-1.00049 F300"] + \
+        [f"G1 X{i * 0.1234567:.7f} Y{i * 0.05:.4f} Z-1 F1200" for i in range(200)] + ["M30"]
+    before = compile_program(lines).records
+    after = compile_program(compact_all(lines)).records
+    for axis in "xyz":
+        np.testing.assert_allclose(after[axis], before[axis], atol=0.0005)
+    np.testing.assert_array_equal(after["feed"], before["feed"])
+
+
+def test_relative_moves_do_not_drift():
+    lines = ["G21 G91"] + ["G1 X0.00049 Y-0.0123456 F500"] * 10000
+    end = compile_program(compact_all(lines)).records[-1]
+    assert abs(end["x"] - 4.9) < 1e-6 and abs(end["y"] + 123.456) < 1e-6
+
+
+def test_compacted_lines_count_bytes():
+    lines = CompactedLines(["G1 X1.00000 F500 (a)", "G1 X2.00000 F500"])
+    assert list(lines) == ["G1X1F500", "X2"]
+    assert (lines.bytes_in, lines.bytes_out) == (38, 12)
+    assert lines[0] == "G1X1F500"  # cached re-read
@@ -0,0 +1,63 @@
+import random
+
+import numpy as np
+import pytest
+
+from pilotx_gcode import (PROGRAM_DTYPE, MOTION_NONE, FLAG_MOTION_WORD, FLAG_X, FLAG_F, FLAG_ABSOLUTE,
+                          FLAG_INCHES, compile_program, _compile_lines)
+
+GARBAGE = ["X1.2.3", "X-", "5X1", "GX1", "X1 2", "X1-2", "G17", "X1X2", "G1 G0", "N10 G1 X1", "X+.5", "\tG1\tX1",
+           "g1x1", "G1.0 X1", "G01.X1", "X.", "X1.", "-1", "G", "  ", "G4 X1", "X-0", "X1e3", "X1 ;c", "G3 X1 I1",
+           "G91 X1", "G90", "G20", "G21", "G93", "M3 S1000", "G10 L2 P1 X5", "N1N2X1", "X1 (c)", "G54 G1 X1"]
+
+
+def word_loop(lines):
+    """Reference: every line through the word loop."""
+    records = np.zeros(len(lines), dtype=PROGRAM_DTYPE)
+    _compile_lines([line.upper() for line in lines], records, (MOTION_NONE, 0.0, 0.0, 0.0, 0.0, 0.0, 0, True, False))
+    return records
+
+
+def cam_program(seed, runs=300):
+    rng = random.Random(seed)
+
+    def num():
+        return rng.choice(["", "-", "+"]) + rng.choice(["1", "1.", ".5", "12.345", "0", "007.25", "0.1234567"])
+    lines = []
+    for _ in range(runs):
+        for _ in range(rng.randint(20, 150)):
+            words = [rng.choice(["G0", "G1", "G01", "g1", "G2", "G3"])] if rng.random() < 0.3 else []
+            words += [axis + num() for axis in "XYZF" if rng.random() < 0.6]
+            if rng.random() < 0.05:
+                words.insert(0, f"N{rng.randint(1, 9999)}")
+            lines.append(rng.choice([" ", "", "\t"]).join(words))
+        lines.append(rng.choice(GARBAGE))
+    return lines
+
+
+@pytest.mark.parametrize("seed", [1, 2, 3])
+def test_runs_compile_like_the_word_loop(seed):
+    lines = cam_program(seed)
+    for program in (lines, ["G91"] + lines, ["G20 G91"] + lines):
+        expected = word_loop(program)
+        records = compile_program(program).records
+        for field in PROGRAM_DTYPE.names:
+            if field != "src":
+                np.testing.assert_array_equal(records[field], expected[field], err_msg=field)
+
+
+def test_simple_line_records():
+    lines = ["G21 G90"] + [f"G1 X{i}.5 F{100 + i // 10}" for i in range(100)] + ["Y2", "G0 Z-1"]
+    rec = compile_program(lines).records
+    assert rec["motion"][1] == 1 and rec["motion"][-1] == 0
+    assert rec["x"][100] == 99.5 and rec["feed"][100] == 109.0
+    assert rec["flags"][1] == FLAG_MOTION_WORD | FLAG_X | FLAG_F | FLAG_ABSOLUTE
+    assert (rec["y"][-2], rec["z"][-1], rec["x"][-1]) == (2.0, -1.0, 99.5)
+
+
+def test_inches_and_progress():
+    calls = []
+    lines = ["G20"] + ["X1 Y1"] * 250000
+    rec = compile_program(lines, progress=lambda stage, done, total: calls.append(done)).records
+    assert rec["flags"][-1] & FLAG_INCHES
+    assert calls == [0, 100000, 200000, 250001]
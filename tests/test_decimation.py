@@ -0,0 +1,36 @@
+import numpy as np
+
+from pilotx_gcode import compile_program, decimate_program
+
+
+def test_merges_a_collinear_run():
+    lines = ["G21 G90", "G0 X0 Y0 Z0", "G1 X0 F500"] + [f"G1 X{i * 0.01:.2f} Y0" for i in range(1, 101)]
+    program, report = decimate_program(compile_program(lines), 0.005)
+    assert report.lines_before == len(lines)
+    assert report.lines_after == len(program) < 10
+    assert report.max_deviation <= 0.005
+    assert program.lines[-1] == lines[-1]
+
+
+def test_deviation_stays_within_tolerance():
+    x = np.linspace(0, 20, 2001)
+    y = 0.003 * np.sin(x * 3)
+    lines = ["G21 G90", "G0 X0 Y0 Z0", "G1 X0 F800"] + [f"G1 X{a:.4f} Y{b:.4f}" for a, b in zip(x, y)]
+    program, report = decimate_program(compile_program(lines), 0.002)
+    assert report.lines_after < report.lines_before
+    assert report.max_deviation <= 0.002
+    end = program.records[-1]
+    assert (end["x"], end["y"]) == (float(np.float64(f"{x[-1]:.4f}")), float(np.float64(f"{y[-1]:.4f}")))
+
+
+def test_feed_changes_and_other_words_are_kept():
+    lines = ["G21 G90", "G0 X0 Y0 Z0", "G1 X1 F500", "G1 X2 F600", "G1 X3 M8", "G1 X4", "G1 X5"]
+    program, report = decimate_program(compile_program(lines), 0.01)
+    assert "G1 X2 F600" in program.lines and "G1 X3 M8" in program.lines
+
+
+def test_dropped_axis_words_reappear():
+    lines = ["G21 G90", "G0 X0 Y0 Z0", "G1 X0 F500", "G1 X1 Z-1", "G1 X2 Z-2", "G1 X3", "G1 X4 Z-2.0001"]
+    program, _ = decimate_program(compile_program(lines), 0.01)
+    rec = compile_program(list(program.lines)).records
+    np.testing.assert_allclose((rec[-1]["x"], rec[-1]["z"]), (4.0, -2.0001))
@@ -0,0 +1,85 @@
+import threading
+import time
+
+import pytest
+
+from pilotx_engine import StreamEngine, RT_STATUS, parse_status_report
+
+PROGRAM = ["G21 G90", "G0 X0 Y0 Z5", "G1 Z-1 F600"] + [f"G1 X{i} Y{i % 7}" for i in range(1, 60)] + ["G0 Z5", "M30"]
+
+
+def test_status_report_fields():
+    report = parse_status_report("<Hold:1|WPos:1.000,2.000,3.000|Bf:15,128|Ln:42|FS:500,8000|WCO:1.000,2.000,0.000>")
+    assert (report.state, report.substate) == ("Hold", 1)
+    assert report.mpos == (2.0, 4.0, 3.0)
+    assert (report.planner, report.rx_free, report.line, report.feed, report.spindle) == (15, 128, 42, 500.0, 8000.0)
+    later = parse_status_report("<Run|MPos:0.000,0.000,0.000>", report)
+    assert later.wco == report.wco and later.wpos == (-1.0, -2.0, 0.0)
+
+
+def test_streams_a_program_to_the_end(stream, virtual_grbl):
+    grbl, _ = virtual_grbl
+    responses = stream(PROGRAM)
+    assert not [r for r in responses if r.startswith(("error", "ALARM"))]
+    assert grbl.lines >= len(PROGRAM) and grbl.overflows == 0
+    assert grbl._end_position()[0] == pytest.approx(59.0)
+
+
+def test_errors_are_reported_with_their_line(stream):
+    responses = stream(["G21 G90", "G1 X1 F100", "G2F800", "G1 X2"])
+    assert [r for r in responses if r.startswith("error")] == ["error:26 (G2F800)"]
+
+
+def test_realtime_bytes_take_no_buffer_credit(virtual_grbl):
+    _, url = virtual_grbl
+    engine = StreamEngine()
+    engine.connect(url)
+    try:
+        for _ in range(50):
+            engine.send_realtime(RT_STATUS)
+        assert engine.send_line("?") is None
+        assert engine.pending_chars == 0 and not engine.pending_lines
+        assert engine.send_line("G4 P0").result(timeout=5) == "ok"
+    finally:
+        engine.disconnect()
+
+
+def test_simulated_job_sends_nothing():
+    engine = StreamEngine()
+    engine.simulate = True
+    engine.sim_speed = 1000.0
+    engine.load_program(PROGRAM[:5])
+    engine.start_job()
+    engine.wait_until_done(poll=0.01)
+    assert engine.current_line_index == 5
+
+
+class SlowDrainPort:
+    """Serial stand-in whose flush() takes as long as draining a full RX buffer at 115200 baud."""
+
+    is_open = True
+
+    def __init__(self):
+        self.data = bytearray()
+        self.draining = threading.Event()
+
+    def write(self, data):
+        self.data += data
+
+    def flush(self):
+        self.draining.set()
+        time.sleep(0.2)
+
+
+def test_realtime_bytes_do_not_wait_for_a_line_to_drain():
+    engine = StreamEngine()
+    engine.serial_connection = port = SlowDrainPort()
+    engine.is_connected = True
+    writer = threading.Thread(target=engine.send_line, args=("G1 X10 F100",))
+    writer.start()
+    assert port.draining.wait(1)
+    t = time.perf_counter()
+    engine.send_realtime(RT_STATUS)
+    assert time.perf_counter() - t < 0.1
+    writer.join()
+    assert bytes(port.data) == b"G1 X10 F100\n" + RT_STATUS
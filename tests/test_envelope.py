@@ -0,0 +1,111 @@
+import numpy as np
+
+from pilotx_engine import StreamEngine
+from pilotx_gcode import compile_program, check_envelope, resume_state, resume_preamble
+from pilotx_virtual import VirtualGrbl
+
+# Work offset -100,-100,-50, 200 mm travel, $23=3 (X and Y home to negative,
+# which does not move machine space)
+ENVELOPE_SETUP = ("$20=1", "$23=3", "G10 L2 P1 X-100 Y-100 Z-50")
+ENVELOPE_PROGRAM = (
+    "G21 G90", "G0 X0 Y0 Z10", "G0 X50 Y50 Z10", "G1 X50 Y50 Z-5 F500",
+    "G1 X100.5 Y50 Z-5",    # machine X +0.5
+    "G1 X-150 Y50 Z-5",     # machine X -250
+    "G1 X-90 Y50 Z-5",      # machine X -190, inside
+    "G1 X-90 Y120 Z-5",     # machine Y +20
+    "G0 X-90 Y50 Z60",      # machine Z +10
+    "G0 X-90 Y50 Z-160",    # machine Z -210
+    "G0 X0 Y0 Z0", "M30",
+)
+
+
+def soft_limit_alarms(setup, program):
+    """Lines of program that trip VirtualGrbl's soft limits, and the controller."""
+    grbl = VirtualGrbl()
+    for line in setup:
+        grbl._execute_line(line)
+    alarmed = []
+    for i, line in enumerate(program):
+        grbl._execute_line(line)
+        if grbl.state == "Alarm":
+            alarmed.append(i)
+            grbl._execute_line("$X")
+        grbl._execute(float("inf"))  # finish the move
+    return alarmed, grbl
+
+
+def test_flags_the_lines_the_controller_alarms_on():
+    alarmed, grbl = soft_limit_alarms(ENVELOPE_SETUP, ENVELOPE_PROGRAM)
+    travel = [grbl.settings[130 + a] for a in range(3)]
+    report = check_envelope(compile_program(list(ENVELOPE_PROGRAM)), grbl._offset(), travel)
+    assert alarmed == [4, 5, 7, 8, 9]
+    assert report.travel_lines.tolist() == alarmed
+    assert not report.ok
+
+
+def test_inside_travel_and_stock_is_ok():
+    program = compile_program(["G21 G90", "G0 X10 Y10 Z5", "G1 Z-2 F300", "G1 X20"])
+    report = check_envelope(program, (-100.0, -100.0, -50.0), travel=(200.0, 200.0, 200.0),
+                            stock=(0.0, 30.0, 0.0, 30.0, -5.0, 10.0))
+    assert report.ok
+    np.testing.assert_allclose(report.work_min, (10.0, 10.0, -2.0))
+    np.testing.assert_allclose(report.work_max, (20.0, 10.0, 5.0))
+
+
+def test_stock_box_is_checked_in_work_coordinates():
+    program = compile_program(["G21 G90", "G0 X10 Y10 Z5", "G1 Z-6 F300"])
+    report = check_envelope(program, stock=(0.0, 30.0, 0.0, 30.0, -5.0, 10.0))
+    assert not report.ok
+    assert report.stock_lines.tolist() == [2]
+
+
+# $23=3: X and Y home to negative; with HOMING_FORCE_SET_ORIGIN they travel 0..+200
+FORCE_ORIGIN_PROGRAM = ["G21 G90", "G0 X10 Y10 Z-10", "G1 X150 F500", "G1 X-5", "G1 Y210", "G0 Z5"]
+
+
+def test_force_set_origin_travel_is_positive_on_negative_homing_axes():
+    program = compile_program(FORCE_ORIGIN_PROGRAM)
+    travel = (200.0, 200.0, 200.0)
+    # default machine space -travel..0: X and Y are positive all along
+    assert check_envelope(program, (0.0, 0.0, 0.0), travel).travel_lines.tolist() == [1, 2, 3, 4, 5]
+    report = check_envelope(program, (0.0, 0.0, 0.0), travel, positive_axes=3)
+    assert report.travel_lines.tolist() == [3, 4, 5]  # X-5, Y210, and Z+5 as Z stays -200..0
+    assert "outside travel 0.000..200.000" in report.summary()
+
+
+def test_engine_applies_dollar_23_only_with_force_set_origin():
+    engine = StreamEngine()
+    engine.grbl_settings.update({23: 3.0, 130: 200.0, 131: 200.0, 132: 200.0})
+    program = compile_program(FORCE_ORIGIN_PROGRAM)
+    assert engine.check_envelope(program).travel_lines.tolist() == [1, 2, 3, 4, 5]
+    assert engine.check_envelope(program, force_set_origin=True).travel_lines.tolist() == [3, 4, 5]
+
+
+def test_resume_checks_the_preamble_and_the_rest_of_the_program():
+    lines = ["G21 G90", "G0 X10 Y10 Z-20", "G1 Z-30 F300", "G1 X-150", "G1 X-10", "G1 X-20"]
+    program = compile_program(lines)
+    state = resume_state(program, 5)
+    preamble = resume_preamble(state, safe_z=5.0)
+    travel = (200.0, 200.0, 200.0)
+    wco = (-100.0, -100.0, -50.0)
+    full = check_envelope(program, wco, travel)
+    assert full.travel_lines.tolist() == [3]  # machine X -250
+    resumed = check_envelope(program, wco, travel, start=state.start, preamble=preamble)
+    assert resumed.ok
+    # the same resume with the work zero 47 mm higher: the safe Z retract leaves the travel
+    resumed = check_envelope(program, (-100.0, -100.0, -3.0), travel, start=state.start, preamble=preamble)
+    assert resumed.travel_lines.tolist() == [-1]
+    assert "resume preamble: machine Z" in resumed.summary()
+
+
+def test_resume_preamble_agrees_with_the_controller():
+    lines = ["G21 G90", "G0 X10 Y10 Z-20", "G1 Z-30 F300", "G1 X-10", "G1 X-20"]
+    program = compile_program(lines)
+    state = resume_state(program, 4)
+    preamble = resume_preamble(state, safe_z=5.0)
+    setup = ("$20=1", "G10 L2 P1 X-100 Y-100 Z-3")
+    alarmed, grbl = soft_limit_alarms(setup, preamble + lines[state.start:])
+    assert alarmed == [1]  # the safe Z retract
+    report = check_envelope(program, grbl._offset(), [grbl.settings[130 + a] for a in range(3)],
+                            start=state.start, preamble=preamble)
+    assert report.travel_lines.tolist() == [-1]
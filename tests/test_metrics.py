@@ -0,0 +1,69 @@
+import threading
+
+import numpy as np
+
+from pilotx_engine import parse_status_report
+from pilotx_metrics import StageTimers, StarvationMonitor, TelemetryRecorder, load_telemetry
+
+
+def test_stage_timers_count_every_thread():
+    timers = StageTimers(enabled=True)
+
+    def work():
+        for _ in range(5000):
+            timers.stop("stage", timers.start())
+    threads = [threading.Thread(target=work) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert timers.summary()["stage"]["count"] == 20000
+
+
+def test_disabled_stage_timers_record_nothing():
+    timers = StageTimers()
+    timers.stop("stage", timers.start())
+    assert timers.summary() == {}
+
+
+def test_telemetry_round_trip_across_spills(tmp_path):
+    recorder = TelemetryRecorder(str(tmp_path), chunk=4)
+    recorder.start("job 1")
+    report = parse_status_report("<Run|MPos:1.000,2.000,3.000|Bf:12,100|FS:500,8000|Ln:7>")
+    for i in range(10):
+        recorder.record(report._replace(time=float(i)), i)
+    done = []
+    path = recorder.stop({"file": "a.nc"}, done=done.append)
+    recorder.wait()
+    assert done == [path] and not list(tmp_path.glob("*.part"))
+    rows, states, meta = load_telemetry(path)
+    assert len(rows) == 10 and meta == {"file": "a.nc"}
+    np.testing.assert_array_equal(rows["index"], np.arange(10))
+    assert states[rows["state"][0]] == "Run"
+    assert tuple(rows[0][["planner", "rx_free", "line"]]) == (12, 100, 7)
+
+
+def test_telemetry_without_reports_leaves_no_file(tmp_path):
+    recorder = TelemetryRecorder(str(tmp_path))
+    recorder.start()
+    assert recorder.stop() is None
+    assert not list(tmp_path.iterdir())
+
+
+def test_starvation_events_from_planner_reports():
+    monitor = StarvationMonitor(threshold=2)
+    base = parse_status_report("<Run|MPos:0,0,0|Bf:15,128>")
+    # empty at the start (not counted), fills, then runs dry twice; Bf: counts free blocks
+    for i, free in enumerate([15, 5, 5, 14, 15, 5, 13, 5]):
+        monitor.sample(base._replace(planner=free, time=monitor.t0 + i), 10 + i, 20 + i)
+    assert monitor.reports == 8 and monitor.samples == 8
+    assert monitor.planner_size == 15 and monitor.starved == 3
+    assert [ev["samples"] for ev in monitor.events] == [2, 1]
+    assert "2 events" in monitor.report()
+
+
+def test_starvation_without_bf_says_so():
+    monitor = StarvationMonitor()
+    monitor.sample(parse_status_report("<Run|MPos:0,0,0>"), 0, 0)
+    assert monitor.reports == 1 and not monitor.seen_bf
+    assert "no Bf:" in monitor.report()
@@ -0,0 +1,67 @@
+import pytest
+
+from pilotx_gcode import compile_program, load_gcode_program, resume_state, resume_preamble
+
+ARC_PROGRAM = ["G21 G90 G18", "M3 S1000", "G0 X0 Y0 Z1", "G1 Z-1 F800",
+               "G2 X10 Z-1 I5 K0", "X20 I5 K0", "G1 X30"]
+
+
+def errors(responses):
+    return [r for r in responses if r.lower().startswith(("error", "alarm"))]
+
+
+def test_state_tracks_plane_and_feed_mode():
+    program = compile_program(["G21 G90 G19 G93", "G1 X1 F2", "G17 G94", "G1 X2 F100"])
+    state = resume_state(program, 2)
+    assert (state.plane, state.inverse_time) == (19, True)
+    state = resume_state(program, 4)
+    assert (state.plane, state.inverse_time) == (17, False)
+
+
+def test_m30_resets_plane_and_feed_mode():
+    state = resume_state(compile_program(["G18 G93", "M30", "G1 X1 F100"]), 2)
+    assert (state.plane, state.inverse_time) == (17, False)
+
+
+def test_arc_continuation_carries_its_motion_word():
+    program = compile_program(ARC_PROGRAM)
+    state = resume_state(program, 5)
+    assert state.arc_continues and state.start == 6 and state.motion == 2
+    preamble = resume_preamble(state, line=ARC_PROGRAM[5])
+    assert preamble[0] == "G21 G90 G54 G18 G94"
+    assert not any(line.startswith(("G2 F", "G3 F")) or line in ("G2", "G3") for line in preamble)
+    assert preamble[-1] == "G2 X20 I5 K0"
+    with pytest.raises(ValueError):
+        resume_preamble(state)
+
+
+def test_line_with_its_own_motion_word_starts_the_stream():
+    state = resume_state(compile_program(ARC_PROGRAM), 6)
+    assert state.motion == 2 and not state.arc_continues and state.start == 6
+    assert resume_preamble(state)[-1] == "F800"
+
+
+def test_inverse_time_is_restored_after_the_preamble():
+    program = compile_program(["G21 G90 G93", "G0 X0 Y0 Z1", "G1 Z-1 F10", "G1 X5 F20"])
+    preamble = resume_preamble(resume_state(program, 3))
+    assert preamble[0].endswith("G94") and preamble[-1] == "G93"
+    assert "F" not in preamble[-2] or preamble[-2].startswith("G1 Z")
+
+
+def test_virtual_controller_rejects_a_bare_arc(virtual_grbl):
+    grbl, _ = virtual_grbl
+    assert grbl._gcode("G2F800") == "error:26"
+
+
+def test_arc_resume_streams_without_errors(tmp_path, stream, virtual_grbl):
+    grbl, _ = virtual_grbl
+    path = tmp_path / "arc.nc"
+    path.write_text("\n".join(ARC_PROGRAM) + "\n")
+    program = load_gcode_program(str(path))
+    index = program.index_of_line(6)
+    state = resume_state(program, index)
+    preamble = resume_preamble(state, line=program.lines[index])
+    responses = stream(program.lines, state.start, preamble)
+    assert not errors(responses)
+    assert grbl.modes["plane"] == 18.0
+    assert grbl._end_position()[0] - grbl._offset()[0] == pytest.approx(30.0)